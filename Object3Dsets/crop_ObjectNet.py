@@ -1,4 +1,5 @@
 import os
+import json
 from PIL import Image
 import glob
 from tqdm import tqdm
@@ -91,8 +92,11 @@ def crop_and_pad_image(image_path, bbox, output_path):
         image_path (str): 入力画像へのパス。
         bbox (tuple): (xmin, ymin, xmax, ymax) のバウンディングボックス (int型)。
         output_path (str): クロップされた画像を保存するパス。
+
+    Returns:
+        list: パディングを除いた有効領域 [left, top, right, bottom] (出力画像の辺に対する割合 0〜1)、
+              失敗した場合は None。
     """
-    # (この関数の内容は変更なし)
     try:
         img = Image.open(image_path).convert('RGB')
         img_width, img_height = img.size
@@ -153,6 +157,11 @@ def crop_and_pad_image(image_path, bbox, output_path):
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         final_image.save(output_path)
 
+        if paste_width <= 0 or paste_height <= 0:
+            return None
+        return [round(paste_x / target_size, 6), round(paste_y / target_size, 6),
+                round((paste_x + paste_width) / target_size, 6), round((paste_y + paste_height) / target_size, 6)]
+
     except FileNotFoundError:
         print(f"Error: Image file not found at {image_path}")
     except Exception as e:
@@ -198,6 +207,8 @@ def main():
     processed_count = 0
     skipped_count = 0
     annotation_not_found_count = 0
+    # 画像ごとの有効領域 (パディングを除いた部分) を出力ディレクトリからの相対パスをキーに記録
+    valid_regions = {}
     error_count = 0
 
     for image_path in tqdm(image_files, desc="Processing images"):
@@ -221,7 +232,9 @@ def main():
                 relative_path = os.path.relpath(image_path, INPUT_BASE_DIR)
                 output_path = os.path.join(OUTPUT_BASE_DIR, relative_path)
 
-                crop_and_pad_image(image_path, bbox, output_path)
+                valid = crop_and_pad_image(image_path, bbox, output_path)
+                if valid is not None:
+                    valid_regions[relative_path.replace(os.sep, '/')] = valid
                 processed_count += 1
             else:
                 skipped_count += 1
@@ -231,6 +244,12 @@ def main():
             error_count += 1
             skipped_count += 1
 
+    # 有効領域をサイドカー JSON に保存 (評価時のノードマスク用)
+    valid_file = os.path.join(OUTPUT_BASE_DIR, "valid_regions.json")
+    os.makedirs(OUTPUT_BASE_DIR, exist_ok=True)
+    with open(valid_file, "w", encoding="utf-8") as f:
+        json.dump(valid_regions, f)
+
     print("\n--- Processing Summary ---")
     print(f"Total candidate image files found: {len(image_files)}")
     print(f"Successfully processed and saved: {processed_count} images.")
@@ -241,6 +260,7 @@ def main():
     # print(f"Skipped (Errors during processing): {error_count} images.") # エラー数は↑に含まれるため、冗長ならコメントアウト
     print(f"Total skipped: {skipped_count} images.")
     print(f"Cropped images saved to: {OUTPUT_BASE_DIR}")
+    print(f"Valid (unpadded) regions saved to: {valid_file}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
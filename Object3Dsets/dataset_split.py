@@ -1,4 +1,5 @@
 import os
+import json
 import shutil
 import random
 import glob
@@ -78,6 +79,14 @@ def split_data(input_dir, output_dir, train_ratio, val_ratio, seed):
     # <<< 修正 >>> ログメッセージを調整
     logging.info(f"Found {len(label_dirs)} label directories.")
 
+    # クロップ時の有効領域 (valid_regions.json, キーは "ラベル/ファイル名") を split ごとに振り分ける
+    valid_file = os.path.join(input_dir, "valid_regions.json")
+    valid_regions = None
+    if os.path.isfile(valid_file):
+        with open(valid_file, "r", encoding="utf-8") as f:
+            valid_regions = json.load(f)
+    split_regions = {"train": {}, "val": {}, "test": {}}
+
     # --- 統計情報用変数 ---
     total_files_considered = 0
     total_files_skipped_insufficient = 0
@@ -154,6 +163,9 @@ def split_data(input_dir, output_dir, train_ratio, val_ratio, seed):
                         dst_path = os.path.join(split_dir, relative_path)
                         os.makedirs(os.path.dirname(dst_path), exist_ok=True)
                         shutil.copy2(src_path, dst_path)
+                        key = relative_path.replace(os.sep, '/')
+                        if valid_regions is not None and key in valid_regions:
+                            split_regions[split_name][key] = valid_regions[key]
                     except Exception as e:
                         logging.error(f"Error copying file {src_path} to {dst_path}: {e}")
                         error_copying_files_count += 1
@@ -163,6 +175,13 @@ def split_data(input_dir, output_dir, train_ratio, val_ratio, seed):
             skipped_label_dirs_count += 1
             total_files_skipped_insufficient += num_files
 
+    # 有効領域は split ディレクトリからの相対パス ("ラベル/ファイル名") をキーに書き出す
+    if valid_regions is not None:
+        for split_name, split_dir in [("train", train_dir), ("val", val_dir), ("test", test_dir)]:
+            with open(os.path.join(split_dir, "valid_regions.json"), "w", encoding="utf-8") as f:
+                json.dump(split_regions[split_name], f)
+        logging.info(f"Valid regions saved to: {output_dir}/{{train,val,test}}/valid_regions.json")
+
     # --- 最終結果の表示 ---
     # <<< 修正 >>> 統計情報やログメッセージの表現を「カテゴリ/ビューポイント」から「ラベル」へ変更
     print("\n" + "="*30 + " Data Splitting Summary " + "="*30)
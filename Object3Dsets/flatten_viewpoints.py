@@ -1,4 +1,5 @@
 import os
+import json
 import shutil
 import glob
 from tqdm import tqdm
@@ -78,6 +79,14 @@ def merge_viewpoints_to_object_label(input_dir, output_dir):
 
         # <<< 修正 >>> ログメッセージを調整
         logging.info(f"Found {len(label_dirs_with_viewpoint)} source label directories in '{split}'.")
+
+        # 有効領域のキーを "物体_方向/ファイル名" から統合後の "物体/ファイル名" に付け替える
+        valid_file = os.path.join(split_dir_in, "valid_regions.json")
+        valid_regions = None
+        if os.path.isfile(valid_file):
+            with open(valid_file, "r", encoding="utf-8") as f:
+                valid_regions = json.load(f)
+        merged_regions = {}
         processed_source_dirs += len(label_dirs_with_viewpoint)
 
         # <<< 修正 >>> "物体ラベル_方向ラベル" ごとに処理
@@ -133,12 +142,19 @@ def merge_viewpoints_to_object_label(input_dir, output_dir):
 
                     shutil.copy2(src_path, dst_path)
                     files_copied_from_source += 1
+                    key = f"{label_name_with_viewpoint}/{filename}"
+                    if valid_regions is not None and key in valid_regions:
+                        merged_regions[f"{object_label}/{filename}"] = valid_regions[key]
                 except Exception as e:
                     logging.error(f"Error copying file {src_path} to {dst_path}: {e}")
                     total_errors_copying += 1
 
             total_files_copied += files_copied_from_source
 
+        if valid_regions is not None:
+            with open(os.path.join(split_dir_out, "valid_regions.json"), "w", encoding="utf-8") as f:
+                json.dump(merged_regions, f)
+
     # --- 最終結果の表示 ---
     print("\n" + "="*30 + " Merging Summary " + "="*30)
     logging.info(f"Viewpoint merging process complete.")
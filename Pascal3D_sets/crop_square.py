@@ -3,6 +3,7 @@
 
 import os
 import argparse
+import json
 import re
 import cv2
 import numpy as np
@@ -59,19 +60,22 @@ def dump_mat_contents_to_file(mat_path, outfile):
         outfile.write(f"Unexpected error loading or parsing {mat_path}: {e}\n")
     outfile.write("=" * (len(mat_path) + 20) + "\n\n")
 
-def crop_image_square_by_bbox(image, bbox):
+def crop_image_square_by_bbox(image, bbox, return_valid=False):
     """
     画像を指定されたBBoxに基づき、中央揃えの正方形にクロップし、不足分を黒でパディングする。
+    return_valid=True の場合は (クロップ画像, 有効領域) を返す。有効領域はパディングを除いた
+    画像部分の矩形 [left, top, right, bottom] を出力画像の辺の長さに対する割合 (0〜1) で表したもの。
     """
+    full = [0.0, 0.0, 1.0, 1.0] # クロップしない場合は全体が有効
     if bbox is None or len(bbox) != 4:
         print(f"Warning: Invalid bbox received: {bbox}. Skipping crop.")
-        return image
+        return (image, full) if return_valid else image
 
     try:
         xmin, ymin, xmax, ymax = map(int, bbox)
         if xmin >= xmax or ymin >= ymax:
             print(f"Warning: Invalid bbox values (min >= max): {bbox}. Skipping crop.")
-            return image
+            return (image, full) if return_valid else image
 
         width = xmax - xmin
         height = ymax - ymin
@@ -106,7 +110,7 @@ def crop_image_square_by_bbox(image, bbox):
 
         if actual_crop_width <= 0 or actual_crop_height <= 0:
              print(f"Warning: Zero area crop region calculated for bbox {bbox} on image size {w}x{h}. Skipping crop.")
-             return image
+             return (image, full) if return_valid else image
 
         # 画像から切り取り
         cropped = image[crop_top:crop_bottom, crop_left:crop_right]
@@ -135,10 +139,15 @@ def crop_image_square_by_bbox(image, bbox):
         # if final_h != side or final_w != side:
         #     print(f"Warning: Final size {final_w}x{final_h} != target {side}x{side} for bbox {bbox}")
 
+        if return_valid:
+            # パディングを除いた有効領域 (出力画像の辺に対する割合)
+            valid = [round(pad_left / side, 6), round(pad_top / side, 6),
+                     round((pad_left + actual_crop_width) / side, 6), round((pad_top + actual_crop_height) / side, 6)]
+            return cropped, valid
         return cropped
     except Exception as e:
         print(f"Error during cropping image with bbox {bbox}: {e}")
-        return image # エラー時は元の画像を返す
+        return (image, full) if return_valid else image # エラー時は元の画像を返す
 
 def get_bbox_from_mat(mat_path, target_class):
     """指定されたクラスに一致する最初のオブジェクトのBboxを取得"""
@@ -276,6 +285,10 @@ def main():
 
     print(f"Found {len(label_dirs)} label directories in '{src_dir}'. Starting cropping...")
 
+    # 画像ごとの有効領域 (パディングを除いた部分) を "ラベル/ファイル名" をキーに記録
+    valid_regions = {}
+    valid_file = os.path.join(out_dir, "valid_regions.json")
+
     processed_count = 0
     skipped_count = 0
     error_count = 0
@@ -332,11 +345,12 @@ def main():
                 if img is None: raise ValueError(f"Failed to load image file: {src_img_path}")
 
                 # クロップ処理
-                cropped = crop_image_square_by_bbox(img, bbox)
+                cropped, valid = crop_image_square_by_bbox(img, bbox, return_valid=True)
 
                 # クロップ結果を保存
                 success = cv2.imwrite(dst_img_path, cropped, [cv2.IMWRITE_JPEG_QUALITY, 95]) # 品質指定(任意)
                 if not success: raise IOError(f"Failed to save cropped image to: {dst_img_path}")
+                valid_regions[f"{label_name}/{img_file}"] = valid
                 processed_count += 1
 
             except (FileNotFoundError, ValueError, IOError, OSError, Exception) as e:
@@ -362,6 +376,13 @@ def main():
                 skipped_count += 1
                 error_count += 1 # エラーとしてカウント
 
+    # 有効領域をサイドカー JSON に保存 (評価時のノードマスク用)
+    try:
+        with open(valid_file, "w", encoding='utf-8') as vf:
+            json.dump(valid_regions, vf)
+    except IOError as e:
+        print(f"Error: Could not write valid region file '{valid_file}': {e}")
+
     # --- 完了メッセージ ---
     print("\n" + "="*30 + " Cropping Summary " + "="*30)
     print(f"Cropping process finished.")
@@ -370,6 +391,7 @@ def main():
     print(f"  (Including {error_count} files with specific errors during processing)")
     print(f"Details for skipped files saved to: {skip_file}")
     print(f"Source image counts per label directory saved to: {debug_file}")
+    print(f"Valid (unpadded) regions per image saved to: {valid_file}")
     print(f"Cropped images saved under: {out_dir}")
     print("="*80)
 
@@ -3,6 +3,7 @@
 
 import os
 import argparse
+import json
 import random
 import math
 import shutil
@@ -60,6 +61,14 @@ def main():
 
     print(f"Found {len(label_dirs)} label directories. Starting split...")
 
+    # クロップ時の有効領域 (valid_regions.json, キーは "ラベル/ファイル名") を split ごとに振り分ける
+    valid_file = os.path.join(src_dir, "valid_regions.json")
+    valid_regions = None
+    if os.path.isfile(valid_file):
+        with open(valid_file, "r", encoding="utf-8") as vf:
+            valid_regions = json.load(vf)
+    split_regions = {"train": {}, "val": {}, "test": {}}
+
     # <<< 修正 >>> 単一ループで処理
     for label_name in tqdm(label_dirs, desc="Processing labels"):
         source_label_dir = os.path.join(src_dir, label_name)
@@ -106,7 +115,7 @@ def main():
             continue
 
         # コピー処理を関数化してDRYに
-        def copy_files(file_list, src_dir, dst_dir):
+        def copy_files(file_list, src_dir, dst_dir, regions):
             copied_count = 0
             for f in file_list:
                 src_path = os.path.join(src_dir, f)
@@ -114,13 +123,16 @@ def main():
                 try:
                     shutil.copy2(src_path, dst_path)
                     copied_count += 1
+                    key = f"{label_name}/{f}"
+                    if valid_regions is not None and key in valid_regions:
+                        regions[key] = valid_regions[key]
                 except Exception as e:
                     print(f"Error copying {src_path} to {dst_path}: {e}")
             return copied_count
 
-        copied_train = copy_files(train_list, source_label_dir, train_subdir)
-        copied_val = copy_files(val_list, source_label_dir, val_subdir)
-        copied_test = copy_files(test_list, source_label_dir, test_subdir)
+        copied_train = copy_files(train_list, source_label_dir, train_subdir, split_regions["train"])
+        copied_val = copy_files(val_list, source_label_dir, val_subdir, split_regions["val"])
+        copied_test = copy_files(test_list, source_label_dir, test_subdir, split_regions["test"])
 
         # 簡易ログ出力 (コピー数ベースに変更)
         # print(f"[{label_name}] total={total} => copied: train={copied_train}, val={copied_val}, test={copied_test}")
@@ -147,6 +159,13 @@ def main():
         object_counts["test"][object_label]  += copied_test
 
 
+    # 有効領域は split ディレクトリからの相対パス ("ラベル/ファイル名") をキーに書き出す
+    if valid_regions is not None:
+        for split_name, regions in split_regions.items():
+            with open(os.path.join(out_dir, split_name, "valid_regions.json"), "w", encoding="utf-8") as vf:
+                json.dump(regions, vf)
+        print(f"Valid regions saved to: {out_dir}/{{train,val,test}}/valid_regions.json")
+
     # <<< 修正 >>> 最後に集計結果を txt に書き出す
     out_txt = os.path.join(out_dir, "dataset_counts.txt")
     print(f"\nWriting summary to {out_txt}...")
@@ -3,6 +3,7 @@
 
 import os
 import argparse
+import json
 import shutil
 from tqdm import tqdm # tqdmを追加
 
@@ -45,6 +46,14 @@ def merge_labels_to_object(src_dir, out_dir):
             print(f"Warning: Error listing label directories in '{split_path}': {e}. Skipping this split.")
             continue
 
+        # 有効領域のキーを "物体_方向/ファイル名" から統合後の "物体/ファイル名" に付け替える
+        valid_file = os.path.join(split_path, "valid_regions.json")
+        valid_regions = None
+        if os.path.isfile(valid_file):
+            with open(valid_file, "r", encoding="utf-8") as vf:
+                valid_regions = json.load(vf)
+        merged_regions = {}
+
         if not label_dirs:
             # print(f"Info: No label directories found in '{split_path}'.")
             continue
@@ -87,10 +96,17 @@ def merge_labels_to_object(src_dir, out_dir):
                         # copy2 を使う (メタデータ保持)
                         shutil.copy2(src_img_path, dst_img_path)
                         copied_files_count += 1
+                        key = f"{label_name}/{img_file}"
+                        if valid_regions is not None and key in valid_regions:
+                            merged_regions[f"{object_label}/{img_file}"] = valid_regions[key]
                 except Exception as e:
                      print(f"Error copying {src_img_path} to {dst_img_path}: {e}")
                      error_count += 1
 
+        if valid_regions is not None:
+            with open(os.path.join(out_split_dir, "valid_regions.json"), "w", encoding="utf-8") as vf:
+                json.dump(merged_regions, vf)
+
     print("\n--- Merging Summary ---")
     print(f"Successfully copied files: {copied_files_count}")
     print(f"Files skipped due to filename collision: {skipped_collision_count}")
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+""" Micro-benchmarks for the ViG graph layers
+
+Each sub-command times a gcn_lib building block against its reference implementation
+and prints a small report (latency, peak memory). The agreement of every variant with its
+reference is asserted by the tests in tests/.
+
+    python benchmark.py knn --batch-size 32 --channels 48 --size 56 --reduce 4
+    python benchmark.py knn --model pvig_ti_224_gelu --checkpoint ckpt.pth.tar --data /path/to/val --block 0
+    python benchmark.py reuse --model vig_ti_224_gelu --checkpoint ckpt.pth.tar --data /path/to/val
+    python benchmark.py window --sizes 28 56 80 112 --reduce 4
+    python benchmark.py mrconv --batch-size 64 --channels 640 --size 14 -k 18 --device cuda
+    python benchmark.py interleave --models vig_ti_224_gelu vig_b_224_gelu --device cuda
+    python benchmark.py gconv --nodes 196 784 3136 --ks 9 18 --channel-sizes 48 192
+    python benchmark.py deploy --models vig_ti_224_gelu pvig_ti_224_gelu --batch-size 1
+    python benchmark.py descent --models vig_ti_224_gelu pvig_ti_224_gelu --data /path/to/val
+    python benchmark.py prune --model vig_ti_224_gelu --schedules none 4,8,12:0.7 2,4,6,8:0.8
+    python benchmark.py checkpoint --models vig_b_224_gelu pvig_s_224_gelu -b 128 --device cuda
+    python benchmark.py compile --models vig_ti_224_gelu vig_s_224_gelu vig_b_224_gelu -b 8
+"""
+import argparse
+import logging
+import time
+
+import torch
+import torch.nn.functional as F
+
+from timm.models import create_model
+
+from gcn_lib import DenseDilatedKnnGraph, GraphConv2d, MRConv2d, compile_model, optimize_for_inference, \
+    profile_model
+import pyramid_vig
+import vig
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def measure(fn, device, repeat=10, warmup=2):
+    """Returns (mean latency in ms, peak allocated MB or None on CPU, last output)."""
+    for _ in range(warmup):
+        out = fn()
+    _sync(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    _sync(device)
+    latency = (time.perf_counter() - start) / repeat * 1000
+    peak = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else None
+    return latency, peak, out
+
+
+def _fmt_mem(peak):
+    return 'n/a' if peak is None else '{:.1f}'.format(peak)
+
+
+def _node_features(args, device):
+    x = torch.randn(args.batch_size, args.channels, args.size * args.size, 1, device=device)
+    y = None
+    if args.reduce > 1:
+        size = args.size // args.reduce
+        y = F.avg_pool2d(x.reshape(args.batch_size, args.channels, args.size, args.size), args.reduce)
+        y = y.reshape(args.batch_size, args.channels, size * size, 1)
+    return x, y, None, (args.size, args.size)
+
+
+def _load_model(args, device, **kwargs):
+    model = create_model(args.model, num_classes=args.num_classes, **kwargs)
+    if args.checkpoint:
+        state_dict = torch.load(args.checkpoint, map_location='cpu')
+        if 'state_dict' in state_dict:
+            state_dict = state_dict['state_dict']
+        model.load_state_dict(state_dict, strict=False)
+    return model.to(device).eval()
+
+
+def _images(args, device):
+    if args.data:
+        from torchvision import datasets, transforms
+        transform = transforms.Compose([
+            transforms.Resize((args.img_size, args.img_size)),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5))])
+        loader = torch.utils.data.DataLoader(datasets.ImageFolder(args.data, transform),
+                                             batch_size=args.batch_size, shuffle=True)
+        images, _ = next(iter(loader))
+        return images.to(device)
+    return torch.randn(args.batch_size, 3, args.img_size, args.img_size, device=device)
+
+
+def _captured_features(args, device):
+    """Inputs (x, y, relative_pos, hw) of the KNN of block args.block of a real model."""
+    model = _load_model(args, device)
+    graphs = [m for m in model.modules() if isinstance(m, DenseDilatedKnnGraph)]
+    captured = {}
+
+    def hook(module, inputs):
+        captured['inputs'] = inputs
+    handle = graphs[args.block].register_forward_pre_hook(hook)
+    with torch.no_grad():
+        model(_images(args, device))
+    handle.remove()
+    # the graph also gets node_masks, which are None without a padding mask
+    x, y, relative_pos, hw = captured['inputs'][:4]
+    return x, y, relative_pos, hw
+
+
+def _parse_backend(spec):
+    """'lsh:n_hashes=4,bucket_size=32' -> ('lsh', {'n_hashes': 4, 'bucket_size': 32})"""
+    name, _, options = spec.partition(':')
+    knn_args = {}
+    for option in filter(None, options.split(',')):
+        key, value = option.split('=')
+        knn_args[key] = None if value == 'None' else int(value)
+    return name, knn_args
+
+
+def bench_knn(args):
+    device = torch.device(args.device)
+    if args.model:
+        x, y, relative_pos, hw = _captured_features(args, device)
+    else:
+        x, y, relative_pos, hw = _node_features(args, device)
+    reference = DenseDilatedKnnGraph(args.k, knn='exact', tile_size=None)
+    ref_latency, ref_peak, _ = measure(lambda: reference(x, y, relative_pos, hw), device, args.repeat)
+    print('nodes={} keys={} k={} channels={} batch={}'.format(
+        x.shape[2], x.shape[2] if y is None else y.shape[2], args.k, x.shape[1], x.shape[0]))
+    print('{:<32}{:>12}{:>14}{:>10}'.format('backend', 'latency(ms)', 'peak mem(MB)', 'speedup'))
+    print('{:<32}{:>12.2f}{:>14}{:>10}'.format('exact:tile_size=None', ref_latency, _fmt_mem(ref_peak), '-'))
+    for spec in args.backends:
+        name, knn_args = _parse_backend(spec)
+        graph = DenseDilatedKnnGraph(args.k, knn=name, **knn_args)
+        latency, peak, _ = measure(lambda: graph(x, y, relative_pos, hw), device, args.repeat)
+        print('{:<32}{:>12.2f}{:>14}{:>10.2f}'.format(spec, latency, _fmt_mem(peak), ref_latency / latency))
+
+
+def bench_reuse(args):
+    device = torch.device(args.device)
+    images = _images(args, device)
+    print('{:<10}{:>12}{:>10}'.format('interval', 'latency(ms)', 'speedup'))
+    ref_latency = None
+    for interval in args.intervals:
+        model = _load_model(args, device, graph_reuse=interval)
+        with torch.no_grad():
+            latency, _, _ = measure(lambda: model(images), device, args.repeat)
+        ref_latency = ref_latency or latency
+        print('{:<10}{:>12.2f}{:>10.2f}'.format(interval, latency, ref_latency / latency))
+
+
+def bench_window(args):
+    device = torch.device(args.device)
+    print('{:<8}{:>8}{:>8}{:>14}{:>14}{:>10}'.format(
+        'size', 'nodes', 'keys', 'exact(ms)', 'window(ms)', 'speedup'))
+    exact = DenseDilatedKnnGraph(args.k, knn='exact')
+    window = DenseDilatedKnnGraph(args.k, knn='window', window=args.window, n_global=args.n_global)
+    for size in args.sizes:
+        # spatially smooth features, like the ones of a real feature map
+        x = torch.randn(args.batch_size, args.channels, max(1, size // 4), max(1, size // 4), device=device)
+        x = F.interpolate(x, size=(size, size), mode='bilinear', align_corners=False)
+        x = x + 0.1 * torch.randn_like(x)
+        y = None
+        if args.reduce > 1:
+            y = F.avg_pool2d(x, args.reduce, args.reduce).reshape(args.batch_size, args.channels, -1, 1)
+        x = x.reshape(args.batch_size, args.channels, -1, 1)
+        ref_latency, _, _ = measure(lambda: exact(x, y, None, (size, size)), device, args.repeat)
+        latency, _, _ = measure(lambda: window(x, y, None, (size, size)), device, args.repeat)
+        print('{:<8}{:>8}{:>8}{:>14.2f}{:>14.2f}{:>10.2f}'.format(
+            size, x.shape[2], x.shape[2] if y is None else y.shape[2], ref_latency, latency,
+            ref_latency / latency))
+
+
+def bench_descent(args):
+    device = torch.device(args.device)
+    images = _images(args, device)
+    print('{:<20}{:>14}{:>16}{:>10}'.format('model', 'exact(ms)', 'nndescent(ms)', 'speedup'))
+    for name in args.models:
+        args.model = name
+        torch.manual_seed(0)
+        exact = _load_model(args, device, knn='exact')
+        torch.manual_seed(0)
+        descent = _load_model(args, device, knn='nndescent',
+                              knn_args={'n_rounds': args.n_rounds, 'n_sample': args.n_sample})
+        with torch.no_grad():
+            ref_latency, _, _ = measure(lambda: exact(images), device, args.repeat)
+            latency, _, _ = measure(lambda: descent(images), device, args.repeat)
+        print('{:<20}{:>14.2f}{:>16.2f}{:>10.2f}'.format(name, ref_latency, latency, ref_latency / latency))
+
+
+def bench_mrconv(args):
+    device = torch.device(args.device)
+    x, y, relative_pos, _ = _node_features(args, device)
+    edge_index = DenseDilatedKnnGraph(args.k)(x, y, relative_pos)
+    reference = MRConv2d(args.channels, args.channels * 2, 'gelu', 'batch').to(device)
+    chunked = MRConv2d(args.channels, args.channels * 2, 'gelu', 'batch', chunk_budget=args.chunk_budget).to(device)
+    chunked.load_state_dict(reference.state_dict())
+    grad = torch.randn(args.batch_size, args.channels * 2, x.shape[2], 1, device=device)
+
+    def step(module):
+        module.zero_grad()
+        inputs = [t.detach().requires_grad_() for t in (x, y) if t is not None]
+        out = module(inputs[0], edge_index, inputs[1] if len(inputs) > 1 else None)
+        out.backward(grad)
+        return out
+    print('nodes={} keys={} k={} channels={} batch={} chunk_budget={}MB'.format(
+        x.shape[2], x.shape[2] if y is None else y.shape[2], args.k, args.channels, args.batch_size,
+        args.chunk_budget))
+    print('{:<12}{:>20}{:>14}'.format('module', 'fwd+bwd latency(ms)', 'peak mem(MB)'))
+    for name, module in (('reference', reference), ('chunked', chunked)):
+        latency, peak, _ = measure(lambda: step(module), device, args.repeat)
+        print('{:<12}{:>20.2f}{:>14}'.format(name, latency, _fmt_mem(peak)))
+
+
+def bench_interleave(args):
+    device = torch.device(args.device)
+    images = _images(args, device)
+    print('{:<20}{:>6}{:>12}{:>14}{:>12}{:>14}'.format(
+        'model', 'block', 'cat(ms)', 'cat mem(MB)', 'split(ms)', 'split mem(MB)'))
+    for name in args.models:
+        args.model = name
+        model = _load_model(args, device)
+        convs = [m for m in model.modules() if isinstance(m, MRConv2d)]
+        captured = []
+        handles = [m.register_forward_pre_hook(lambda module, inputs: captured.append(inputs)) for m in convs]
+        with torch.no_grad():
+            model(images)
+        for handle in handles:
+            handle.remove()
+        for i, (conv, inputs) in enumerate(zip(convs, captured)):
+            x = inputs[0].detach().requires_grad_()
+
+            def step():
+                out = conv(x, *inputs[1:])
+                out.backward(torch.ones_like(out))
+            conv.copy_free = False
+            ref_latency, ref_peak, _ = measure(step, device, args.repeat)
+            conv.copy_free = True
+            latency, peak, _ = measure(step, device, args.repeat)
+            print('{:<20}{:>6}{:>12.2f}{:>14}{:>12.2f}{:>14}'.format(
+                name, i, ref_latency, _fmt_mem(ref_peak), latency, _fmt_mem(peak)))
+
+
+def bench_gconv(args):
+    device = torch.device(args.device)
+    # the gather-free variant of every conv
+    variants = {'gin': 'gin_csr', 'sage': 'sage_chunked'}
+    print('{:<6}{:>8}{:>4}{:>6}{:>14}{:>14}{:>10}'.format(
+        'conv', 'nodes', 'k', 'C', 'dense(ms)', 'variant(ms)', 'speedup'))
+    for conv in args.convs:
+        for n_points in args.nodes:
+            for k in args.ks:
+                for channels in args.channel_sizes:
+                    x = torch.randn(args.batch_size, channels, n_points, 1, device=device)
+                    edge_index = DenseDilatedKnnGraph(k)(x)
+                    dense = GraphConv2d(channels, channels * 2, conv, 'gelu', 'batch').to(device).eval()
+                    csr = GraphConv2d(channels, channels * 2, variants[conv], 'gelu', 'batch').to(device).eval()
+                    with torch.no_grad():
+                        ref_latency, _, _ = measure(lambda: dense(x, edge_index), device, args.repeat)
+                        latency, _, _ = measure(lambda: csr(x, edge_index), device, args.repeat)
+                    print('{:<6}{:>8}{:>4}{:>6}{:>14.2f}{:>14.2f}{:>10.2f}'.format(
+                        conv, n_points, k, channels, ref_latency, latency, ref_latency / latency))
+
+
+def bench_deploy(args):
+    device = torch.device(args.device)
+    images = _images(args, device)
+    print('{:<20}{:>12}{:>16}{:>10}'.format('model', 'eager(ms)', 'optimized(ms)', 'speedup'))
+    for name in args.models:
+        args.model = name
+        model = _load_model(args, device)
+        optimized = optimize_for_inference(model)
+        with torch.no_grad():
+            ref_latency, _, _ = measure(lambda: model(images), device, args.repeat)
+            latency, _, _ = measure(lambda: optimized(images), device, args.repeat)
+        print('{:<20}{:>12.2f}{:>16.2f}{:>10.2f}'.format(name, ref_latency, latency, ref_latency / latency))
+
+
+def _parse_schedule(spec):
+    """'4,8,12:0.7' -> {'prune_blocks': [4, 8, 12], 'prune_keep': 0.7}, 'none' -> {}"""
+    if spec == 'none':
+        return {}
+    blocks, _, keep = spec.partition(':')
+    return {'prune_blocks': [int(b) for b in blocks.split(',')], 'prune_keep': float(keep or 0.7)}
+
+
+def bench_prune(args):
+    device = torch.device(args.device)
+    images = _images(args, device)
+    print('{:<18}{:>8}{:>10}{:>14}{:>10}  {}'.format(
+        'schedule', 'score', 'GMACs', 'latency(ms)', 'speedup', 'nodes per block'))
+    ref_latency = None
+    for spec in args.schedules:
+        model = _load_model(args, device, prune_score=args.prune_score, **_parse_schedule(spec))
+        nodes = []
+        handles = [block.register_forward_pre_hook(lambda module, inputs: nodes.append(inputs[0][0, 0].numel()))
+                   for block in model.backbone]
+        with torch.no_grad():
+            model(images[:1])
+        for handle in handles:
+            handle.remove()
+        report = profile_model(model, [1] + list(images.shape[1:]))
+        macs = (report['macs'] + report['knn_macs']) / 1e9
+        with torch.no_grad():
+            latency, _, _ = measure(lambda: model(images), device, args.repeat)
+        ref_latency = ref_latency or latency
+        print('{:<18}{:>8}{:>10.3f}{:>14.2f}{:>10.2f}  {}'.format(
+            spec, args.prune_score, macs, latency, ref_latency / latency, ' '.join(str(n) for n in nodes)))
+
+
+def _parse_blocks(spec, n_blocks):
+    """'none' -> None, 'all' -> every block, 'even' -> every other block, '0,2,5' -> these blocks"""
+    if spec == 'none':
+        return None
+    if spec == 'all':
+        return list(range(n_blocks))
+    if spec == 'even':
+        return list(range(0, n_blocks, 2))
+    return [int(b) for b in spec.split(',')]
+
+
+def bench_checkpoint(args):
+    device = torch.device(args.device)
+    images = _images(args, device)
+    target = torch.randint(0, args.num_classes, (images.shape[0],), device=device)
+    print('{:<20}{:>8}{:>20}{:>12}{:>14}'.format('model', 'blocks', 'fwd+bwd latency(ms)', 'img/s', 'peak mem(MB)'))
+    for name in args.models:
+        args.model = name
+        torch.manual_seed(0)
+        model = _load_model(args, device).train()
+
+        def step():
+            model.zero_grad()
+            F.cross_entropy(model(images), target).backward()
+        for spec in args.settings:
+            blocks = _parse_blocks(spec, len(model.backbone))
+            model.set_grad_checkpointing(blocks is not None, blocks)
+            latency, peak, _ = measure(step, device, args.repeat)
+            print('{:<20}{:>8}{:>20.2f}{:>12.1f}{:>14}'.format(
+                name, spec, latency, images.shape[0] / latency * 1000, _fmt_mem(peak)))
+
+
+def bench_compile(args):
+    device = torch.device(args.device)
+    images = _images(args, device)
+    print('{:<20}{:>12}{:>14}{:>16}{:>10}{:>12}'.format(
+        'model', 'eager(ms)', 'compile(s)', 'compiled(ms)', 'speedup', 'img/s'))
+    for name in args.models:
+        args.model = name
+        model = _load_model(args, device)
+        with torch.no_grad():
+            latency, _, _ = measure(lambda: model(images), device, args.repeat)
+            compile_model(model, args.compile_mode)
+            start = time.perf_counter()
+            model(images)
+            _sync(device)
+            compile_time = time.perf_counter() - start
+            compiled, _, _ = measure(lambda: model(images), device, args.repeat)
+        print('{:<20}{:>12.2f}{:>14.1f}{:>16.2f}{:>10.2f}{:>12.1f}'.format(
+            name, latency, compile_time, compiled, latency / compiled, images.shape[0] / compiled * 1000))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='ViG graph layer benchmarks')
+    subparsers = parser.add_subparsers(dest='mode')
+    subparsers.required = True
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--device', default='cpu', type=str)
+    common.add_argument('--repeat', default=10, type=int)
+    common.add_argument('-b', '--batch-size', default=8, type=int)
+    common.add_argument('--channels', default=48, type=int)
+    common.add_argument('--size', default=56, type=int, help='side of the node grid')
+    common.add_argument('--reduce', default=1, type=int, help='key grid reduce ratio r')
+    common.add_argument('-k', default=9, type=int, help='neighbors (k * dilation)')
+
+    model = argparse.ArgumentParser(add_help=False)
+    model.add_argument('--model', default='', type=str, help='take real features from this model')
+    model.add_argument('--checkpoint', default='', type=str)
+    model.add_argument('--num-classes', default=1000, type=int)
+    model.add_argument('--data', default='', type=str, help='image folder (default: random images)')
+    model.add_argument('--img-size', default=224, type=int)
+    model.add_argument('--block', default=0, type=int, help='Grapher block whose KNN inputs are used')
+
+    knn = subparsers.add_parser('knn', parents=[common, model], help='KNN backends vs the full-matrix KNN')
+    knn.add_argument('--backends', default=['exact:tile_size=1024', 'cosine', 'cosine:low_precision=1',
+                                            'lsh', 'lsh:n_hashes=4,bucket_size=32'],
+                     nargs='+', help='backend[:option=value,...]')
+    knn.set_defaults(func=bench_knn)
+
+    reuse = subparsers.add_parser('reuse', parents=[common, model], help='KNN graph reuse across blocks')
+    reuse.add_argument('--intervals', default=[1, 2, 3, 4], type=int, nargs='+')
+    reuse.set_defaults(func=bench_reuse, model='vig_ti_224_gelu')
+
+    window = subparsers.add_parser('window', parents=[common], help='windowed KNN vs resolution')
+    window.add_argument('--sizes', default=[14, 28, 56, 80, 112], type=int, nargs='+', help='node grid sides')
+    window.add_argument('--window', default=7, type=int)
+    window.add_argument('--n-global', default=16, type=int)
+    window.set_defaults(func=bench_window)
+    mrconv = subparsers.add_parser('mrconv', parents=[common],
+                                   help='latency and memory of the chunked MRConv aggregation')
+    mrconv.add_argument('--chunk-budget', default=64, type=float, help='MB of gathers per vertex chunk')
+    mrconv.set_defaults(func=bench_mrconv)
+
+    interleave = subparsers.add_parser('interleave', parents=[common, model],
+                                       help='per-block MRConv with and without the interleaved copy')
+    interleave.add_argument('--models', default=['vig_ti_224_gelu', 'vig_b_224_gelu'], type=str, nargs='+')
+    interleave.set_defaults(func=bench_interleave)
+
+    gconv = subparsers.add_parser('gconv', parents=[common], help='gather-free vs gather aggregation of gin and sage')
+    gconv.add_argument('--convs', default=['gin', 'sage'], type=str, nargs='+')
+    gconv.add_argument('--nodes', default=[196, 784, 3136], type=int, nargs='+')
+    gconv.add_argument('--ks', default=[9, 18], type=int, nargs='+')
+    gconv.add_argument('--channel-sizes', default=[48, 192, 384], type=int, nargs='+')
+    gconv.set_defaults(func=bench_gconv)
+
+    deploy = subparsers.add_parser('deploy', parents=[common, model],
+                                   help='latency before and after optimize_for_inference')
+    deploy.add_argument('--models', default=['vig_ti_224_gelu', 'pvig_ti_224_gelu'], type=str, nargs='+')
+    deploy.set_defaults(func=bench_deploy)
+
+    descent = subparsers.add_parser('descent', parents=[common, model],
+                                    help='NN-descent KNN seeded from the previous block vs exact KNN')
+    descent.add_argument('--models', default=['vig_ti_224_gelu', 'pvig_ti_224_gelu'], type=str, nargs='+')
+    descent.add_argument('--n-rounds', default=2, type=int)
+    descent.add_argument('--n-sample', default=8, type=int)
+    descent.set_defaults(func=bench_descent)
+
+    prune = subparsers.add_parser('prune', parents=[common, model],
+                                  help='MACs and latency of node-pruning schedules of vig models')
+    prune.add_argument('--schedules', default=['none', '4,8,12:0.7', '2,4,6,8:0.8'], type=str, nargs='+',
+                       help='blocks:keep ratio, or none')
+    prune.add_argument('--prune-score', default='norm', type=str, help='norm or pool')
+    prune.set_defaults(func=bench_prune, model='vig_ti_224_gelu')
+
+    ckpt = subparsers.add_parser('checkpoint', parents=[common, model],
+                                 help='training step memory and throughput with activation checkpointing')
+    ckpt.add_argument('--models', default=['vig_ti_224_gelu', 'pvig_ti_224_gelu'], type=str, nargs='+')
+    ckpt.add_argument('--settings', default=['none', 'even', 'all'], type=str, nargs='+',
+                      help='none, all, even or comma-separated backbone indices')
+    ckpt.set_defaults(func=bench_checkpoint)
+
+    comp = subparsers.add_parser('compile', parents=[common, model], help='eager vs torch.compile inference')
+    comp.add_argument('--models', default=['vig_ti_224_gelu', 'vig_s_224_gelu', 'vig_b_224_gelu',
+                                           'pvig_ti_224_gelu', 'pvig_s_224_gelu'], type=str, nargs='+')
+    comp.add_argument('--compile-mode', default=None, type=str)
+    comp.set_defaults(func=bench_compile)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    torch.manual_seed(0)
+    args.func(args)
@@ -8,6 +8,9 @@ https://github.com/NVIDIA/apex/commit/d5e2bb4bdeedd27b1dfaf5bb2b24d6c000dee9be#d
 Hacked together by / Copyright 2020 Ross Wightman
 """
 
+import random
+from collections import deque
+
 import torch.utils.data
 import torch.distributed as dist
 import numpy as np
@@ -42,6 +45,84 @@ def get_rank():
     return dist.get_rank()
 
 
+def aug_seed(seed, epoch, index, repeat=0, salt=0):
+    """Augmentation seed of a sample, depending only on the run seed, the epoch and the sample."""
+    return int(np.random.SeedSequence([seed, epoch, index, repeat, salt]).generate_state(1)[0] >> 1)
+
+
+class AugSeedSampler(torch.utils.data.Sampler):
+    """
+    Yields the (index, augmentation seed) pairs of the samples of sampler, truncated to full batches.
+    The pairs are also queued in order, so the training loop pops the keys of every batch it
+    receives, however far the loader workers run ahead.
+    """
+
+    def __init__(self, sampler, batch_size, seed=0, salt=0):
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.seed = seed
+        # tells apart the repeated augmentations sent to different ranks
+        self.salt = salt
+        self.epoch = 0
+        self.keys = deque()
+
+    def __iter__(self):
+        repeats = {}
+        for i, index in enumerate(self.sampler):
+            if i >= len(self):
+                break
+            repeat = repeats.get(index, 0)
+            repeats[index] = repeat + 1
+            key = (index, aug_seed(self.seed, self.epoch, index, repeat, self.salt))
+            self.keys.append(key)
+            yield key
+
+    def __len__(self):
+        return len(self.sampler) // self.batch_size * self.batch_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def pop_keys(self, n):
+        return [self.keys.popleft() for _ in range(n)]
+
+
+class AugSeedDataset(torch.utils.data.Dataset):
+    """
+    Loads the (index, augmentation seed) keys of AugSeedSampler with the random, numpy and torch
+    generators seeded by the augmentation seed, restoring their states afterwards.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    @property
+    def transform(self):
+        return self.dataset.transform
+
+    @transform.setter
+    def transform(self, transform):
+        self.dataset.transform = transform
+
+    def __getitem__(self, key):
+        index, seed = key
+        states = random.getstate(), np.random.get_state(), torch.get_rng_state()
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.default_generator.manual_seed(seed)
+        try:
+            return self.dataset[index]
+        finally:
+            random.setstate(states[0])
+            np.random.set_state(states[1])
+            torch.set_rng_state(states[2])
+
+    def __len__(self):
+        return len(self.dataset)
+
+
 def create_loader(
         dataset,
         input_size,
@@ -71,7 +152,8 @@ def create_loader(
         fp16=False,
         tf_preprocessing=False,
         use_multi_epochs_loader=False,
-        repeated_aug=False
+        repeated_aug=False,
+        seed=None
 ):
     re_num_splits = 0
     if re_split:
@@ -125,6 +207,14 @@ def create_loader(
                     dataset, num_replicas=num_tasks, rank=global_rank, shuffle=True
                 )
 
+    if seed is not None:
+        # every sample is augmented from its own seed, see AugSeedSampler
+        if sampler is None:
+            sampler = torch.utils.data.RandomSampler(dataset) if is_training else \
+                torch.utils.data.SequentialSampler(dataset)
+        sampler = AugSeedSampler(sampler, batch_size, seed, get_rank() if repeated_aug else 0)
+        dataset = AugSeedDataset(dataset)
+
     if collate_fn is None:
         collate_fn = fast_collate if use_prefetcher else torch.utils.data.dataloader.default_collate
 
@@ -3,4 +3,5 @@
 from .torch_nn import *
 from .torch_edge import *
 from .torch_vertex import *
-
+from .torch_deploy import *
+from .torch_profile import *
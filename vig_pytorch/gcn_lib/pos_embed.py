@@ -13,6 +13,7 @@
 import numpy as np
 
 import torch
+import torch.nn.functional as F
 
 # --------------------------------------------------------
 # relative position embedding
@@ -29,6 +30,44 @@ def get_2d_relative_pos_embed(embed_dim, grid_size):
     return relative_pos
 
 
+def get_2d_relative_pos_embed_torch(embed_dim, grid_size, device=None):
+    """
+    torch version of get_2d_relative_pos_embed, computed in float64 on device
+    grid_size: int of the grid height and width
+    return:
+    pos_embed: [grid_size*grid_size, grid_size*grid_size]
+    """
+    assert embed_dim % 4 == 0
+    omega = torch.arange(embed_dim // 4, dtype=torch.float64, device=device)
+    omega = 1. / 10000**(omega / (embed_dim / 4.))  # (D/4,)
+    coords = torch.arange(grid_size, dtype=torch.float64, device=device)
+
+    def embed_1d(pos):
+        out = pos[:, None] * omega[None, :]
+        return torch.cat([torch.sin(out), torch.cos(out)], dim=1)
+    # the first half encodes the w coordinate, as in get_2d_sincos_pos_embed
+    pos_embed = torch.cat([embed_1d(coords.repeat(grid_size)),
+                           embed_1d(coords.repeat_interleave(grid_size))], dim=1)
+    return 2 * torch.matmul(pos_embed, pos_embed.t()) / pos_embed.shape[1]
+
+
+def get_relative_pos_table(embed_dim, n, r=1, hw=None, device=None, dtype=torch.float32):
+    """
+    relative position bias of a Grapher with n nodes and an r x r pooled key grid
+    hw: (height, width) of the actual node grid (n nodes if None)
+    return:
+    relative_pos: [1, height*width, (height//r)*(width//r)]
+    """
+    relative_pos = get_2d_relative_pos_embed_torch(embed_dim, int(n**0.5), device)
+    relative_pos = relative_pos.float().unsqueeze(0).unsqueeze(1)
+    relative_pos = -F.interpolate(relative_pos, size=(n, n//(r*r)), mode='bicubic', align_corners=False)
+    if hw is not None:
+        size = (hw[0] * hw[1], (hw[0] // r) * (hw[1] // r))
+        if size != tuple(relative_pos.shape[2:]):
+            relative_pos = F.interpolate(relative_pos, size=size, mode='bicubic')
+    return relative_pos.squeeze(1).to(dtype)
+
+
 # --------------------------------------------------------
 # 2D sine-cosine position embedding
 # References:
@@ -71,7 +110,7 @@ def get_1d_sincos_pos_embed_from_grid(embed_dim, pos):
     out: (M, D)
     """
     assert embed_dim % 2 == 0
-    omega = np.arange(embed_dim // 2, dtype=np.float)
+    omega = np.arange(embed_dim // 2, dtype=np.float64)
     omega /= embed_dim / 2.
     omega = 1. / 10000**omega  # (D/2,)
 
@@ -0,0 +1,232 @@
+import copy
+import logging
+import time
+import warnings
+from collections import OrderedDict
+
+import torch
+from torch import nn
+from timm.models.layers import DropPath
+try:
+    from torch.ao import quantization as tq
+except ImportError:
+    from torch import quantization as tq
+
+_logger = logging.getLogger(__name__)
+
+##############################
+#    Inference graph optimization
+##############################
+def fuse_conv_bn(conv, bn):
+    """Conv2d equivalent to bn(conv(x)) with the running statistics of bn (grouped convs included)"""
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                      conv.dilation, conv.groups, bias=True, padding_mode=conv.padding_mode)
+    fused = fused.to(conv.weight.device, conv.weight.dtype)
+    with torch.no_grad():
+        scale = bn.running_var.add(bn.eps).rsqrt()
+        if bn.weight is not None:
+            scale = scale * bn.weight
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        shift = (bias - bn.running_mean) * scale
+        if bn.bias is not None:
+            shift = shift + bn.bias
+        fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        fused.bias.copy_(shift)
+    return fused
+
+
+def fold_batch_norms(model):
+    """Fold every BatchNorm2d that directly follows a Conv2d in a Sequential into that conv."""
+    count = 0
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        names = list(module._modules.keys())
+        for name, next_name in zip(names[:-1], names[1:]):
+            conv, bn = module._modules[name], module._modules[next_name]
+            if type(conv) is nn.Conv2d and isinstance(bn, nn.BatchNorm2d) and bn.track_running_stats:
+                module._modules[name] = fuse_conv_bn(conv, bn)
+                module._modules[next_name] = nn.Identity()
+                count += 1
+    for module in model.modules():
+        if hasattr(module, 'batch_norm') and hasattr(module, 'nn'):
+            module.batch_norm = any(isinstance(m, nn.BatchNorm2d) for m in module.nn.modules())
+    return count
+
+
+def strip_identities(model):
+    """Replace DropPath/Dropout (no-ops in eval) by Identity and drop Identity entries of Sequentials."""
+    count = 0
+    for module in model.modules():
+        for name, child in list(module._modules.items()):
+            if isinstance(child, (DropPath, nn.Dropout, nn.Dropout2d)):
+                module._modules[name] = nn.Identity()
+        if isinstance(module, nn.Sequential):
+            for name, child in list(module._modules.items()):
+                if isinstance(child, nn.Identity) and len(module._modules) > 1:
+                    del module._modules[name]
+                    count += 1
+    return count
+
+
+def optimize_for_inference(model, check_input=None, repeat=10, rtol=1e-3, atol=1e-4, log_info=True):
+    """
+    Inference copy of a vig/pyramid_vig DeepGCN: batch norms folded into the convs, drop path and
+    dropout removed, and, with check_input, the relative position and pos_embed tables of its
+    resolution generated once. With check_input the outputs of both models are compared and the
+    latency change is logged.
+    Args:
+        model: nn.Module, left unchanged
+        check_input: (B, 3, H, W) images on the device of the model or None
+        log_info: log the folding and check statistics at info level
+    Returns:
+        the optimized copy in eval mode
+    """
+    optimized = copy.deepcopy(model).eval()
+    n_folded = fold_batch_norms(optimized)
+    n_stripped = strip_identities(optimized)
+    if log_info:
+        _logger.info('optimize_for_inference: folded {} batch norms, removed {} identities'.format(
+            n_folded, n_stripped))
+    if check_input is None:
+        return optimized
+
+    def timed(m):
+        with torch.no_grad():
+            out = m(check_input)  # also generates the tables of this resolution
+            if check_input.is_cuda:
+                torch.cuda.synchronize(check_input.device)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                m(check_input)
+            if check_input.is_cuda:
+                torch.cuda.synchronize(check_input.device)
+        return out, (time.perf_counter() - start) / repeat * 1000
+    training = model.training
+    ref, ref_latency = timed(model.eval())
+    model.train(training)
+    out, latency = timed(optimized)
+    diff = (out.float() - ref.float()).abs().max().item()
+    if log_info:
+        _logger.info('optimize_for_inference: max abs diff {:.2e}, latency {:.2f} ms -> {:.2f} ms ({:.2f}x)'.format(
+            diff, ref_latency, latency, ref_latency / latency))
+    if not torch.allclose(out.float(), ref.float(), rtol=rtol, atol=atol):
+        warnings.warn('optimize_for_inference: outputs differ by up to {:.2e}'.format(diff))
+    return optimized
+
+
+def compile_model(model, mode=None, dynamic=False):
+    """
+    Compile model in place with torch.compile (torch >= 2.0), keeping its state dict keys.
+    In compiled code the exact KNN runs on the full distance matrix, the stochastic dilation is
+    drawn on the device and the relative position tables are cached without LRU bookkeeping,
+    so a fixed input size compiles into one graph per model.
+    Args:
+        model: nn.Module
+        mode: torch.compile mode, e.g. None, 'reduce-overhead' or 'max-autotune'
+        dynamic: compile for dynamic input shapes
+    Returns:
+        model
+    """
+    if not hasattr(torch, 'compile'):
+        raise RuntimeError('torch.compile needs torch >= 2.0, found {}'.format(torch.__version__))
+    if hasattr(model, 'compile'):
+        model.compile(mode=mode, dynamic=dynamic)
+    else:
+        model.forward = torch.compile(model.forward, mode=mode, dynamic=dynamic)
+    return model
+
+
+# modules that run on quantized tensors: the mapped convs/linears/norms and the quantized-aware activations
+_int8_types = (nn.Conv2d, nn.Linear, nn.BatchNorm2d, nn.ReLU, nn.ReLU6, nn.GELU, nn.Hardswish, nn.LeakyReLU,
+               nn.AdaptiveAvgPool2d, nn.AvgPool2d, nn.MaxPool2d)
+
+
+def _int8_chain(module):
+    """True for an int8-capable layer or a Sequential chain of them."""
+    if isinstance(module, nn.Sequential):
+        return len(module) > 0 and all(_int8_chain(m) for m in module)
+    return type(module) in _int8_types
+
+
+def _has_weight_layer(module):
+    return any(type(m) in (nn.Conv2d, nn.Linear) for m in module.modules())
+
+
+def insert_quant_stubs(module, qconfig):
+    """
+    Turn every maximal run of int8-capable children of a Sequential (holding at least one conv or
+    linear) into one int8 region: QuantStub before it, DeQuantStub after it, qconfig on all of it.
+    Activations stay quantized inside a region and are only converted at its boundaries. Stubs
+    are inserted into the Sequential itself; a module with such a Sequential and a copy_free path
+    (MRConv2d) switches that path off, as its int8 conv needs the interleaved copy of x and x_j
+    as one quantized input. Returns the number of regions.
+    """
+    count = 0
+    if not isinstance(module, nn.Sequential):
+        for child in module.children():
+            count += insert_quant_stubs(child, qconfig)
+        if count and getattr(module, 'copy_free', False):
+            module.copy_free = False
+        return count
+    children, run = OrderedDict(), []
+
+    def close_run():
+        if run and any(_has_weight_layer(child) for _, child in run):
+            quant = tq.QuantStub()
+            dequant = tq.DeQuantStub()
+            for m in [quant, dequant] + [child for _, child in run]:
+                m.qconfig = qconfig
+            children[run[0][0] + '_quant'] = quant
+            children.update(run)
+            children[run[-1][0] + '_dequant'] = dequant
+            return 1
+        children.update(run)
+        return 0
+
+    for name, child in module._modules.items():
+        if _int8_chain(child):
+            run.append((name, child))
+            continue
+        count += close_run()
+        run = []
+        count += insert_quant_stubs(child, qconfig)
+        children[name] = child
+    count += close_run()
+    module._modules.clear()
+    module._modules.update(children)
+    return count
+
+
+def quantize_int8(model, calibration_batches, backend='fbgemm'):
+    """
+    INT8 post-training static quantization for CPU inference (eager mode). Batch norms are folded
+    first; then every chain of convs, linears and activations inside a Sequential (BasicConv, fc1,
+    fc2, the stem, the head) becomes one int8 region with quant/dequant stubs at its boundaries
+    (see insert_quant_stubs), is calibrated and converted. The KNN distances, the aggregations and
+    the residual sums stay float.
+    Args:
+        model: nn.Module, left unchanged
+        calibration_batches: iterable of (B, 3, H, W) float images
+        backend: quantized engine, 'fbgemm' (x86) or 'qnnpack' (ARM)
+    Returns:
+        the quantized copy on CPU in eval mode
+    """
+    quantized = copy.deepcopy(model).cpu().eval()
+    fold_batch_norms(quantized)
+    strip_identities(quantized)
+    torch.backends.quantized.engine = backend
+    insert_quant_stubs(quantized, tq.get_default_qconfig(backend))
+    tq.prepare(quantized, inplace=True)
+    with torch.no_grad():
+        for images in calibration_batches:
+            quantized(images.cpu())
+    # eager convert leaves unmapped layers float, which then fail on the quantized activations
+    region_layers = {id(m) for m in quantized.modules()
+                     if type(m) in (nn.Conv2d, nn.Linear, nn.BatchNorm2d) and getattr(m, 'qconfig', None) is not None}
+    tq.convert(quantized, inplace=True)
+    float_layers = [name for name, m in quantized.named_modules() if id(m) in region_layers]
+    if float_layers:
+        raise RuntimeError('quantize_int8: layers of int8 regions left float by convert: {}'.format(
+            ', '.join(float_layers)))
+    return quantized
@@ -1,9 +1,11 @@
 # 2022.06.17-Changed for building ViG model
 #            Huawei Technologies Co., Ltd. <foss@huawei.com>
 import math
+from collections import OrderedDict
 import torch
 from torch import nn
 import torch.nn.functional as F
+from .torch_nn import is_compiling
 
 
 def pairwise_distance(x):
@@ -51,20 +53,63 @@ def xy_pairwise_distance(x, y):
         return x_square + xy_inner + y_square.transpose(2, 1)
 
 
-def dense_knn_matrix(x, k=16, relative_pos=None):
+def tiled_knn(x, y, k=16, relative_pos=None, tile_size=1024):
+    """Exact KNN that streams a running top-k over query and key tiles,
+    so that only (batch_size, tile_size, tile_size) distances are alive at once.
+    Args:
+        x: tensor (batch_size, num_points, num_dims)
+        y: tensor (batch_size, num_points_y, num_dims)
+        k: int
+        relative_pos: (1 or batch_size, num_points, num_points_y) or None
+        tile_size: int, number of queries and keys per tile
+    Returns:
+        nearest neighbors: (batch_size, num_points, k)
+    """
+    with torch.no_grad():
+        n_points, m_points = x.shape[1], y.shape[1]
+        x_square = torch.sum(torch.mul(x, x), dim=-1, keepdim=True)
+        y_square = torch.sum(torch.mul(y, y), dim=-1, keepdim=True).transpose(2, 1)
+        nn_idx_list = []
+        for q_start in range(0, n_points, tile_size):
+            q_end = min(n_points, q_start + tile_size)
+            x_part = x[:, q_start:q_end]
+            top_dist, top_idx = None, None
+            for k_start in range(0, m_points, tile_size):
+                k_end = min(m_points, k_start + tile_size)
+                xy_inner = -2*torch.matmul(x_part, y[:, k_start:k_end].transpose(2, 1))
+                dist = x_square[:, q_start:q_end] + xy_inner + y_square[:, :, k_start:k_end]
+                if relative_pos is not None:
+                    dist += relative_pos[:, q_start:q_end, k_start:k_end]
+                part_dist, part_idx = torch.topk(dist, k=min(k, k_end - k_start), largest=False)
+                part_idx += k_start
+                if top_dist is None:
+                    top_dist, top_idx = part_dist, part_idx
+                else:
+                    top_dist = torch.cat([top_dist, part_dist], dim=-1)
+                    top_idx = torch.cat([top_idx, part_idx], dim=-1)
+                    top_dist, order = torch.topk(top_dist, k=min(k, top_dist.shape[-1]), largest=False)
+                    top_idx = torch.gather(top_idx, -1, order)
+            nn_idx_list += [top_idx]
+        return torch.cat(nn_idx_list, dim=1)
+
+
+def dense_knn_matrix(x, k=16, relative_pos=None, tile_size=1024):
     """Get KNN based on the pairwise distance.
     Args:
         x: (batch_size, num_dims, num_points, 1)
         k: int
+        tile_size: int, tile size of the streaming top-k (None: build the full distance matrix)
     Returns:
-        nearest neighbors: (batch_size, num_points, k) (batch_size, num_points, k)
+        nearest neighbors: (1, batch_size, num_points, k), the centers are the points themselves
     """
     with torch.no_grad():
         x = x.transpose(2, 1).squeeze(-1)
         batch_size, n_points, n_dims = x.shape
         ### memory efficient implementation ###
         n_part = 10000
-        if n_points > n_part:
+        if tile_size:
+            nn_idx = tiled_knn(x.detach(), x.detach(), k, relative_pos, tile_size)
+        elif n_points > n_part:
             nn_idx_list = []
             groups = math.ceil(n_points / n_part)
             for i in range(groups):
@@ -82,35 +127,407 @@ def dense_knn_matrix(x, k=16, relative_pos=None):
                 dist += relative_pos
             _, nn_idx = torch.topk(-dist, k=k) # b, n, k
         ######
-        center_idx = torch.arange(0, n_points, device=x.device).repeat(batch_size, k, 1).transpose(2, 1)
-    return torch.stack((nn_idx, center_idx), dim=0)
+    return nn_idx.unsqueeze(0)
 
 
-def xy_dense_knn_matrix(x, y, k=16, relative_pos=None):
+def xy_dense_knn_matrix(x, y, k=16, relative_pos=None, tile_size=1024):
     """Get KNN based on the pairwise distance.
     Args:
         x: (batch_size, num_dims, num_points, 1)
+        y: (batch_size, num_dims, num_points_y, 1)
         k: int
+        tile_size: int, tile size of the streaming top-k (None: build the full distance matrix)
     Returns:
-        nearest neighbors: (batch_size, num_points, k) (batch_size, num_points, k)
+        nearest neighbors: (1, batch_size, num_points, k), the centers are the points themselves
     """
     with torch.no_grad():
         x = x.transpose(2, 1).squeeze(-1)
         y = y.transpose(2, 1).squeeze(-1)
+        if tile_size:
+            nn_idx = tiled_knn(x.detach(), y.detach(), k, relative_pos, tile_size)
+        else:
+            dist = xy_pairwise_distance(x.detach(), y.detach())
+            if relative_pos is not None:
+                dist += relative_pos
+            _, nn_idx = torch.topk(-dist, k=k)
+    return nn_idx.unsqueeze(0)
+
+
+def candidate_knn(x, y, cand, k=16, relative_pos=None, invalid=None, tile_size=1024):
+    """Exact KNN restricted to a list of candidate keys per query.
+    Args:
+        x: tensor (batch_size, num_points, num_dims)
+        y: tensor (batch_size, num_points_y, num_dims)
+        cand: (batch_size or 1, num_points, num_cand), candidate key indices
+        k: int, at most the number of valid candidates
+        relative_pos: (1 or batch_size, num_points, num_points_y) or None
+        invalid: bool (batch_size or 1, num_points, num_cand), candidates to skip, or None
+        tile_size: int, number of queries scored at once
+    Returns:
+        nearest neighbors: (batch_size, num_points, k)
+    """
+    with torch.no_grad():
         batch_size, n_points, n_dims = x.shape
-        dist = xy_pairwise_distance(x.detach(), y.detach())
-        if relative_pos is not None:
-            dist += relative_pos
-        _, nn_idx = torch.topk(-dist, k=k)
-        center_idx = torch.arange(0, n_points, device=x.device).repeat(batch_size, k, 1).transpose(2, 1)
-    return torch.stack((nn_idx, center_idx), dim=0)
+        cand = cand.expand(batch_size, -1, -1)
+        y_square = torch.sum(torch.mul(y, y), dim=-1)
+        nn_idx_list = []
+        for q_start in range(0, n_points, tile_size):
+            q_end = min(n_points, q_start + tile_size)
+            cand_part = cand[:, q_start:q_end]
+            n_cand = cand_part.shape[-1]
+            y_part = torch.gather(y, 1, cand_part.reshape(batch_size, -1, 1).expand(-1, -1, n_dims))
+            y_part = y_part.view(batch_size, q_end - q_start, n_cand, n_dims)
+            x_part = x[:, q_start:q_end]
+            xy_inner = -2*torch.einsum('bnc,bnwc->bnw', x_part, y_part)
+            dist = torch.sum(torch.mul(x_part, x_part), dim=-1, keepdim=True) + xy_inner + \
+                torch.gather(y_square, 1, cand_part.reshape(batch_size, -1)).view_as(xy_inner)
+            if relative_pos is not None:
+                rel = relative_pos[:, q_start:q_end].expand(batch_size, -1, -1)
+                dist += torch.gather(rel, 2, cand_part)
+            if invalid is not None:
+                dist.masked_fill_(invalid[:, q_start:q_end], float('inf'))
+            _, order = torch.topk(dist, k=k, largest=False)
+            nn_idx_list += [torch.gather(cand_part, -1, order)]
+        return torch.cat(nn_idx_list, dim=1)
+
+
+# bounded LRU cache of the random projections of lsh_knn keyed by (seed, n_hashes, n_dims, n_proj, device)
+_lsh_rotations = OrderedDict()
+_lsh_max_entries = 16
+
+
+def lsh_rotations(n_hashes, n_dims, n_proj, device, seed=0):
+    """(n_hashes, n_dims, n_proj) projections of lsh_knn, drawn once per seed, shape and device."""
+    key = (seed, n_hashes, n_dims, n_proj, torch.device(device))
+    if key in _lsh_rotations:
+        _lsh_rotations.move_to_end(key)
+        return _lsh_rotations[key]
+    # drawn on the CPU so that every device hashes with the same projections
+    generator = torch.Generator().manual_seed(seed)
+    rotations = torch.randn(n_hashes, n_dims, n_proj, generator=generator).to(device)
+    _lsh_rotations[key] = rotations
+    while len(_lsh_rotations) > _lsh_max_entries:
+        _lsh_rotations.popitem(last=False)
+    return rotations
+
+
+def lsh_knn(x, y, k=16, relative_pos=None, n_hashes=2, bucket_size=64, tile_size=1024, seed=0):
+    """Approximate KNN with random-projection (angular) LSH.
+
+    Keys are sorted by their hash bucket (argmax over [xR, -xR]) and, inside a bucket, by one
+    more random projection. Every query only scores the bucket_size keys around its own
+    position in that order; the candidates of n_hashes rounds are merged.
+    Args:
+        x: tensor (batch_size, num_points, num_dims), l2-normalized
+        y: tensor (batch_size, num_points_y, num_dims), l2-normalized
+        k: int
+        relative_pos: (1 or batch_size, num_points, num_points_y) or None
+        n_hashes: int, number of hash rounds
+        bucket_size: int, number of candidate keys per query and round
+        tile_size: int, number of queries scored at once
+        seed: int, seed of the random projections
+    Returns:
+        nearest neighbors: (batch_size, num_points, k)
+    """
+    with torch.no_grad():
+        batch_size, n_points, n_dims = x.shape
+        m_points = y.shape[1]
+        window = min(m_points, max(bucket_size, k))
+        if window * n_hashes >= m_points:
+            # the candidates would cover every key anyway
+            return tiled_knn(x, y, k, relative_pos, tile_size)
+        n_half = max(1, m_points // (2 * window))
+        rotations = lsh_rotations(n_hashes, n_dims, n_half + 1, x.device, seed)
+
+        def lsh_code(z, rotation):
+            z = torch.matmul(z.float(), rotation)
+            bucket = torch.cat([z[..., :-1], -z[..., :-1]], dim=-1).argmax(dim=-1)
+            return bucket * 4 + torch.tanh(z[..., -1])
+
+        offsets = torch.arange(window, device=x.device)
+        cand_list = []
+        for i in range(n_hashes):
+            y_code, y_order = torch.sort(lsh_code(y, rotations[i]), dim=-1)
+            pos = torch.searchsorted(y_code, lsh_code(x, rotations[i]).contiguous())
+            start = torch.clamp(pos - window // 2, 0, m_points - window)
+            cand = (start.unsqueeze(-1) + offsets).view(batch_size, -1)
+            cand_list += [torch.gather(y_order, 1, cand).view(batch_size, n_points, window)]
+        cand, _ = torch.sort(torch.cat(cand_list, dim=-1), dim=-1)
+        duplicate = torch.zeros_like(cand, dtype=torch.bool)
+        duplicate[..., 1:] = cand[..., 1:] == cand[..., :-1]
+        return candidate_knn(x, y, cand, k, relative_pos, duplicate, tile_size)
+
+
+def lsh_knn_matrix(x, y=None, k=16, relative_pos=None, n_hashes=2, bucket_size=64, tile_size=1024):
+    """Get approximate KNN with random-projection LSH.
+    Args:
+        x: (batch_size, num_dims, num_points, 1)
+        y: (batch_size, num_dims, num_points_y, 1) or None for the self graph
+        k: int
+    Returns:
+        nearest neighbors: (1, batch_size, num_points, k), the centers are the points themselves
+    """
+    with torch.no_grad():
+        x = x.transpose(2, 1).squeeze(-1)
+        y = x if y is None else y.transpose(2, 1).squeeze(-1)
+        nn_idx = lsh_knn(x.detach(), y.detach(), k, relative_pos, n_hashes, bucket_size, tile_size)
+    return nn_idx.unsqueeze(0)
+
+
+def cosine_knn(x, y, k=16, relative_pos=None, low_precision=False, tile_size=1024):
+    """KNN of l2-normalized features ranked by similarity.
+
+    For unit vectors ||x - y||^2 = 2 - 2 x.y, so ranking by x.y - relative_pos / 2 (largest first)
+    is ranking by distance + relative_pos. The bias is fused into one baddbmm per query tile and
+    topk runs on the scores directly, without squared norms, a distance sum or a negated copy.
+    Args:
+        x: tensor (batch_size, num_points, num_dims), l2-normalized
+        y: tensor (batch_size, num_points_y, num_dims), l2-normalized
+        k: int
+        relative_pos: (1 or batch_size, num_points, num_points_y) or None
+        low_precision: bool, score in float16 (bfloat16 on cpu) and re-rank the top 2k in float32
+        tile_size: int, number of queries scored at once
+    Returns:
+        nearest neighbors: (batch_size, num_points, k)
+    """
+    with torch.no_grad():
+        n_points, m_points = x.shape[1], y.shape[1]
+        k_cand = min(2 * k, m_points) if low_precision else k
+        if low_precision:
+            dtype = torch.float16 if x.is_cuda else torch.bfloat16
+            x_score, y_score = x.to(dtype), y.to(dtype)
+        else:
+            x_score, y_score = x, y
+        y_score = y_score.transpose(2, 1)
+        nn_idx_list = []
+        for q_start in range(0, n_points, tile_size):
+            q_end = min(n_points, q_start + tile_size)
+            if relative_pos is not None:
+                bias = relative_pos[:, q_start:q_end].to(x_score.dtype)
+                score = torch.baddbmm(bias, x_score[:, q_start:q_end], y_score, beta=-0.5)
+            else:
+                score = torch.bmm(x_score[:, q_start:q_end], y_score)
+            _, nn_idx_part = torch.topk(score, k=k_cand, largest=True)
+            nn_idx_list += [nn_idx_part]
+        nn_idx = torch.cat(nn_idx_list, dim=1)
+        if low_precision:
+            nn_idx = candidate_knn(x.float(), y.float(), nn_idx, k, relative_pos, None, tile_size)
+        return nn_idx
+
+
+def cosine_knn_matrix(x, y=None, k=16, relative_pos=None, low_precision=False, tile_size=1024):
+    """Get KNN of l2-normalized features by similarity.
+    Args:
+        x: (batch_size, num_dims, num_points, 1)
+        y: (batch_size, num_dims, num_points_y, 1) or None for the self graph
+        k: int
+    Returns:
+        nearest neighbors: (1, batch_size, num_points, k), the centers are the points themselves
+    """
+    with torch.no_grad():
+        x = x.transpose(2, 1).squeeze(-1)
+        y = x if y is None else y.transpose(2, 1).squeeze(-1)
+        nn_idx = cosine_knn(x.detach(), y.detach(), k, relative_pos, low_precision, tile_size)
+    return nn_idx.unsqueeze(0)
+
+
+def nn_descent_knn(x, seed_idx, k=16, relative_pos=None, n_rounds=2, n_sample=8, tile_size=1024):
+    """Approximate self KNN refined from an initial neighbor list with NN-descent.
+
+    Every round scores the current neighbors plus the first n_sample neighbors of the first
+    n_sample neighbors of every point, i.e. (k_seed + n_sample^2) candidates instead of all points.
+    Args:
+        x: tensor (batch_size, num_points, num_dims)
+        seed_idx: (batch_size, num_points, k_seed) initial neighbors with k_seed >= k,
+            e.g. the graph of the previous block
+        k: int
+        relative_pos: (1 or batch_size, num_points, num_points) or None
+        n_rounds: int, refinement rounds
+        n_sample: int, neighbors expanded per point and round
+        tile_size: int, number of queries scored at once
+    Returns:
+        nearest neighbors: (batch_size, num_points, k)
+    """
+    with torch.no_grad():
+        batch_size, n_points, _ = x.shape
+        nn_idx = seed_idx
+        for _ in range(n_rounds):
+            n_hop = min(n_sample, nn_idx.shape[-1])
+            first = nn_idx[:, :, :n_hop]
+            hop = torch.gather(first, 1, first.reshape(batch_size, -1, 1).expand(-1, -1, n_hop))
+            cand = torch.cat([nn_idx, hop.view(batch_size, n_points, n_hop * n_hop)], dim=-1)
+            cand, _ = torch.sort(cand, dim=-1)
+            duplicate = torch.zeros_like(cand, dtype=torch.bool)
+            duplicate[..., 1:] = cand[..., 1:] == cand[..., :-1]
+            nn_idx = candidate_knn(x, x, cand, k, relative_pos, duplicate, tile_size)
+        return nn_idx
+
+
+def nn_descent_knn_matrix(x, seed_idx, k=16, relative_pos=None, n_rounds=2, n_sample=8, tile_size=1024):
+    """Get approximate KNN by NN-descent from an initial neighbor list.
+    Args:
+        x: (batch_size, num_dims, num_points, 1)
+        seed_idx: (batch_size, num_points, k_seed), k_seed >= k
+        k: int
+    Returns:
+        nearest neighbors: (1, batch_size, num_points, k), the centers are the points themselves
+    """
+    with torch.no_grad():
+        x = x.transpose(2, 1).squeeze(-1)
+        nn_idx = nn_descent_knn(x.detach(), seed_idx, k, relative_pos, n_rounds, n_sample, tile_size)
+    return nn_idx.unsqueeze(0)
+
+
+def window_shape(hk, wk, window=7, k=1):
+    """(height, width) of the local window on an hk x wk key grid: a square of at least k keys
+    cut to the grid and, on thin grids, widened along the other side until it holds k keys again
+    (or the whole grid when it has fewer)."""
+    window = max(window, int(math.ceil(math.sqrt(k))))
+    wh, ww = min(window, hk), min(window, wk)
+    if wh * ww < k:
+        ww = min(wk, max(ww, int(math.ceil(k / wh))))
+        wh = min(hk, max(wh, int(math.ceil(k / ww))))
+    return wh, ww
+
+
+def window_candidates(h, w, r=1, window=7, n_global=16, device=None, k=1):
+    """Candidate keys of windowed KNN: a local patch of the key grid around every query
+    (shifted to stay inside the grid, see window_shape) plus a strided grid of about n_global keys.
+    Args:
+        h, w: int, height and width of the query grid
+        r: int, reduce ratio of the key grid (h // r, w // r)
+        window: int, side of the local window
+        n_global: int, number of strided global candidates
+        k: int, minimum number of distinct keys of the local window
+    Returns:
+        candidates (num_points, num_cand) and the mask of the global candidates that
+        already lie in the window (num_points, num_cand)
+    """
+    hk, wk = h // r, w // r
+    wh, ww = window_shape(hk, wk, window, k)
+    rows = torch.clamp(torch.arange(h, device=device) // r, max=hk - 1)
+    cols = torch.clamp(torch.arange(w, device=device) // r, max=wk - 1)
+    top = torch.clamp(rows - wh // 2, 0, hk - wh)
+    left = torch.clamp(cols - ww // 2, 0, wk - ww)
+    win_rows = top.view(h, 1, 1, 1) + torch.arange(wh, device=device).view(1, 1, wh, 1)
+    win_cols = left.view(1, w, 1, 1) + torch.arange(ww, device=device).view(1, 1, 1, ww)
+    local = (win_rows * wk + win_cols).view(h * w, wh * ww)
+
+    n_side = max(1, int(math.ceil(math.sqrt(n_global))))
+    g_rows = torch.linspace(0, hk - 1, min(n_side, hk), device=device).round().long()
+    g_cols = torch.linspace(0, wk - 1, min(n_side, wk), device=device).round().long()
+    g_rows, g_cols = g_rows.view(-1, 1).expand(-1, len(g_cols)), g_cols.view(1, -1).expand(len(g_rows), -1)
+    inside_rows = (g_rows.reshape(1, 1, -1) >= top.view(h, 1, 1)) & (g_rows.reshape(1, 1, -1) < top.view(h, 1, 1) + wh)
+    inside_cols = (g_cols.reshape(1, 1, -1) >= left.view(1, w, 1)) & (g_cols.reshape(1, 1, -1) < left.view(1, w, 1) + ww)
+    glob = (g_rows * wk + g_cols).reshape(1, -1).expand(h * w, -1)
+    cand = torch.cat([local, glob], dim=-1)
+    invalid = torch.cat([torch.zeros_like(local, dtype=torch.bool),
+                         (inside_rows & inside_cols).view(h * w, -1)], dim=-1)
+    return cand, invalid
+
+
+def window_knn_matrix(x, y=None, k=16, relative_pos=None, hw=None, window=7, n_global=16, tile_size=1024):
+    """Get KNN among the keys of a local spatial window plus a few strided global keys.
+    Args:
+        x: (batch_size, num_dims, num_points, 1)
+        y: (batch_size, num_dims, num_points_y, 1), the r x r average-pooled x, or None
+        k: int
+        hw: (height, width) of the query grid
+    Returns:
+        nearest neighbors: (1, batch_size, num_points, k), the centers are the points themselves
+    """
+    with torch.no_grad():
+        h, w = hw
+        r = 1 if y is None else int(round(math.sqrt(x.shape[2] / y.shape[2])))
+        n_keys = x.shape[2] if y is None else y.shape[2]
+        wh, ww = window_shape(h // r, w // r, window, k)
+        if wh * ww + n_global >= n_keys:
+            # the candidates would cover every key anyway
+            if y is None:
+                return dense_knn_matrix(x, k, relative_pos, tile_size)
+            return xy_dense_knn_matrix(x, y, k, relative_pos, tile_size)
+        x = x.transpose(2, 1).squeeze(-1)
+        y = x if y is None else y.transpose(2, 1).squeeze(-1)
+        cand, invalid = window_candidates(h, w, r, window, n_global, x.device, k)
+        nn_idx = candidate_knn(x.detach(), y.detach(), cand.unsqueeze(0), k, relative_pos,
+                               invalid.unsqueeze(0), tile_size)
+    return nn_idx.unsqueeze(0)
+
+
+def neighbor_overlap(nn_idx, ref_idx):
+    """Fraction of the reference neighbors that are also found in nn_idx (the recall of nn_idx).
+    Args:
+        nn_idx: (batch_size, num_points, k)
+        ref_idx: (batch_size, num_points, k_ref)
+    Returns:
+        overlap per point: (batch_size, num_points)
+    """
+    with torch.no_grad():
+        hit = (ref_idx.unsqueeze(-1) == nn_idx.unsqueeze(-2)).any(dim=-1)
+        return hit.float().mean(dim=-1)
+
+
+class GraphContext(object):
+    """
+    Neighbor lists shared between the KNN graphs of one model, used to reuse a block's graph in the next blocks
+
+    track_overlap: blocks that reuse a graph also compute their own one and record the overlap of both
+    node_mask: (batch_size, 1, h, w) mask of the nodes with image content, set by the model for the
+        current forward (None: every node is valid); see node_masks
+    """
+    def __init__(self, track_overlap=False):
+        self.track_overlap = track_overlap
+        self.neighbors = {}
+        self.overlap = {}
+        self.num_graphs = 0
+        self.node_mask = None
+
+    def new_id(self):
+        self.num_graphs += 1
+        return self.num_graphs - 1
+
+    def store(self, graph_id, edge_index):
+        # keyed by device as well so that nn.DataParallel replicas do not overwrite each other
+        self.neighbors[(graph_id, edge_index.device)] = edge_index
+
+    def fetch(self, graph_id, device):
+        return self.neighbors[(graph_id, device)]
+
+    def compact(self, keep):
+        """Keep only the samples selected by keep (batch_size,) after the batch shrank between blocks."""
+        for key, edge_index in self.neighbors.items():
+            if edge_index.device == keep.device:
+                self.neighbors[key] = edge_index[:, keep]
+
+    def node_masks(self, H, W, r=1):
+        """
+        Bool (query, key) masks (batch_size, H * W) and (batch_size, H // r * W // r) of node_mask
+        resized to an H x W node grid and its r-pooled key grid, or None without a node mask.
+        A node is valid when any part of it is.
+        """
+        if self.node_mask is None:
+            return None
+        mask = self.node_mask.float()
+        if tuple(mask.shape[2:]) != (H, W):
+            mask = F.adaptive_max_pool2d(mask, (H, W))
+        key_mask = mask if r == 1 else F.max_pool2d(mask, r, r)
+        return mask.flatten(1) > 0, key_mask.flatten(1) > 0
+
+    def record_overlap(self, graph_id, overlap):
+        total, count = self.overlap.get(graph_id, (0.0, 0))
+        self.overlap[graph_id] = (total + overlap, count + 1)
+
+    def overlap_report(self):
+        """Mean overlap between the reused and the freshly computed neighbors, per graph id."""
+        return {graph_id: total / count for graph_id, (total, count) in sorted(self.overlap.items())}
 
 
 class DenseDilated(nn.Module):
     """
     Find dilated neighbor from neighbor list
 
-    edge_index: (2, batch_size, num_points, k)
+    edge_index: (2, batch_size, num_points, k) neighbors and centers, or (1, batch_size, num_points, k)
+        neighbors only when every point is its own center
     """
     def __init__(self, k=9, dilation=1, stochastic=False, epsilon=0.0):
         super(DenseDilated, self).__init__()
@@ -120,13 +537,14 @@ class DenseDilated(nn.Module):
         self.k = k
 
     def forward(self, edge_index):
-        if self.stochastic:
-            if torch.rand(1) < self.epsilon and self.training:
-                num = self.k * self.dilation
-                randnum = torch.randperm(num)[:self.k]
-                edge_index = edge_index[:, :, :, randnum]
-            else:
-                edge_index = edge_index[:, :, :, ::self.dilation]
+        if self.stochastic and self.training:
+            # drawn on the device and selected with torch.where: no host sync and no data-dependent branch
+            num = self.k * self.dilation
+            device = edge_index.device
+            randnum = torch.rand(num, device=device).argsort()[:self.k]
+            dilated = torch.arange(0, num, self.dilation, device=device)
+            idx = torch.where(torch.rand((), device=device) < self.epsilon, randnum, dilated)
+            edge_index = edge_index.index_select(-1, idx)
         else:
             edge_index = edge_index[:, :, :, ::self.dilation]
         return edge_index
@@ -135,25 +553,112 @@ class DenseDilated(nn.Module):
 class DenseDilatedKnnGraph(nn.Module):
     """
     Find the neighbors' indices based on dilated knn
+
+    knn: knn backend {exact, cosine, lsh, window, nndescent}
+    tile_size: queries/keys per tile of the streaming top-k, None builds the full distance matrix
+    low_precision: cosine backend scores in half precision and re-ranks the candidates in float32
+    n_hashes, bucket_size: hash rounds and candidates per query and round of the lsh backend
+    window, n_global: local window side and number of strided global candidates of the window backend
+        (exact knn when the grid size hw is not given)
+    n_rounds, n_sample: refinement rounds and expanded neighbors of the nndescent backend, which
+        starts from the graph of the previous block (see gcn_lib.share_knn_graphs) and falls back
+        to exact knn for the first block of a stage and for pooled keys (r > 1)
+
+    Under torch.compile the exact backend builds the full distance matrix (one matmul and one topk of
+    static shape) instead of streaming tiles.
+
+    With node masks (see GraphContext.node_masks) the masked (padding) nodes get one more feature
+    coordinate mask_offset away from the valid ones, so that valid nodes only pick them when fewer
+    than k valid keys exist. The cosine backend ranks by inner product and falls back to exact knn.
     """
-    def __init__(self, k=9, dilation=1, stochastic=False, epsilon=0.0):
+    mask_offset = 10.0
+
+    def __init__(self, k=9, dilation=1, stochastic=False, epsilon=0.0, knn='exact', tile_size=1024,
+                 low_precision=False, n_hashes=2, bucket_size=64, window=7, n_global=16, n_rounds=2,
+                 n_sample=8):
         super(DenseDilatedKnnGraph, self).__init__()
+        if knn not in ('exact', 'cosine', 'lsh', 'window', 'nndescent'):
+            raise NotImplementedError('knn:{} is not supported'.format(knn))
         self.dilation = dilation
         self.stochastic = stochastic
         self.epsilon = epsilon
         self.k = k
+        self.knn = knn
+        self.tile_size = tile_size
+        self.low_precision = low_precision
+        self.n_hashes = n_hashes
+        self.bucket_size = bucket_size
+        self.window = window
+        self.n_global = n_global
+        self.n_rounds = n_rounds
+        self.n_sample = n_sample
         self._dilated = DenseDilated(k, dilation, stochastic, epsilon)
+        # graph reuse, set up by gcn_lib.share_knn_graphs
+        self.context = None
+        self.graph_id = None
+        self.source_id = None
+        self.seed_id = None
+        self.store_graph = False  # a later block reads this graph
+        self.knn_width = k * dilation
+
+    def forward(self, x, y=None, relative_pos=None, hw=None, node_masks=None):
+        n_keys = x.shape[2] if y is None else y.shape[2]
+        width = self.k * self.dilation
+        if width > n_keys:
+            # fewer nodes than at the resolution the model was built for: shrink dilation (and k)
+            k = min(self.k, n_keys)
+            dilation = max(1, n_keys // k)
+            width = k * dilation
+        edge_index = None
+        if self.source_id is not None:
+            edge_index = self.context.fetch(self.source_id, x.device)
+            if edge_index.shape[2] != x.shape[2]:
+                # nodes were pruned since the source block: build a graph of its own
+                edge_index = None
+        if edge_index is not None:
+            edge_index = edge_index[:, :, :, :width]
+            if self.context.track_overlap:
+                fresh = self.knn_matrix(x, y, relative_pos, width, hw, node_masks)
+                overlap = neighbor_overlap(edge_index[0], fresh[0]).mean().item()
+                self.context.record_overlap(self.graph_id, overlap)
+        else:
+            edge_index = self.knn_matrix(x, y, relative_pos, max(min(self.knn_width, n_keys), width), hw,
+                                         node_masks)
+            if self.store_graph:
+                self.context.store(self.graph_id, edge_index)
+            edge_index = edge_index[:, :, :, :width]
+        if width < self.k * self.dilation:
+            return edge_index[:, :, :, ::dilation]
+        return self._dilated(edge_index)
 
-    def forward(self, x, y=None, relative_pos=None):
+    def knn_matrix(self, x, y, relative_pos, k, hw=None, node_masks=None):
+        #### normalize
+        x = F.normalize(x, p=2.0, dim=1)
         if y is not None:
-            #### normalize
-            x = F.normalize(x, p=2.0, dim=1)
             y = F.normalize(y, p=2.0, dim=1)
-            ####
-            edge_index = xy_dense_knn_matrix(x, y, self.k * self.dilation, relative_pos)
+        ####
+        if node_masks is not None:
+            query_mask, key_mask = node_masks
+            x = torch.cat([x, self._mask_coordinate(x, query_mask)], dim=1)
+            if y is not None:
+                y = torch.cat([y, self._mask_coordinate(y, key_mask)], dim=1)
+        if self.knn == 'cosine' and node_masks is None:
+            return cosine_knn_matrix(x, y, k, relative_pos, self.low_precision, self.tile_size or 1024)
+        elif self.knn == 'lsh':
+            return lsh_knn_matrix(x, y, k, relative_pos, self.n_hashes, self.bucket_size, self.tile_size or 1024)
+        elif self.knn == 'nndescent' and y is None and self.seed_id is not None:
+            seed_idx = self.context.fetch(self.seed_id, x.device)[0]
+            if seed_idx.shape[1] == x.shape[2] and seed_idx.shape[2] >= k:
+                return nn_descent_knn_matrix(x, seed_idx, k, relative_pos, self.n_rounds, self.n_sample,
+                                             self.tile_size or 1024)
+        if self.knn == 'window' and hw is not None:
+            return window_knn_matrix(x, y, k, relative_pos, hw, self.window, self.n_global, self.tile_size or 1024)
+        tile_size = None if is_compiling() else self.tile_size
+        if y is not None:
+            return xy_dense_knn_matrix(x, y, k, relative_pos, tile_size)
         else:
-            #### normalize
-            x = F.normalize(x, p=2.0, dim=1)
-            ####
-            edge_index = dense_knn_matrix(x, self.k * self.dilation, relative_pos)
-        return self._dilated(edge_index)
+            return dense_knn_matrix(x, k, relative_pos, tile_size)
+
+    def _mask_coordinate(self, x, mask):
+        # (batch_size, 1, num_points, 1): 0 for valid nodes, mask_offset for masked ones
+        return (~mask).to(x.dtype).mul_(self.mask_offset).view(x.shape[0], 1, -1, 1)
@@ -78,6 +78,25 @@ class BasicConv(Seq):
                 m.bias.data.zero_()
 
 
+def is_compiling():
+    """True while torch.compile traces the code (always False before torch 2.0)."""
+    compiler = getattr(torch, 'compiler', None)
+    if compiler is not None and hasattr(compiler, 'is_compiling'):
+        return compiler.is_compiling()
+    dynamo = getattr(torch, '_dynamo', None)
+    return dynamo is not None and dynamo.is_compiling()
+
+
+# stage timer of gcn_lib.Instrumentation entered around every gather, None while it is disabled
+_gather_timer = None
+
+
+def set_gather_timer(timer):
+    """Installs the context manager timing batched_index_select (None removes it)."""
+    global _gather_timer
+    _gather_timer = timer
+
+
 def batched_index_select(x, idx):
     r"""fetches neighbors features from a given neighbor idx
 
@@ -90,6 +109,13 @@ def batched_index_select(x, idx):
         Tensor: output neighbors features
             :math:`\mathbf{X} \in \mathbb{R}^{B \times C \times N \times k}`.
     """
+    if _gather_timer is not None:
+        with _gather_timer:
+            return _index_select(x, idx)
+    return _index_select(x, idx)
+
+
+def _index_select(x, idx):
     batch_size, num_dims, num_vertices_reduced = x.shape[:3]
     _, num_vertices, k = idx.shape
     idx_base = torch.arange(0, batch_size, device=idx.device).view(-1, 1, 1) * num_vertices_reduced
@@ -100,3 +126,111 @@ def batched_index_select(x, idx):
     feature = x.contiguous().view(batch_size * num_vertices_reduced, -1)[idx, :]
     feature = feature.view(batch_size, num_vertices, k, num_dims).permute(0, 3, 1, 2).contiguous()
     return feature
+
+
+def vertex_chunk(budget, per_vertex, num_vertices):
+    """Number of vertices whose per_vertex bytes of temporaries fit in budget MB (at least 1)."""
+    return max(1, min(num_vertices, int(budget * 2**20 // max(per_vertex, 1))))
+
+
+class MaxRelative(torch.autograd.Function):
+    """max_j (x_j - x_i) over the k neighbors of every vertex, computed in vertex chunks.
+
+    Only the argmax slot of every (batch, channel, vertex) is saved for backward, so the
+    B x C x N x k gathers never have to be kept alive. With x None this is the plain max_j y_j.
+    """
+
+    @staticmethod
+    def forward(ctx, x, y, nn_idx, center_idx, chunk_budget):
+        batch_size, num_dims = y.shape[:2]
+        num_vertices, k = nn_idx.shape[1:]
+        chunk = vertex_chunk(chunk_budget, 3 * batch_size * num_dims * k * y.element_size(), num_vertices)
+        value = y.new_empty(batch_size, num_dims, num_vertices, 1)
+        arg = torch.empty(batch_size, num_dims, num_vertices, dtype=torch.uint8 if k <= 256 else torch.int64,
+                          device=y.device)
+        for start in range(0, num_vertices, chunk):
+            end = min(start + chunk, num_vertices)
+            x_j = batched_index_select(y, nn_idx[:, start:end])
+            if x is not None and center_idx is not None:
+                x_j = x_j - batched_index_select(x, center_idx[:, start:end])
+            value[:, :, start:end, 0], arg[:, :, start:end] = torch.max(x_j, -1)
+        if x is not None and center_idx is None:
+            value -= x
+        ctx.save_for_backward(arg, nn_idx, center_idx)
+        ctx.shapes = None if x is None else x.shape, y.shape
+        return value
+
+    @staticmethod
+    def backward(ctx, grad_value):
+        arg, nn_idx, center_idx = ctx.saved_tensors
+        x_shape, y_shape = ctx.shapes
+        batch_size, num_dims, num_vertices = arg.shape
+        arg = arg.long().unsqueeze(-1)
+        grad_value = grad_value.reshape(batch_size, num_dims, num_vertices)
+        nn_idx = nn_idx.unsqueeze(1).expand(-1, num_dims, -1, -1)
+        grad_y = grad_value.new_zeros(batch_size, num_dims, y_shape[2])
+        grad_y.scatter_add_(2, torch.gather(nn_idx, 3, arg).squeeze(-1), grad_value)
+        grad_x = None
+        if x_shape is not None and center_idx is None:
+            grad_x = (-grad_value).view(x_shape)
+        elif x_shape is not None:
+            center_idx = center_idx.unsqueeze(1).expand(-1, num_dims, -1, -1)
+            grad_x = grad_value.new_zeros(batch_size, num_dims, x_shape[2])
+            grad_x.scatter_add_(2, torch.gather(center_idx, 3, arg).squeeze(-1), -grad_value)
+            grad_x = grad_x.view(x_shape)
+        return grad_x, grad_y.view(y_shape), None, None, None
+
+
+def max_relative(x, edge_index, y=None, chunk_budget=64):
+    r"""memory-efficient :math:`\max_j (x_j - x_i)` of MRConv2d
+
+    Args:
+        x (Tensor): vertex features (B, C, N, 1)
+        edge_index (Tensor): (2, B, N, k), neighbors in [0] and centers in [1], or (1, B, N, k)
+            when every vertex is its own center
+        y (Tensor): key features (B, C, M, 1) the neighbors index into, x if None
+        chunk_budget (float): MB of gather temporaries allowed per vertex chunk
+    Returns:
+        Tensor: (B, C, N, 1)
+    """
+    center_idx = edge_index[1] if edge_index.shape[0] > 1 else None
+    return MaxRelative.apply(x, x if y is None else y, edge_index[0], center_idx, chunk_budget)
+
+
+def neighbor_max(y, nn_idx, chunk_budget=64):
+    r"""memory-efficient :math:`\max_j y_j` over the neighbors nn_idx (B, N, k) of y (B, C, M, 1)"""
+    return MaxRelative.apply(None, y, nn_idx, None, chunk_budget)
+
+
+def knn_csr(nn_idx, num_keys):
+    r"""block-diagonal adjacency of a neighbor list as a CSR matrix with int32 indices
+
+    Args:
+        nn_idx (Tensor): neighbors (B, N, k) in [0, num_keys)
+        num_keys (int): M
+    Returns:
+        Tensor: sparse (B * N, B * M) matrix with a one for every edge
+    """
+    batch_size, num_vertices, k = nn_idx.shape
+    offset = torch.arange(0, batch_size, device=nn_idx.device, dtype=torch.int32).view(-1, 1, 1) * num_keys
+    col_indices = (nn_idx.to(torch.int32) + offset).reshape(-1)
+    crow_indices = torch.arange(0, batch_size * num_vertices * k + 1, k, device=nn_idx.device, dtype=torch.int32)
+    values = torch.ones(col_indices.numel(), device=nn_idx.device)
+    return torch.sparse_csr_tensor(crow_indices, col_indices, values,
+                                   size=(batch_size * num_vertices, batch_size * num_keys))
+
+
+def csr_neighbor_sum(y, nn_idx):
+    r"""sum of the neighbor features by a sparse-dense matmul
+
+    Args:
+        y (Tensor): key features (B, C, M, 1)
+        nn_idx (Tensor): neighbors (B, N, k)
+    Returns:
+        Tensor: (B, C, N, 1)
+    """
+    batch_size, num_dims, num_keys = y.shape[:3]
+    num_vertices = nn_idx.shape[1]
+    feature = y.squeeze(-1).transpose(1, 2).reshape(batch_size * num_keys, num_dims)
+    feature = torch.sparse.mm(knn_csr(nn_idx, num_keys), feature.float()).to(y.dtype)
+    return feature.view(batch_size, num_vertices, num_dims).transpose(1, 2).unsqueeze(-1)
@@ -0,0 +1,373 @@
+import csv
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+
+import torch
+from torch import nn
+from .torch_nn import set_gather_timer
+from .torch_edge import DenseDilatedKnnGraph, window_shape
+from .torch_vertex import Grapher, MRConv2d
+
+
+##############################
+#    Model profiling
+##############################
+
+
+def profile_blocks(model):
+    """(name, module) of every top-level module of model, with the backbone split into its blocks."""
+    blocks = []
+    for name, child in model.named_children():
+        if name == 'backbone':
+            blocks += [('backbone.{}'.format(i), block) for i, block in enumerate(child)]
+        else:
+            blocks.append((name, child))
+    return blocks
+
+
+def _conv_macs(conv, out):
+    return out.numel() * (conv.in_channels // conv.groups) * conv.kernel_size[0] * conv.kernel_size[1]
+
+
+def knn_cost(knn_graph, x, y=None, hw=None, node_masks=None):
+    """
+    (distance MACs, top-k comparisons) of one DenseDilatedKnnGraph forward on x (and keys y):
+    every query scores its candidate keys with a channels-long inner product and keeps the best
+    k * dilation of them in about log2(k * dilation) comparisons per candidate. A graph reused
+    from an earlier block costs nothing.
+    """
+    batch_size, channels, n_points = x.shape[:3]
+    n_keys = n_points if y is None else y.shape[2]
+    if knn_graph.source_id is not None and not knn_graph.context.track_overlap and \
+            knn_graph.context.fetch(knn_graph.source_id, x.device).shape[2] == n_points:
+        return 0, 0
+    if node_masks is not None:
+        channels += 1
+    if knn_graph.knn == 'lsh':
+        candidates = knn_graph.n_hashes * knn_graph.bucket_size
+    elif knn_graph.knn == 'window' and hw is not None:
+        r = int(round(math.sqrt(n_points / n_keys)))
+        wh, ww = window_shape(hw[0] // r, hw[1] // r, knn_graph.window, knn_graph.knn_width)
+        candidates = wh * ww + knn_graph.n_global
+    elif knn_graph.knn == 'nndescent' and y is None and knn_graph.seed_id is not None:
+        candidates = knn_graph.n_rounds * (knn_graph.knn_width + knn_graph.n_sample ** 2)
+    else:
+        candidates = n_keys
+    candidates = min(candidates, n_keys)
+    width = max(2, min(knn_graph.knn_width, n_keys))
+    scored = batch_size * n_points * candidates
+    return scored * channels, int(scored * math.log2(width))
+
+
+def profile_model(model, input_size=(1, 3, 224, 224)):
+    """
+    Per-block cost of one inference forward of a vig/pyramid_vig DeepGCN on a random input.
+    MACs count the convolutions and linear layers (including the copy-free max-relative conv,
+    which bypasses its Conv2d module); knn_macs and topk_ops the KNN distances and top-k of the
+    Grapher blocks (see knn_cost); activation is the number of output elements of the block.
+    Args:
+        model: nn.Module, profiled on the device of its parameters and left in its training mode
+        input_size: (batch_size, 3, H, W)
+    Returns:
+        dict with the per-block list under 'blocks' and the model totals
+    """
+    device = next(model.parameters()).device
+    blocks = profile_blocks(model)
+    stats = OrderedDict((name, OrderedDict([
+        ('params', sum(p.numel() for p in block.parameters())), ('macs', 0), ('knn_macs', 0),
+        ('topk_ops', 0), ('activation', None), ('activation_mb', None)])) for name, block in blocks)
+    handles = []
+    for name, block in blocks:
+        entry = stats[name]
+        for m in block.modules():
+            if isinstance(m, (nn.Conv2d, nn.Linear)):
+                handles.append(m.register_forward_hook(
+                    lambda module, inputs, out, entry=entry: _macs_hook(entry, module, out)))
+            elif isinstance(m, MRConv2d):
+                handles.append(m.register_forward_hook(
+                    lambda module, inputs, out, entry=entry: _mrconv_hook(entry, module, inputs, out)))
+            elif isinstance(m, DenseDilatedKnnGraph):
+                handles.append(m.register_forward_hook(
+                    lambda module, inputs, out, entry=entry: _knn_hook(entry, module, inputs)))
+        handles.append(block.register_forward_hook(
+            lambda module, inputs, out, entry=entry: _activation_hook(entry, out)))
+
+    training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            model(torch.randn(*input_size, device=device))
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.train(training)
+
+    report = OrderedDict()
+    report['input_size'] = list(input_size)
+    report['params'] = sum(p.numel() for p in model.parameters())
+    for key in ('macs', 'knn_macs', 'topk_ops'):
+        report[key] = sum(entry[key] for entry in stats.values())
+    report['blocks'] = [OrderedDict([('name', name)], **entry) for name, entry in stats.items()
+                        if entry['activation'] is not None or entry['params']]
+    return report
+
+
+def _macs_hook(entry, module, out):
+    if isinstance(module, nn.Conv2d):
+        entry['macs'] += _conv_macs(module, out)
+    else:
+        entry['macs'] += out.numel() * module.in_features
+
+
+def _mrconv_hook(entry, module, inputs, out):
+    conv = module.nn[0]
+    if module.copy_free and type(conv) is nn.Conv2d and inputs[0].shape[1] % conv.groups == 0:
+        # see MRConv2d.update: the conv weight is applied with F.conv2d, its hook never fires
+        entry['macs'] += _conv_macs(conv, out)
+
+
+def _knn_hook(entry, module, inputs):
+    x, y = inputs[0], inputs[1] if len(inputs) > 1 else None
+    hw = inputs[3] if len(inputs) > 3 else None
+    node_masks = inputs[4] if len(inputs) > 4 else None
+    macs, topk_ops = knn_cost(module, x, y, hw, node_masks)
+    entry['knn_macs'] += macs
+    entry['topk_ops'] += topk_ops
+
+
+def _activation_hook(entry, out):
+    if isinstance(out, (tuple, list)):
+        out = out[0]
+    entry['activation'] = out.numel()
+    entry['activation_mb'] = round(out.numel() * out.element_size() / 2**20, 3)
+
+
+def cached_profile(model, name, config=None, input_size=(1, 3, 224, 224), cache_file='profile_cache.json',
+                   refresh=False):
+    """
+    profile_model, cached in the JSON file cache_file under (name, config, input_size), so the
+    forward only runs for a new model, configuration or input size (or with refresh).
+    Args:
+        model: nn.Module
+        name: model name, e.g. 'vig_ti_224_gelu'
+        config: JSON-serializable dict of the options the model was built with
+    """
+    key = json.dumps([name, config or {}, list(input_size)], sort_keys=True, default=str)
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+    if key in cache and not refresh:
+        return cache[key]
+    report = profile_model(model, input_size)
+    report['model'] = name
+    report['config'] = config or {}
+    cache[key] = report
+    if os.path.dirname(cache_file):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(cache_file + '.tmp', cache_file)
+    return report
+
+
+def format_profile(report):
+    """Text table of a profile_model report."""
+    lines = ['{} {}: {:.2f}M params, {:.3f} GMACs + {:.3f} GMACs KNN distances, {:.3f} G top-k comparisons'.format(
+        report.get('model', ''), 'x'.join(str(s) for s in report['input_size']), report['params'] / 1e6,
+        report['macs'] / 1e9, report['knn_macs'] / 1e9, report['topk_ops'] / 1e9)]
+    lines.append('{:<14}{:>12}{:>12}{:>12}{:>12}{:>14}'.format(
+        'block', 'params(M)', 'GMACs', 'knn GMACs', 'topk (G)', 'act (MB)'))
+    for entry in report['blocks']:
+        act = 'n/a' if entry['activation_mb'] is None else '{:.3f}'.format(entry['activation_mb'])
+        lines.append('{:<14}{:>12.3f}{:>12.4f}{:>12.4f}{:>12.4f}{:>14}'.format(
+            entry['name'], entry['params'] / 1e6, entry['macs'] / 1e9, entry['knn_macs'] / 1e9,
+            entry['topk_ops'] / 1e9, act))
+    return '\n'.join(lines)
+
+
+##############################
+#    Latency and memory instrumentation
+##############################
+
+
+class _StageTimer(object):
+    """Context manager charging the time spent inside it to one stage of an Instrumentation."""
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        self.instrumentation.push(self.stage)
+
+    def __exit__(self, *exc):
+        self.instrumentation.pop()
+
+
+def _rss_mb():
+    """Resident set size of this process in MB (None where /proc is not available)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class Instrumentation(object):
+    """
+    Opt-in forward timers and peak-memory sampling per block of a vig/pyramid_vig DeepGCN (see
+    profile_blocks), aggregated over n_batches forwards after skipping the first skip ones.
+
+    The time of every block is split into exclusive stages: knn (DenseDilatedKnnGraph), gather
+    (batched_index_select), graph_conv (the rest of the Grapher: fc1, aggregation MLP, fc2), ffn
+    (the FFN module) and other (the rest of the block, e.g. the stem or the head). CUDA is
+    synchronized at every stage boundary, so the stages add up to the block time but the run is
+    slower than an uninstrumented one. Peak memory is the peak of the torch allocator during the
+    block on CUDA and the resident set size after it on CPU.
+
+    Hooks and the gather timer are removed once n_batches are recorded (or by stop()), after which
+    the model runs exactly as before; while disabled batched_index_select only tests a global for
+    None. Only model forwards are timed: the replays of activation checkpointing in backward are
+    not. Not for nn.DataParallel, whose replicas run the hooks concurrently.
+    Args:
+        model: the DeepGCN (not a DDP or DataParallel wrapper)
+        n_batches: int, forwards to record
+        skip: int, warm-up forwards ignored first
+    """
+    stages = ('knn', 'gather', 'graph_conv', 'ffn', 'other')
+
+    def __init__(self, model, n_batches=20, skip=2):
+        self.model = model
+        self.n_batches = n_batches
+        self.skip = skip
+        self.device = next(model.parameters()).device
+        self.blocks = profile_blocks(model)
+        self.times = OrderedDict((name, OrderedDict((stage, 0.0) for stage in self.stages))
+                                 for name, _ in self.blocks)
+        self.peak_mb = OrderedDict((name, None) for name, _ in self.blocks)
+        self.batches = 0
+        self.recorded = 0
+        self.active = False
+        self.block = None
+        self.stack = []
+        self.handles = []
+
+    @property
+    def done(self):
+        return self.recorded >= self.n_batches
+
+    def start(self):
+        """Registers the hooks and the gather timer; returns self."""
+        self.handles.append(self.model.register_forward_pre_hook(lambda module, inputs: self._begin_batch()))
+        self.handles.append(self.model.register_forward_hook(lambda module, inputs, out: self._end_batch()))
+        for name, block in self.blocks:
+            self.handles.append(block.register_forward_pre_hook(
+                lambda module, inputs, name=name: self._enter_block(name)))
+            self.handles.append(block.register_forward_hook(lambda module, inputs, out: self._exit_block()))
+            for m in block.modules():
+                if isinstance(m, DenseDilatedKnnGraph):
+                    stage = 'knn'
+                elif isinstance(m, Grapher):
+                    stage = 'graph_conv'
+                elif type(m).__name__ == 'FFN':
+                    stage = 'ffn'
+                else:
+                    continue
+                self.handles.append(m.register_forward_pre_hook(
+                    lambda module, inputs, stage=stage: self.push(stage)))
+                self.handles.append(m.register_forward_hook(lambda module, inputs, out: self.pop()))
+        set_gather_timer(_StageTimer(self, 'gather'))
+        return self
+
+    def stop(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        set_gather_timer(None)
+        self.active = False
+
+    def _sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def _begin_batch(self):
+        self.active = self.batches >= self.skip
+        self.batches += 1
+        self.block = None
+        self.stack = []
+
+    def _end_batch(self):
+        if self.active:
+            self.recorded += 1
+            self.active = False
+            if self.done:
+                self.stop()
+
+    def _enter_block(self, name):
+        if not self.active:
+            return
+        self.block = name
+        if self.device.type == 'cuda':
+            self._sync()
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.push('other')
+
+    def _exit_block(self):
+        if not self.active or self.block is None:
+            return
+        self.pop()
+        if self.device.type == 'cuda':
+            peak = torch.cuda.max_memory_allocated(self.device) / 2**20
+        else:
+            peak = _rss_mb()
+        if peak is not None:
+            self.peak_mb[self.block] = max(self.peak_mb[self.block] or 0.0, peak)
+        self.block = None
+
+    def push(self, stage):
+        if not self.active or self.block is None:
+            return
+        self._sync()
+        self.stack.append([stage, time.perf_counter(), 0.0])
+
+    def pop(self):
+        if not self.active or self.block is None or not self.stack:
+            return
+        self._sync()
+        stage, start, children = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        self.times[self.block][stage] += elapsed - children
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def report(self):
+        """Per-block mean ms per recorded forward of every stage, their total and the peak memory (MB)."""
+        rows = []
+        count = max(self.recorded, 1)
+        for name, times in self.times.items():
+            row = OrderedDict([('block', name)])
+            for stage, seconds in times.items():
+                row[stage + '_ms'] = round(seconds * 1000 / count, 4)
+            row['total_ms'] = round(sum(times.values()) * 1000 / count, 4)
+            row['peak_mb'] = None if self.peak_mb[name] is None else round(self.peak_mb[name], 1)
+            rows.append(row)
+        return rows
+
+    def save(self, path):
+        """Writes report() to path, as CSV if it ends with .csv and as JSON otherwise."""
+        rows = self.report()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(path, 'w') as f:
+                json.dump(OrderedDict([('device', str(self.device)), ('batches', self.recorded),
+                                       ('blocks', rows)]), f, indent=1)
+        return rows
@@ -1,30 +1,59 @@
 # 2022.06.17-Changed for building ViG model
 #            Huawei Technologies Co., Ltd. <foss@huawei.com>
-import numpy as np
+import warnings
+from collections import OrderedDict
+
 import torch
 from torch import nn
-from .torch_nn import BasicConv, batched_index_select, act_layer
+from .torch_nn import BasicConv, batched_index_select, act_layer, max_relative, neighbor_max, csr_neighbor_sum, \
+    vertex_chunk, is_compiling
 from .torch_edge import DenseDilatedKnnGraph
-from .pos_embed import get_2d_relative_pos_embed
+from .pos_embed import get_relative_pos_table
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from timm.models.layers import DropPath
 
 
 class MRConv2d(nn.Module):
     """
     Max-Relative Graph Convolution (Paper: https://arxiv.org/abs/1904.03751) for dense data type
+
+    With chunk_budget (MB) the max-relative aggregation runs in vertex chunks and keeps only
+    the argmax for backward (see gcn_lib.max_relative) instead of the full neighbor gathers.
+    With copy_free the first grouped 1x1 conv reads x and x_j through the even and odd input
+    columns of its weight instead of a channel-interleaved copy of both (same state dict);
+    quantize_int8 turns it off for the int8 conv, which reads the interleaved copy.
     """
-    def __init__(self, in_channels, out_channels, act='relu', norm=None, bias=True):
+    def __init__(self, in_channels, out_channels, act='relu', norm=None, bias=True, chunk_budget=None):
         super(MRConv2d, self).__init__()
         self.nn = BasicConv([in_channels*2, out_channels], act, norm, bias)
+        self.chunk_budget = chunk_budget
+        self.copy_free = True
 
     def forward(self, x, edge_index, y=None):
-        x_i = batched_index_select(x, edge_index[1])
+        if self.chunk_budget is not None:
+            return self.update(x, max_relative(x, edge_index, y, self.chunk_budget))
         if y is not None:
             x_j = batched_index_select(y, edge_index[0])
         else:
             x_j = batched_index_select(x, edge_index[0])
-        x_j, _ = torch.max(x_j - x_i, -1, keepdim=True)
+        if edge_index.shape[0] > 1:
+            x_j, _ = torch.max(x_j - batched_index_select(x, edge_index[1]), -1, keepdim=True)
+        else:
+            # identity centers: max_j (x_j - x_i) = max_j x_j - x_i
+            x_j, _ = torch.max(x_j, -1, keepdim=True)
+            x_j = x_j - x
+        return self.update(x, x_j)
+
+    def update(self, x, x_j):
+        conv = self.nn[0]
+        if self.copy_free and type(conv) is nn.Conv2d and x.shape[1] % conv.groups == 0:
+            # the interleaved input [x_0, x_j0, x_1, x_j1, ...] meets the weight columns 0, 1, 2, 3, ...
+            out = F.conv2d(x, conv.weight[:, 0::2], conv.bias, groups=conv.groups)
+            out += F.conv2d(x_j, conv.weight[:, 1::2], None, groups=conv.groups)
+            for layer in list(self.nn)[1:]:
+                out = layer(out)
+            return out
         b, c, n, _ = x.shape
         x = torch.cat([x.unsqueeze(2), x_j.unsqueeze(2)], dim=2).reshape(b, 2 * c, n, _)
         return self.nn(x)
@@ -33,17 +62,94 @@ class MRConv2d(nn.Module):
 class EdgeConv2d(nn.Module):
     """
     Edge convolution layer (with activation, batch normalization) for dense data type
+
+    With chunk_budget (MB) the MLP and the max over k run one vertex chunk at a time, recomputed
+    in backward. A batch norm in training mode normalizes with the statistics of all edges: a
+    first pass over the chunks sums the pre-norm conv outputs, and the second one normalizes with
+    them. Both passes are differentiable, so the gradient through the batch statistics is exact.
+    Instance norm needs all edges of a sample at once and disables the chunking.
     """
-    def __init__(self, in_channels, out_channels, act='relu', norm=None, bias=True):
+    def __init__(self, in_channels, out_channels, act='relu', norm=None, bias=True, chunk_budget=None):
         super(EdgeConv2d, self).__init__()
         self.nn = BasicConv([in_channels * 2, out_channels], act, norm, bias)
+        self.out_channels = out_channels
+        self.chunk_budget = chunk_budget
+        self.batch_norm = any(isinstance(m, nn.BatchNorm2d) for m in self.nn.modules())
+        if chunk_budget is not None and any(isinstance(m, nn.InstanceNorm2d) for m in self.nn.modules()):
+            warnings.warn('EdgeConv2d: chunk_budget has no effect with instance norm')
+            self.chunk_budget = None
+
+    def edge_features(self, x, edge_index, y, start, end):
+        x_j = batched_index_select(x if y is None else y, edge_index[0, :, start:end])
+        if edge_index.shape[0] > 1:
+            x_i = batched_index_select(x, edge_index[1, :, start:end])
+        else:
+            x_i = x[:, :, start:end].expand_as(x_j)
+        return torch.cat([x_i, x_j - x_i], dim=1)
+
+    def chunk_forward(self, x, edge_index, y, start, end):
+        max_value, _ = torch.max(self.nn(self.edge_features(x, edge_index, y, start, end)), -1, keepdim=True)
+        return max_value
+
+    def chunk_moments(self, x, edge_index, y, start, end):
+        # per-channel sum and sum of squares of the pre-norm conv output, at least in float32
+        z = self.nn[0](self.edge_features(x, edge_index, y, start, end))
+        if z.element_size() < 4:
+            z = z.float()
+        return torch.stack([z.sum(dim=(0, 2, 3)), z.pow(2).sum(dim=(0, 2, 3))])
+
+    def chunk_forward_bn(self, x, edge_index, y, start, end, mean, invstd):
+        bn = self.nn[1]
+        z = self.nn[0](self.edge_features(x, edge_index, y, start, end))
+        z = (z - mean.view(1, -1, 1, 1)) * (invstd * bn.weight).view(1, -1, 1, 1) + bn.bias.view(1, -1, 1, 1)
+        for layer in list(self.nn)[2:]:
+            z = layer(z)
+        max_value, _ = torch.max(z, -1, keepdim=True)
+        return max_value
+
+    def run_chunks(self, fn, x, edge_index, y, *args):
+        b, c, n, _ = x.shape
+        k = edge_index.shape[-1]
+        per_vertex = b * k * (4 * c + 3 * self.out_channels) * x.element_size()
+        chunk = vertex_chunk(self.chunk_budget, per_vertex, n)
+        out = []
+        for start in range(0, n, chunk):
+            end = min(start + chunk, n)
+            if torch.is_grad_enabled():
+                out.append(checkpoint(fn, x, edge_index, y, start, end, *args, use_reentrant=False))
+            else:
+                out.append(fn(x, edge_index, y, start, end, *args))
+        return out
+
+    def batch_norm_chunks(self, x, edge_index, y):
+        bn = self.nn[1]
+        count = x.shape[0] * edge_index.shape[2] * edge_index.shape[3]
+        moments = sum(self.run_chunks(self.chunk_moments, x, edge_index, y)) / count
+        mean = moments[0]
+        var = (moments[1] - mean * mean).clamp(min=0)
+        if bn.track_running_stats:
+            # the update of nn.BatchNorm2d: momentum (or cumulative) average, unbiased variance
+            bn.num_batches_tracked += 1
+            momentum = bn.momentum if bn.momentum is not None else 1.0 / float(bn.num_batches_tracked)
+            with torch.no_grad():
+                bn.running_mean.mul_(1 - momentum).add_(mean.detach(), alpha=momentum)
+                bn.running_var.mul_(1 - momentum).add_(var.detach() * count / max(count - 1, 1), alpha=momentum)
+        invstd = torch.rsqrt(var + bn.eps)
+        return torch.cat(self.run_chunks(self.chunk_forward_bn, x, edge_index, y, mean, invstd), dim=2)
 
     def forward(self, x, edge_index, y=None):
-        x_i = batched_index_select(x, edge_index[1])
+        if self.chunk_budget is not None:
+            if self.training and self.batch_norm:
+                return self.batch_norm_chunks(x, edge_index, y)
+            return torch.cat(self.run_chunks(self.chunk_forward, x, edge_index, y), dim=2)
         if y is not None:
             x_j = batched_index_select(y, edge_index[0])
         else:
             x_j = batched_index_select(x, edge_index[0])
+        if edge_index.shape[0] > 1:
+            x_i = batched_index_select(x, edge_index[1])
+        else:
+            x_i = x.expand_as(x_j)
         max_value, _ = torch.max(self.nn(torch.cat([x_i, x_j - x_i], dim=1)), -1, keepdim=True)
         return max_value
 
@@ -85,20 +191,54 @@ class GINConv2d(nn.Module):
         return self.nn((1 + self.eps) * x + x_j)
 
 
+class GraphSAGEChunked(GraphSAGE):
+    """
+    GraphSAGE that applies nn1 to every key once and takes the max over the neighbors in vertex
+    chunks (see gcn_lib.neighbor_max) instead of through the B x C x N x k gather. Same parameters
+    and outputs as GraphSAGE: a norm of nn1 that needs the statistics of all edges (instance norm,
+    batch norm in training) runs the GraphSAGE gather instead.
+    """
+    def __init__(self, in_channels, out_channels, act='relu', norm=None, bias=True, chunk_budget=None):
+        super(GraphSAGEChunked, self).__init__(in_channels, out_channels, act, norm, bias)
+        self.chunk_budget = chunk_budget or 64
+        self.batch_norm = any(isinstance(m, nn.BatchNorm2d) for m in self.nn1.modules())
+        self.instance_norm = any(isinstance(m, nn.InstanceNorm2d) for m in self.nn1.modules())
+
+    def forward(self, x, edge_index, y=None):
+        if self.instance_norm or (self.training and self.batch_norm):
+            return super(GraphSAGEChunked, self).forward(x, edge_index, y)
+        x_j = neighbor_max(self.nn1(x if y is None else y), edge_index[0], self.chunk_budget)
+        return self.nn2(torch.cat([x, x_j], dim=1))
+
+
+class GINConv2dCSR(GINConv2d):
+    """
+    GINConv2d summing the neighbors with a block-diagonal int32 CSR adjacency (sparse-dense matmul)
+    """
+    def forward(self, x, edge_index, y=None):
+        x_j = csr_neighbor_sum(x if y is None else y, edge_index[0])
+        return self.nn((1 + self.eps) * x + x_j)
+
+
 class GraphConv2d(nn.Module):
     """
     Static graph convolution layer
     """
-    def __init__(self, in_channels, out_channels, conv='edge', act='relu', norm=None, bias=True):
+    def __init__(self, in_channels, out_channels, conv='edge', act='relu', norm=None, bias=True,
+                 chunk_budget=None):
         super(GraphConv2d, self).__init__()
         if conv == 'edge':
-            self.gconv = EdgeConv2d(in_channels, out_channels, act, norm, bias)
+            self.gconv = EdgeConv2d(in_channels, out_channels, act, norm, bias, chunk_budget)
         elif conv == 'mr':
-            self.gconv = MRConv2d(in_channels, out_channels, act, norm, bias)
+            self.gconv = MRConv2d(in_channels, out_channels, act, norm, bias, chunk_budget)
         elif conv == 'sage':
             self.gconv = GraphSAGE(in_channels, out_channels, act, norm, bias)
         elif conv == 'gin':
             self.gconv = GINConv2d(in_channels, out_channels, act, norm, bias)
+        elif conv == 'sage_chunked':
+            self.gconv = GraphSAGEChunked(in_channels, out_channels, act, norm, bias, chunk_budget)
+        elif conv == 'gin_csr':
+            self.gconv = GINConv2dCSR(in_channels, out_channels, act, norm, bias)
         else:
             raise NotImplementedError('conv:{} is not supported'.format(conv))
 
@@ -111,12 +251,13 @@ class DyGraphConv2d(GraphConv2d):
     Dynamic graph convolution layer
     """
     def __init__(self, in_channels, out_channels, kernel_size=9, dilation=1, conv='edge', act='relu',
-                 norm=None, bias=True, stochastic=False, epsilon=0.0, r=1):
-        super(DyGraphConv2d, self).__init__(in_channels, out_channels, conv, act, norm, bias)
+                 norm=None, bias=True, stochastic=False, epsilon=0.0, r=1, knn_args=None, chunk_budget=None):
+        super(DyGraphConv2d, self).__init__(in_channels, out_channels, conv, act, norm, bias, chunk_budget)
         self.k = kernel_size
         self.d = dilation
         self.r = r
-        self.dilated_knn_graph = DenseDilatedKnnGraph(kernel_size, dilation, stochastic, epsilon)
+        self.dilated_knn_graph = DenseDilatedKnnGraph(kernel_size, dilation, stochastic, epsilon,
+                                                      **(knn_args or {}))
 
     def forward(self, x, relative_pos=None):
         B, C, H, W = x.shape
@@ -125,17 +266,60 @@ class DyGraphConv2d(GraphConv2d):
             y = F.avg_pool2d(x, self.r, self.r)
             y = y.reshape(B, C, -1, 1).contiguous()            
         x = x.reshape(B, C, -1, 1).contiguous()
-        edge_index = self.dilated_knn_graph(x, y, relative_pos)
+        # pruned node sets (B, C, N, 1) are no grid, so the window backend falls back to exact knn
+        hw = (H, W) if W > 1 else None
+        context = self.dilated_knn_graph.context
+        node_masks = None if context is None else context.node_masks(H, W, self.r)
+        edge_index = self.dilated_knn_graph(x, y, relative_pos, hw, node_masks)
         x = super(DyGraphConv2d, self).forward(x, edge_index, y)
         return x.reshape(B, -1, H, W).contiguous()
 
 
+class RelativePosCache(object):
+    """
+    Bounded LRU cache of the relative position tables of the Grapher blocks, generated on the
+    device of the features for every node grid. Keys are (channels, n, r, H, W, device, dtype),
+    so a cache shared by the blocks of a model holds one table per stage shape.
+    """
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.tables = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        if is_compiling():
+            # plain lookup without the LRU bookkeeping, which torch.compile cannot trace; a missing
+            # table is still stored so that it becomes a constant of the next graphs
+            table = self.tables.get(key)
+            if table is None:
+                table = self.tables[key] = build()
+            return table
+        if key in self.tables:
+            self.hits += 1
+            self.tables.move_to_end(key)
+            return self.tables[key]
+        self.misses += 1
+        table = build()
+        self.tables[key] = table
+        while len(self.tables) > self.max_entries:
+            self.tables.popitem(last=False)
+        return table
+
+    def clear(self):
+        self.tables.clear()
+
+    def stats(self):
+        return {'entries': len(self.tables), 'hits': self.hits, 'misses': self.misses}
+
+
 class Grapher(nn.Module):
     """
     Grapher module with graph convolution and fc layers
     """
     def __init__(self, in_channels, kernel_size=9, dilation=1, conv='edge', act='relu', norm=None,
-                 bias=True,  stochastic=False, epsilon=0.0, r=1, n=196, drop_path=0.0, relative_pos=False):
+                 bias=True,  stochastic=False, epsilon=0.0, r=1, n=196, drop_path=0.0, relative_pos=False,
+                 knn_args=None, chunk_budget=None):
         super(Grapher, self).__init__()
         self.channels = in_channels
         self.n = n
@@ -145,35 +329,98 @@ class Grapher(nn.Module):
             nn.BatchNorm2d(in_channels),
         )
         self.graph_conv = DyGraphConv2d(in_channels, in_channels * 2, kernel_size, dilation, conv,
-                              act, norm, bias, stochastic, epsilon, r)
+                              act, norm, bias, stochastic, epsilon, r, knn_args, chunk_budget)
         self.fc2 = nn.Sequential(
             nn.Conv2d(in_channels * 2, in_channels, 1, stride=1, padding=0),
             nn.BatchNorm2d(in_channels),
         )
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
-        self.relative_pos = None
+        self.relative_pos = relative_pos
+        self.relative_pos_cache = None
         if relative_pos:
             print('using relative_pos')
-            relative_pos_tensor = torch.from_numpy(np.float32(get_2d_relative_pos_embed(in_channels,
-                int(n**0.5)))).unsqueeze(0).unsqueeze(1)
-            relative_pos_tensor = F.interpolate(
-                    relative_pos_tensor, size=(n, n//(r*r)), mode='bicubic', align_corners=False)
-            self.relative_pos = nn.Parameter(-relative_pos_tensor.squeeze(1), requires_grad=False)
-
-    def _get_relative_pos(self, relative_pos, H, W):
-        if relative_pos is None or H * W == self.n:
-            return relative_pos
-        else:
-            N = H * W
-            N_reduced = N // (self.r * self.r)
-            return F.interpolate(relative_pos.unsqueeze(0), size=(N, N_reduced), mode="bicubic").squeeze(0)
+            # the fixed tables are generated on the feature device at the first forward
+            self.relative_pos_cache = RelativePosCache()
+
+    def _get_relative_pos(self, H, W, device, dtype):
+        if not self.relative_pos:
+            return None
+        key = (self.channels, self.n, self.r, H, W, device, dtype)
+        return self.relative_pos_cache.get(
+            key, lambda: get_relative_pos_table(self.channels, self.n, self.r, (H, W), device, dtype))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints stored the relative position table as a frozen parameter
+        state_dict.pop(prefix + 'relative_pos', None)
+        super(Grapher, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
         _tmp = x
         x = self.fc1(x)
         B, C, H, W = x.shape
-        relative_pos = self._get_relative_pos(self.relative_pos, H, W)
+        # the table stays float32 under autocast
+        dtype = torch.float32 if torch.is_autocast_enabled() else x.dtype
+        relative_pos = self._get_relative_pos(H, W, x.device, dtype)
         x = self.graph_conv(x, relative_pos)
         x = self.fc2(x)
         x = self.drop_path(x) + _tmp
         return x
+
+
+def share_knn_graphs(graphers, interval, context):
+    """
+    Reuse the KNN graph of every interval-th Grapher in the following interval - 1 Graphers.
+
+    The first block of each group computes a top-(k * dilation) list wide enough for the whole
+    group; the others slice it to their own k * dilation before dilating. With the nndescent
+    backend every group leader is seeded with the list of the previous leader, and all leaders
+    keep a list as wide as the widest graph of the stage so that the seed always covers k.
+    Every graph is attached to context, which also carries the node mask of the current forward;
+    only the graphs that a later block reads are stored in it.
+    Args:
+        graphers: consecutive Grapher blocks with the same node and key sets (one stage)
+        interval: int, number of blocks sharing one graph (1: no reuse)
+        context: GraphContext holding the shared neighbor lists and the node mask
+    """
+    knn_graphs = [grapher.graph_conv.dilated_knn_graph for grapher in graphers]
+    for knn_graph in knn_graphs:
+        knn_graph.context = context
+    descent = any(knn_graph.knn == 'nndescent' for knn_graph in knn_graphs)
+    if interval <= 1 and not descent:
+        return
+    interval = max(interval, 1)
+    leaders = []
+    for start in range(0, len(knn_graphs), interval):
+        group = knn_graphs[start:start + interval]
+        for knn_graph in group:
+            knn_graph.graph_id = context.new_id()
+            knn_graph.source_id = group[0].graph_id
+        group[0].source_id = None
+        group[0].store_graph = len(group) > 1
+        group[0].knn_width = max(knn_graph.k * knn_graph.dilation for knn_graph in group)
+        leaders.append(group[0])
+    if descent:
+        width = max(knn_graph.k * knn_graph.dilation for knn_graph in knn_graphs)
+        for previous, leader in zip([None] + leaders[:-1], leaders):
+            leader.seed_id = None if previous is None else previous.graph_id
+            leader.knn_width = width
+            if previous is not None:
+                previous.store_graph = True
+
+
+def record_knn_graphs(blocks, edges):
+    """
+    Forward hooks storing the neighbor list (edge_index) of the KNN graph of every block into edges.
+    Args:
+        blocks: iterable of (key, module), e.g. enumerate(model.backbone)
+        edges: dict filled with {key: edge_index} at every forward
+    Returns:
+        the hook handles, to be removed by the caller
+    """
+    handles = []
+    for key, block in blocks:
+        for module in block.modules():
+            if isinstance(module, DenseDilatedKnnGraph):
+                handles.append(module.register_forward_hook(
+                    lambda module, inputs, output, key=key: edges.__setitem__(key, output)))
+    return handles
@@ -7,13 +7,14 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Sequential as Seq
+from torch.utils.checkpoint import checkpoint
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.models.helpers import load_pretrained
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 from timm.models.registry import register_model
 
-from gcn_lib import Grapher, act_layer
+from gcn_lib import Grapher, act_layer, GraphContext, RelativePosCache, record_knn_graphs, share_knn_graphs
 
 
 def _cfg(url='', **kwargs):
@@ -112,6 +113,11 @@ class DeepGCN(torch.nn.Module):
         conv = opt.conv
         emb_dims = opt.emb_dims
         drop_path = opt.drop_path
+        knn_args = dict(opt.knn_args, knn=opt.knn)
+        if opt.exit_blocks:
+            raise NotImplementedError('exit_blocks:{} is not supported by pyramid_vig'.format(opt.exit_blocks))
+        if opt.prune_blocks:
+            raise NotImplementedError('prune_blocks:{} is not supported by pyramid_vig'.format(opt.prune_blocks))
         
         blocks = opt.blocks
         self.n_blocks = sum(blocks)
@@ -119,27 +125,49 @@ class DeepGCN(torch.nn.Module):
         reduce_ratios = [4, 2, 1, 1]
         dpr = [x.item() for x in torch.linspace(0, drop_path, self.n_blocks)]  # stochastic depth decay rule 
         num_knn = [int(x.item()) for x in torch.linspace(k, k, self.n_blocks)]  # number of knn's k
-        max_dilation = 49 // max(num_knn)
+        h, w = to_2tuple(opt.img_size)
+        grids = []
+        for i in range(1 + len(blocks)):  # the two stem convs and every Downsample halve the resolution
+            h, w = (h + 1) // 2, (w + 1) // 2
+            grids.append((h, w))
+        grids = grids[1:]
+        max_dilation = max(1, grids[-1][0] * grids[-1][1] // max(num_knn))
         
         self.stem = Stem(out_dim=channels[0], act=act)
-        self.pos_embed = nn.Parameter(torch.zeros(1, channels[0], 224//4, 224//4))
-        HW = 224 // 4 * 224 // 4
+        self.pos_embed = nn.Parameter(torch.zeros(1, channels[0], grids[0][0], grids[0][1]))
+        self._pos_embed_cache = {}
+
+        graph_reuse = list(opt.graph_reuse) if isinstance(opt.graph_reuse, (list, tuple)) else [opt.graph_reuse]
+        if len(graph_reuse) == 1:
+            graph_reuse = graph_reuse * len(blocks)
+        if len(graph_reuse) != len(blocks):
+            raise NotImplementedError('graph_reuse:{} needs one value or one per stage ({} stages)'.format(
+                opt.graph_reuse, len(blocks)))
+        self.graph_context = GraphContext()
+        self.relative_pos_cache = RelativePosCache()
 
         self.backbone = nn.ModuleList([])
+        self.stage_ends = []  # backbone index of the last block of every stage
         idx = 0
         for i in range(len(blocks)):
             if i > 0:
                 self.backbone.append(Downsample(channels[i-1], channels[i]))
-                HW = HW // 4
+            HW = grids[i][0] * grids[i][1]
+            stage_start = len(self.backbone)
             for j in range(blocks[i]):
                 self.backbone += [
                     Seq(Grapher(channels[i], num_knn[idx], min(idx // 4 + 1, max_dilation), conv, act, norm,
                                     bias, stochastic, epsilon, reduce_ratios[i], n=HW, drop_path=dpr[idx],
-                                    relative_pos=True),
+                                    relative_pos=True, knn_args=knn_args, chunk_budget=opt.chunk_budget),
                           FFN(channels[i], channels[i] * 4, act=act, drop_path=dpr[idx])
                          )]
                 idx += 1
+            share_knn_graphs([block[0] for block in self.backbone[stage_start:]], graph_reuse[i], self.graph_context)
+            for block in self.backbone[stage_start:]:
+                block[0].relative_pos_cache = self.relative_pos_cache
+            self.stage_ends.append(len(self.backbone) - 1)
         self.backbone = Seq(*self.backbone)
+        self.checkpoint_blocks = set()
 
         self.prediction = Seq(nn.Conv2d(channels[-1], 1024, 1, bias=True),
                               nn.BatchNorm2d(1024),
@@ -157,34 +185,131 @@ class DeepGCN(torch.nn.Module):
                     m.bias.data.zero_()
                     m.bias.requires_grad = True
 
-    def forward(self, inputs):
-        x = self.stem(inputs) + self.pos_embed
+    def set_grad_checkpointing(self, enable=True, blocks=None):
+        """Recompute the activations of the backbone entries in blocks (default: all) in backward."""
+        self.checkpoint_blocks = set(range(len(self.backbone)) if blocks is None else blocks) if enable else set()
+
+    def _run_block(self, i, x, node_mask):
+        # the replay in backward restores the node mask this block saw in forward
+        self.graph_context.node_mask = node_mask
+        return self.backbone[i](x)
+
+    def get_pos_embed(self, H, W):
+        """pos_embed interpolated to an H x W node grid, cached per resolution in inference"""
+        if (H, W) == tuple(self.pos_embed.shape[2:]):
+            return self.pos_embed
+        if torch.is_grad_enabled():
+            return F.interpolate(self.pos_embed, size=(H, W), mode='bicubic', align_corners=False)
+        key = (H, W, self.pos_embed.device, self.pos_embed.dtype, self.pos_embed._version)
+        if key not in self._pos_embed_cache:
+            if len(self._pos_embed_cache) >= 4:
+                self._pos_embed_cache.clear()
+            self._pos_embed_cache[key] = F.interpolate(self.pos_embed, size=(H, W), mode='bicubic',
+                                                       align_corners=False)
+        return self._pos_embed_cache[key]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of another resolution: resize pos_embed to the grid of this model
+        pos_embed = state_dict.get(prefix + 'pos_embed')
+        if pos_embed is not None and pos_embed.shape != self.pos_embed.shape:
+            state_dict[prefix + 'pos_embed'] = F.interpolate(pos_embed, size=self.pos_embed.shape[2:],
+                                                             mode='bicubic', align_corners=False)
+        super(DeepGCN, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward_features(self, inputs, stages=None, return_nodes=False, return_edges=False, node_mask=None):
+        """
+        Backbone embeddings without the prediction head; stages after the last requested one are not run.
+        Args:
+            inputs: (B, 3, H, W) images
+            stages: stage indices (0 to 3) whose outputs are returned (default: the last stage)
+            return_nodes: also return the node features (B, C, H, W) of these stages
+            return_edges: also return the KNN edge_index (1, B, N, k) of every block up to the last
+                requested stage, keyed by backbone index
+            node_mask: see forward
+        Returns:
+            dict with 'pooled' {stage: (B, C)} and, if requested, 'nodes' {stage: features} and 'edges' {block: edge_index}
+        """
+        stages = [len(self.stage_ends) - 1] if stages is None else sorted(stages)
+        ends = {self.stage_ends[stage]: stage for stage in stages}
+        last = self.stage_ends[stages[-1]]
+        features = {'pooled': {}}
+        if return_nodes:
+            features['nodes'] = {}
+        handles = []
+        if return_edges:
+            features['edges'] = {}
+            handles = record_knn_graphs(enumerate(self.backbone[:last + 1]), features['edges'])
+        x = self.stem(inputs)
         B, C, H, W = x.shape
-        for i in range(len(self.backbone)):
-            x = self.backbone[i](x)
+        x = x + self.get_pos_embed(H, W)
+        self.graph_context.node_mask = node_mask
+        for i, block in enumerate(self.backbone[:last + 1]):
+            x = block(x)
+            if i in ends:
+                features['pooled'][ends[i]] = F.adaptive_avg_pool2d(x, 1).flatten(1)
+                if return_nodes:
+                    features['nodes'][ends[i]] = x
+        self.graph_context.node_mask = None
+        for handle in handles:
+            handle.remove()
+        return features
+
+    def forward(self, inputs, node_mask=None):
+        """
+        Args:
+            inputs: (B, 3, H, W) images
+            node_mask: (B, 1, h, w) mask of the image content (e.g. the unpadded part of a square crop)
+                at any resolution, or None. It is pooled to the grid of every stage and masked nodes
+                are no KNN candidates of the valid ones.
+        """
+        x = self.stem(inputs)
+        B, C, H, W = x.shape
+        x = x + self.get_pos_embed(H, W)
+        self.graph_context.node_mask = node_mask
+        for i, block in enumerate(self.backbone):
+            if i in self.checkpoint_blocks and torch.is_grad_enabled():
+                x = checkpoint(self._run_block, i, x, node_mask, use_reentrant=False)
+            else:
+                x = block(x)
+        self.graph_context.node_mask = None
 
         x = F.adaptive_avg_pool2d(x, 1)
         return self.prediction(x).squeeze(-1).squeeze(-1)
 
 
+class _OptInit(object):
+    """Options shared by the pyramid_vig factories; every factory sets the size of its stages on top."""
+    def __init__(self, num_classes=1000, drop_path_rate=0.0, knn='exact', knn_args=None,
+                 graph_reuse=1, chunk_budget=None, conv='mr', img_size=224, exit_blocks=None,
+                 prune_blocks=None, **kwargs):
+        self.k = 9 # neighbor num (default:9)
+        self.conv = conv # graph conv layer {edge, mr, sage, gin, sage_chunked, gin_csr}
+        self.img_size = img_size # input resolution the model is built for, int or (H, W)
+        self.exit_blocks = exit_blocks # early-exit heads are not implemented for pyramid_vig (must be None)
+        self.prune_blocks = prune_blocks # node pruning is not implemented for pyramid_vig (must be None)
+        self.act = 'gelu' # activation layer {relu, prelu, leakyrelu, gelu, hswish}
+        self.norm = 'batch' # batch or instance normalization {batch, instance}
+        self.bias = True # bias of conv layer True or False
+        self.dropout = 0.0 # dropout rate
+        self.use_dilation = True # use dilated knn or not
+        self.epsilon = 0.2 # stochastic epsilon for gcn
+        self.use_stochastic = False # stochastic for gcn, True or False
+        self.drop_path = drop_path_rate
+        self.knn = knn # knn backend {exact, cosine, lsh, window, nndescent}
+        self.knn_args = knn_args or {} # extra DenseDilatedKnnGraph options, e.g. {'tile_size': 512}
+        self.graph_reuse = graph_reuse # blocks sharing one KNN graph, int or one per stage (1: no reuse)
+        self.chunk_budget = chunk_budget # MB per vertex chunk of the memory-efficient edge, mr and sage_chunked convs (None: off)
+        self.n_classes = num_classes # Dimension of out_channels
+        self.emb_dims = 1024 # Dimension of embeddings
+
+
 @register_model
 def pvig_ti_224_gelu(pretrained=False, **kwargs):
-    class OptInit:
-        def __init__(self, num_classes=1000, drop_path_rate=0.0, **kwargs):
-            self.k = 9 # neighbor num (default:9)
-            self.conv = 'mr' # graph conv layer {edge, mr}
-            self.act = 'gelu' # activation layer {relu, prelu, leakyrelu, gelu, hswish}
-            self.norm = 'batch' # batch or instance normalization {batch, instance}
-            self.bias = True # bias of conv layer True or False
-            self.dropout = 0.0 # dropout rate
-            self.use_dilation = True # use dilated knn or not
-            self.epsilon = 0.2 # stochastic epsilon for gcn
-            self.use_stochastic = False # stochastic for gcn, True or False
-            self.drop_path = drop_path_rate
+    class OptInit(_OptInit):
+        def __init__(self, **kwargs):
+            super(OptInit, self).__init__(**kwargs)
             self.blocks = [2,2,6,2] # number of basic blocks in the backbone
             self.channels = [48, 96, 240, 384] # number of channels of deep features
-            self.n_classes = num_classes # Dimension of out_channels
-            self.emb_dims = 1024 # Dimension of embeddings
 
     opt = OptInit(**kwargs)
     model = DeepGCN(opt)
@@ -194,22 +319,11 @@ def pvig_ti_224_gelu(pretrained=False, **kwargs):
 
 @register_model
 def pvig_s_224_gelu(pretrained=False, **kwargs):
-    class OptInit:
-        def __init__(self, num_classes=1000, drop_path_rate=0.0, **kwargs):
-            self.k = 9 # neighbor num (default:9)
-            self.conv = 'mr' # graph conv layer {edge, mr}
-            self.act = 'gelu' # activation layer {relu, prelu, leakyrelu, gelu, hswish}
-            self.norm = 'batch' # batch or instance normalization {batch, instance}
-            self.bias = True # bias of conv layer True or False
-            self.dropout = 0.0 # dropout rate
-            self.use_dilation = True # use dilated knn or not
-            self.epsilon = 0.2 # stochastic epsilon for gcn
-            self.use_stochastic = False # stochastic for gcn, True or False
-            self.drop_path = drop_path_rate
+    class OptInit(_OptInit):
+        def __init__(self, **kwargs):
+            super(OptInit, self).__init__(**kwargs)
             self.blocks = [2,2,6,2] # number of basic blocks in the backbone
             self.channels = [80, 160, 400, 640] # number of channels of deep features
-            self.n_classes = num_classes # Dimension of out_channels
-            self.emb_dims = 1024 # Dimension of embeddings
 
     opt = OptInit(**kwargs)
     model = DeepGCN(opt)
@@ -219,22 +333,11 @@ def pvig_s_224_gelu(pretrained=False, **kwargs):
 
 @register_model
 def pvig_m_224_gelu(pretrained=False, **kwargs):
-    class OptInit:
-        def __init__(self, num_classes=1000, drop_path_rate=0.0, **kwargs):
-            self.k = 9 # neighbor num (default:9)
-            self.conv = 'mr' # graph conv layer {edge, mr}
-            self.act = 'gelu' # activation layer {relu, prelu, leakyrelu, gelu, hswish}
-            self.norm = 'batch' # batch or instance normalization {batch, instance}
-            self.bias = True # bias of conv layer True or False
-            self.dropout = 0.0 # dropout rate
-            self.use_dilation = True # use dilated knn or not
-            self.epsilon = 0.2 # stochastic epsilon for gcn
-            self.use_stochastic = False # stochastic for gcn, True or False
-            self.drop_path = drop_path_rate
+    class OptInit(_OptInit):
+        def __init__(self, **kwargs):
+            super(OptInit, self).__init__(**kwargs)
             self.blocks = [2,2,16,2] # number of basic blocks in the backbone
             self.channels = [96, 192, 384, 768] # number of channels of deep features
-            self.n_classes = num_classes # Dimension of out_channels
-            self.emb_dims = 1024 # Dimension of embeddings
 
     opt = OptInit(**kwargs)
     model = DeepGCN(opt)
@@ -244,22 +347,11 @@ def pvig_m_224_gelu(pretrained=False, **kwargs):
 
 @register_model
 def pvig_b_224_gelu(pretrained=False, **kwargs):
-    class OptInit:
-        def __init__(self, num_classes=1000, drop_path_rate=0.0, **kwargs):
-            self.k = 9 # neighbor num (default:9)
-            self.conv = 'mr' # graph conv layer {edge, mr}
-            self.act = 'gelu' # activation layer {relu, prelu, leakyrelu, gelu, hswish}
-            self.norm = 'batch' # batch or instance normalization {batch, instance}
-            self.bias = True # bias of conv layer True or False
-            self.dropout = 0.0 # dropout rate
-            self.use_dilation = True # use dilated knn or not
-            self.epsilon = 0.2 # stochastic epsilon for gcn
-            self.use_stochastic = False # stochastic for gcn, True or False
-            self.drop_path = drop_path_rate
+    class OptInit(_OptInit):
+        def __init__(self, **kwargs):
+            super(OptInit, self).__init__(**kwargs)
             self.blocks = [2,2,18,2] # number of basic blocks in the backbone
             self.channels = [128, 256, 512, 1024] # number of channels of deep features
-            self.n_classes = num_classes # Dimension of out_channels
-            self.emb_dims = 1024 # Dimension of embeddings
 
     opt = OptInit(**kwargs)
     model = DeepGCN(opt)
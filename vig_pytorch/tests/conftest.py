@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts import gcn_lib, vig and pyramid_vig from the vig_pytorch directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,78 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('timm')
+
+from gcn_lib import MRConv2d, compile_model, fold_batch_norms, fuse_conv_bn, optimize_for_inference, quantize_int8
+import vig
+
+
+def _images(batch_size, size, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(batch_size, 3, size, size, generator=generator)
+
+
+def _randomize_batch_norms(module, seed=2):
+    generator = torch.Generator().manual_seed(seed)
+    for m in module.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.copy_(torch.randn(m.running_mean.shape, generator=generator))
+            m.running_var.copy_(torch.rand(m.running_var.shape, generator=generator) + 0.5)
+            m.weight.data.copy_(torch.rand(m.weight.shape, generator=generator) + 0.5)
+            m.bias.data.copy_(torch.randn(m.bias.shape, generator=generator))
+
+
+@pytest.mark.parametrize('groups, bias', [(1, True), (4, False)])
+def test_fuse_conv_bn_matches_conv_then_bn(groups, bias):
+    conv = torch.nn.Conv2d(8, 16, 3, padding=1, groups=groups, bias=bias).double()
+    bn = torch.nn.BatchNorm2d(16).double()
+    _randomize_batch_norms(bn)
+    bn.eval()
+    x = torch.randn(2, 8, 5, 5, dtype=torch.float64)
+    with torch.no_grad():
+        torch.testing.assert_close(fuse_conv_bn(conv, bn)(x), bn(conv(x)))
+
+
+def test_fold_batch_norms_keeps_vig_outputs():
+    torch.manual_seed(0)
+    model = vig.vig_ti_224_gelu(num_classes=10, img_size=64).double()
+    _randomize_batch_norms(model)
+    model.eval()
+    optimized = optimize_for_inference(model, log_info=False)
+    assert fold_batch_norms(optimized) == 0
+    n_batch_norms = sum(isinstance(m, torch.nn.BatchNorm2d) for m in model.modules())
+    assert sum(isinstance(m, torch.nn.BatchNorm2d) for m in optimized.modules()) < n_batch_norms
+    images = _images(2, 64).double()
+    with torch.no_grad():
+        diff = (optimized(images) - model(images)).abs().max().item()
+    assert diff < 1e-5
+
+
+@pytest.mark.skipif('fbgemm' not in torch.backends.quantized.supported_engines, reason='needs fbgemm')
+def test_quantize_int8_agrees_with_float_model():
+    torch.manual_seed(0)
+    model = vig.vig_ti_224_gelu(num_classes=10, img_size=64).eval()
+    images = _images(16, 64)
+    quantized = quantize_int8(model, [images[:8], images[8:]])
+    assert all(not m.copy_free for m in quantized.modules() if isinstance(m, MRConv2d))
+    with torch.no_grad():
+        ref = model(images)
+        out = quantized(images)
+    assert out.shape == ref.shape == (16, 10)
+    assert out.dtype == torch.float32
+    agreement = (out.argmax(1) == ref.argmax(1)).float().mean().item()
+    assert agreement >= 0.75
+
+
+@pytest.mark.skipif(not hasattr(torch, 'compile'), reason='needs torch >= 2.0')
+def test_compiled_model_keeps_state_dict_and_outputs():
+    torch.manual_seed(0)
+    model = vig.vig_ti_224_gelu(num_classes=10, img_size=64).eval()
+    keys = list(model.state_dict())
+    images = _images(2, 64)
+    with torch.no_grad():
+        ref = model(images)
+        compile_model(model)
+        out = model(images)
+    assert list(model.state_dict()) == keys
+    torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
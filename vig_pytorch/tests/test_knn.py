@@ -0,0 +1,241 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+F = torch.nn.functional
+
+from gcn_lib import DenseDilated, DenseDilatedKnnGraph, GraphContext, Grapher, cosine_knn_matrix, dense_knn_matrix, \
+    lsh_knn_matrix, lsh_rotations, neighbor_overlap, nn_descent_knn_matrix, share_knn_graphs, window_candidates, window_knn_matrix, window_shape, \
+    xy_dense_knn_matrix, xy_pairwise_distance
+from gcn_lib import torch_edge
+
+
+def _features(batch_size, channels, n_points, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(batch_size, channels, n_points, 1, generator=generator, dtype=torch.float64)
+
+
+def _relative_pos(n_points, n_keys, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.rand(1, n_points, n_keys, generator=generator, dtype=torch.float64)
+
+
+def _clustered_features(batch_size, channels, n_clusters, cluster_size, noise=0.05, seed=0):
+    # l2-normalized points around n_clusters random directions, in random order
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn(batch_size, channels, n_clusters, 1, generator=generator, dtype=torch.float64)
+    x = centers.repeat_interleave(cluster_size, dim=2)
+    x = x + noise * torch.randn(x.shape, generator=generator, dtype=torch.float64)
+    x = x[:, :, torch.randperm(x.shape[2], generator=generator)]
+    return F.normalize(x, dim=1)
+
+
+def _distinct(nn_idx):
+    sorted_idx = nn_idx.sort(dim=-1)[0]
+    return (sorted_idx[..., 1:] != sorted_idx[..., :-1]).all()
+
+
+def _same_neighbors(a, b):
+    assert a.shape == b.shape
+    assert torch.equal(a.sort(dim=-1)[0], b.sort(dim=-1)[0])
+
+
+@pytest.mark.parametrize('n_points, tile_size, k', [(50, 16, 9), (196, 64, 9), (196, 1024, 18), (300, 7, 5)])
+@pytest.mark.parametrize('with_relative_pos', [False, True])
+def test_tiled_knn_matches_full_distance_matrix(n_points, tile_size, k, with_relative_pos):
+    x = _features(2, 24, n_points)
+    relative_pos = _relative_pos(n_points, n_points) if with_relative_pos else None
+    full = dense_knn_matrix(x, k, relative_pos, tile_size=None)
+    tiled = dense_knn_matrix(x, k, relative_pos, tile_size=tile_size)
+    _same_neighbors(tiled, full)
+
+
+@pytest.mark.parametrize('n_points, r, tile_size, k', [(196, 2, 16, 9), (784, 4, 32, 9), (256, 2, 1024, 18)])
+@pytest.mark.parametrize('with_relative_pos', [False, True])
+def test_tiled_xy_knn_matches_full_distance_matrix(n_points, r, tile_size, k, with_relative_pos):
+    x = _features(2, 24, n_points)
+    side = int(n_points ** 0.5)
+    y = F.avg_pool2d(x.view(2, 24, side, side), r).reshape(2, 24, -1, 1)
+    relative_pos = _relative_pos(n_points, y.shape[2]) if with_relative_pos else None
+    full = xy_dense_knn_matrix(x, y, k, relative_pos, tile_size=None)
+    tiled = xy_dense_knn_matrix(x, y, k, relative_pos, tile_size=tile_size)
+    _same_neighbors(tiled, full)
+
+
+@pytest.mark.parametrize('k, dilation', [(9, 1), (9, 2), (5, 3)])
+@pytest.mark.parametrize('reduce', [1, 2])
+def test_dilated_knn_graph_tiled_matches_full(k, dilation, reduce):
+    x = _features(2, 16, 196)
+    y = None if reduce == 1 else F.avg_pool2d(x.view(2, 16, 14, 14), reduce).reshape(2, 16, -1, 1)
+    relative_pos = _relative_pos(196, 196 if y is None else y.shape[2])
+    full = DenseDilatedKnnGraph(k, dilation, tile_size=None).eval()(x, y, relative_pos)
+    tiled = DenseDilatedKnnGraph(k, dilation, tile_size=16).eval()(x, y, relative_pos)
+    _same_neighbors(tiled, full)
+
+
+@pytest.mark.parametrize('tile_size', [16, 1024])
+@pytest.mark.parametrize('reduce', [1, 2])
+@pytest.mark.parametrize('with_relative_pos', [False, True])
+def test_cosine_ranking_matches_distance_ranking(tile_size, reduce, with_relative_pos):
+    x = F.normalize(_features(2, 24, 196), dim=1)
+    y = None if reduce == 1 else F.normalize(F.avg_pool2d(x.view(2, 24, 14, 14), reduce).reshape(2, 24, -1, 1), dim=1)
+    n_keys = 196 if y is None else y.shape[2]
+    relative_pos = _relative_pos(196, n_keys) if with_relative_pos else None
+    if y is None:
+        reference = dense_knn_matrix(x, 9, relative_pos, tile_size=None)
+    else:
+        reference = xy_dense_knn_matrix(x, y, 9, relative_pos, tile_size=None)
+    scored = cosine_knn_matrix(x, y, 9, relative_pos, tile_size=tile_size)
+    # same ranking, not only the same set
+    assert torch.equal(scored, reference)
+
+
+@pytest.mark.parametrize('with_relative_pos', [False, True])
+def test_low_precision_cosine_reranks_in_float32(with_relative_pos):
+    x = F.normalize(_features(2, 48, 784), dim=1).float()
+    relative_pos = _relative_pos(784, 784).float() if with_relative_pos else None
+    reference = dense_knn_matrix(x, 9, relative_pos, tile_size=None)
+    scored = cosine_knn_matrix(x, None, 9, relative_pos, low_precision=True, tile_size=256)
+    assert scored.shape == reference.shape
+    # half precision scores only pick the 2k candidates: almost all true neighbors survive
+    assert neighbor_overlap(scored[0], reference[0]).mean().item() > 0.95
+    # and the float32 re-rank orders them by their exact distance
+    points = x.squeeze(-1).transpose(2, 1)
+    dist = xy_pairwise_distance(points, points)
+    if relative_pos is not None:
+        dist = dist + relative_pos
+    picked = torch.gather(dist, 2, scored[0])
+    assert torch.all(picked[..., 1:] >= picked[..., :-1] - 1e-5)
+
+
+@pytest.mark.parametrize('interval, knn, n_stored', [(1, 'exact', 0), (2, 'exact', 2), (3, 'exact', 1),
+                                                     (4, 'exact', 1), (1, 'nndescent', 3), (2, 'nndescent', 2)])
+def test_share_knn_graphs_stores_only_graphs_read_later(interval, knn, n_stored):
+    graphers = [Grapher(16, 4, knn_args={'knn': knn}).eval() for _ in range(4)]
+    context = GraphContext()
+    share_knn_graphs(graphers, interval, context)
+    x = torch.randn(2, 16, 8, 8)
+    with torch.no_grad():
+        for grapher in graphers:
+            x = grapher(x)
+    assert len(context.neighbors) == n_stored
+
+
+def test_graph_reuse_tracks_overlap_of_reusing_blocks():
+    graphers = [Grapher(16, 4).eval() for _ in range(5)]
+    context = GraphContext(track_overlap=True)
+    share_knn_graphs(graphers, 2, context)
+    x = torch.randn(2, 16, 8, 8)
+    with torch.no_grad():
+        for grapher in graphers:
+            x = grapher(x)
+    report = context.overlap_report()
+    reusing = [grapher.graph_conv.dilated_knn_graph.graph_id for grapher in graphers[1::2]]
+    assert list(report) == sorted(reusing)
+    assert all(0.0 <= overlap <= 1.0 for overlap in report.values())
+
+
+def test_lsh_rotations_cache_is_bounded():
+    first = lsh_rotations(2, 8, 3, 'cpu', seed=0)
+    for n_proj in range(4, 4 + 2 * torch_edge._lsh_max_entries):
+        lsh_rotations(2, 8, n_proj, 'cpu', seed=0)
+    assert len(torch_edge._lsh_rotations) == torch_edge._lsh_max_entries
+    # evicted projections are drawn again from the same seed
+    assert torch.equal(lsh_rotations(2, 8, 3, 'cpu', seed=0), first)
+    assert lsh_rotations(2, 8, 3, 'cpu', seed=0) is lsh_rotations(2, 8, 3, 'cpu', seed=0)
+
+
+@pytest.mark.parametrize('reduced', [False, True])
+def test_traced_knn_uses_the_full_distance_matrix(monkeypatch, reduced):
+    x = _features(2, 24, 196)
+    y = _features(2, 24, 49, seed=2) if reduced else None
+    knn_graph = DenseDilatedKnnGraph(9, 1, tile_size=32).eval()
+    ref = knn_graph(x, y)
+    monkeypatch.setattr(torch_edge, 'is_compiling', lambda: True)
+    _same_neighbors(knn_graph(x, y), ref)
+
+
+@pytest.mark.parametrize('epsilon', [0.0, 1.0])
+def test_stochastic_dilation_picks_k_distinct_candidates(epsilon):
+    torch.manual_seed(0)
+    dilated = DenseDilated(k=9, dilation=2, stochastic=True, epsilon=epsilon).train()
+    edge_index = torch.arange(18).expand(1, 2, 5, 18)
+    out = dilated(edge_index)
+    assert out.shape == (1, 2, 5, 9)
+    assert out[0, 0, 0].unique().numel() == 9
+    if epsilon == 0.0:
+        assert torch.equal(out, edge_index[:, :, :, ::2])
+
+
+@pytest.mark.parametrize('hk, wk, window, k', [(2, 40, 3, 9), (1, 40, 3, 9), (40, 2, 3, 9), (3, 40, 3, 16),
+                                               (56, 56, 7, 18), (14, 14, 3, 20)])
+def test_window_holds_k_keys(hk, wk, window, k):
+    wh, ww = window_shape(hk, wk, window, k)
+    assert wh <= hk and ww <= wk
+    assert wh * ww >= k
+
+
+@pytest.mark.parametrize('h, w, r', [(2, 40, 1), (40, 2, 1), (4, 40, 2), (2, 60, 1)])
+def test_window_knn_on_thin_grids_has_k_distinct_neighbors(h, w, r):
+    k = 9
+    x = _features(2, 16, h * w)
+    y = F.avg_pool2d(x.view(2, 16, h, w), r).flatten(2).unsqueeze(-1) if r > 1 else None
+    cand, invalid = window_candidates(h, w, r, window=3, n_global=4, k=k)
+    assert ((~invalid).sum(-1) >= k).all()
+    nn_idx = window_knn_matrix(x, y, k, hw=(h, w), window=3, n_global=4)
+    assert nn_idx.shape == (1, 2, h * w, k)
+    sorted_idx = nn_idx.sort(dim=-1)[0]
+    assert (sorted_idx[..., 1:] != sorted_idx[..., :-1]).all()
+    assert (cand.unsqueeze(0).unsqueeze(-1) == nn_idx[0].unsqueeze(-2)).any(-2).all()
+
+
+def test_lsh_knn_recall_on_clustered_features():
+    x = _clustered_features(2, 32, 64, 16)
+    ref = dense_knn_matrix(x, 9, tile_size=None)
+    out = lsh_knn_matrix(x, k=9, n_hashes=4, bucket_size=32)
+    assert out.shape == ref.shape
+    assert _distinct(out)
+    assert neighbor_overlap(out[0], ref[0]).mean().item() >= 0.9
+
+
+def test_lsh_knn_recall_grows_with_hash_rounds():
+    # the first hash rounds are shared, so more rounds only add candidates
+    x = F.normalize(_features(2, 16, 1024), dim=1)
+    ref = dense_knn_matrix(x, 9, tile_size=None)
+    recall = [neighbor_overlap(lsh_knn_matrix(x, k=9, n_hashes=n_hashes, bucket_size=32)[0], ref[0])
+              for n_hashes in (1, 2, 4)]
+    assert (recall[1] >= recall[0]).all() and (recall[2] >= recall[1]).all()
+    assert recall[2].mean() > recall[0].mean()
+
+
+@pytest.mark.parametrize('h, w', [(20, 20), (16, 24)])
+def test_window_knn_finds_local_neighbors_exactly(h, w):
+    # features are the grid coordinates: the exact neighbors are the 3 x 3 patch of every node
+    generator = torch.Generator().manual_seed(0)
+    rows, cols = torch.meshgrid(torch.arange(h, dtype=torch.float64), torch.arange(w, dtype=torch.float64))
+    x = torch.stack([rows, cols]).view(1, 2, h * w, 1).repeat(2, 1, 1, 1)
+    x = x + 1e-3 * torch.randn(x.shape, generator=generator, dtype=torch.float64)
+    ref = dense_knn_matrix(x, 9, tile_size=None)
+    out = window_knn_matrix(x, k=9, hw=(h, w), window=5, n_global=4)
+    _same_neighbors(out, ref)
+
+
+def test_nn_descent_keeps_an_exact_seed_graph():
+    x = _features(2, 16, 196)
+    ref = dense_knn_matrix(x, 9, tile_size=None)
+    out = nn_descent_knn_matrix(x, ref[0], 9)
+    _same_neighbors(out, ref)
+
+
+def test_nn_descent_improves_the_graph_of_the_previous_block():
+    # the seed is the exact graph of slightly different features, as after one block
+    x = _features(2, 16, 400)
+    previous = x + 0.3 * _features(2, 16, 400, seed=1)
+    seed = dense_knn_matrix(previous, 9, tile_size=None)[0]
+    ref = dense_knn_matrix(x, 9, tile_size=None)[0]
+    seed_recall = neighbor_overlap(seed, ref)
+    recall = [neighbor_overlap(nn_descent_knn_matrix(x, seed, 9, n_rounds=n_rounds)[0], ref)
+              for n_rounds in (1, 2)]
+    assert _distinct(nn_descent_knn_matrix(x, seed, 9))
+    # every round scores the current neighbors again, so no query loses recall
+    assert (recall[0] >= seed_recall).all() and (recall[1] >= recall[0]).all()
+    assert recall[1].mean() > seed_recall.mean()
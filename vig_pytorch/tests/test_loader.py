@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('timm')
+
+from data.myloader import AugSeedDataset, AugSeedSampler
+
+
+class _RandomDataset(torch.utils.data.Dataset):
+    transform = None
+
+    def __len__(self):
+        return 10
+
+    def __getitem__(self, index):
+        return torch.rand(1).item() + random.random(), index
+
+
+def test_aug_seed_sampler_keys_depend_on_epoch_and_index_only():
+    sampler = AugSeedSampler(torch.utils.data.SequentialSampler(range(10)), batch_size=4, seed=42)
+    keys = list(sampler)
+    assert len(keys) == len(sampler) == 8
+    assert [index for index, _ in keys] == list(range(8))
+    reversed_keys = list(AugSeedSampler(list(reversed(range(10))), batch_size=4, seed=42))
+    assert dict(keys)[3] == dict(reversed_keys)[3]
+    sampler.set_epoch(1)
+    assert dict(list(sampler))[3] != dict(keys)[3]
+
+
+def test_aug_seed_sampler_queues_keys_in_order():
+    sampler = AugSeedSampler(torch.utils.data.SequentialSampler(range(10)), batch_size=4, seed=0)
+    keys = list(sampler) + list(sampler)
+    assert sampler.pop_keys(4) == keys[:4]
+    assert sampler.pop_keys(8) == keys[4:12]
+    assert not sampler.keys
+
+
+def test_aug_seed_sampler_repeated_samples_get_new_seeds():
+    keys = list(AugSeedSampler([0, 0, 1, 1], batch_size=2, seed=0))
+    assert keys[0][1] != keys[1][1]
+
+
+def test_aug_seed_dataset_is_deterministic_and_restores_rng():
+    dataset = AugSeedDataset(_RandomDataset())
+    torch.manual_seed(0)
+    expected = torch.rand(1)
+    torch.manual_seed(0)
+    first = dataset[(3, 123)]
+    assert torch.equal(torch.rand(1), expected)
+    assert dataset[(3, 123)] == first
+    assert dataset[(3, 124)] != first
+    dataset.transform = 'transform'
+    assert dataset.dataset.transform == 'transform'
@@ -0,0 +1,220 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('timm')
+F = torch.nn.functional
+
+import numpy as np
+
+from gcn_lib import Grapher
+from gcn_lib.pos_embed import get_2d_relative_pos_embed, get_relative_pos_table
+import pyramid_vig
+import vig
+
+
+def _images(batch_size, size, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(batch_size, 3, size, size, generator=generator)
+
+
+def _baseline_relative_pos(grapher):
+    # the frozen relative_pos parameter of the original Grapher
+    return _numpy_relative_pos(grapher.channels, grapher.n, grapher.r)
+
+
+def _numpy_relative_pos(channels, n, r):
+    table = torch.from_numpy(np.float32(get_2d_relative_pos_embed(channels, int(n ** 0.5))))
+    table = F.interpolate(table.unsqueeze(0).unsqueeze(1), size=(n, n // (r * r)), mode='bicubic',
+                          align_corners=False)
+    return -table.squeeze(1)
+
+
+@pytest.mark.parametrize('channels, grid_size, r', [(48, 56, 4), (96, 28, 2), (192, 14, 1)])
+def test_relative_pos_table_matches_numpy_table(channels, grid_size, r):
+    n = grid_size * grid_size
+    ref = _numpy_relative_pos(channels, n, r)
+    table = get_relative_pos_table(channels, n, r)
+    assert table.shape == ref.shape == (1, n, n // (r * r))
+    torch.testing.assert_close(table, ref, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(get_relative_pos_table(channels, n, r, (grid_size, grid_size)), table)
+
+
+def test_baseline_checkpoint_with_relative_pos_loads_strict():
+    torch.manual_seed(0)
+    source = pyramid_vig.pvig_ti_224_gelu(num_classes=10).eval()
+    state_dict = source.state_dict()
+    for name, module in source.named_modules():
+        if isinstance(module, Grapher) and module.relative_pos:
+            state_dict[name + '.relative_pos'] = _baseline_relative_pos(module)
+    torch.manual_seed(1)
+    model = pyramid_vig.pvig_ti_224_gelu(num_classes=10).eval()
+    model.load_state_dict(state_dict, strict=True)
+    images = _images(2, 224)
+    with torch.no_grad():
+        torch.testing.assert_close(model(images), source(images))
+
+
+def test_relative_pos_tables_are_shared_across_blocks():
+    model = pyramid_vig.pvig_ti_224_gelu(num_classes=10).eval()
+    with torch.no_grad():
+        model(_images(2, 224))
+    n_stages, n_graphers = 4, sum(isinstance(m, Grapher) for m in model.modules())
+    assert model.relative_pos_cache.stats() == {'entries': n_stages, 'hits': n_graphers - n_stages,
+                                                'misses': n_stages}
+
+
+def test_relative_pos_tables_are_cached_per_resolution():
+    model = pyramid_vig.pvig_ti_224_gelu(num_classes=10).eval()
+    n_stages, n_graphers = 4, sum(isinstance(m, Grapher) for m in model.modules())
+    with torch.no_grad():
+        ref = model(_images(1, 224))
+        model(_images(1, 256))
+        out = model(_images(1, 224))
+    assert model.relative_pos_cache.stats() == {'entries': 2 * n_stages, 'hits': 3 * n_graphers - 2 * n_stages,
+                                                'misses': 2 * n_stages}
+    torch.testing.assert_close(out, ref)
+
+
+def test_vig_checkpoint_loads_at_another_resolution():
+    torch.manual_seed(0)
+    source = vig.vig_ti_224_gelu(num_classes=10).eval()
+    torch.nn.init.normal_(source.pos_embed, std=0.02)
+    model = vig.vig_ti_224_gelu(num_classes=10, img_size=448).eval()
+    model.load_state_dict(source.state_dict(), strict=True)
+    assert model.pos_embed.shape == (1, 192, 28, 28)
+    torch.testing.assert_close(model.pos_embed, source.get_pos_embed(28, 28))
+    images = _images(2, 448)
+    with torch.no_grad():
+        torch.testing.assert_close(model(images), source(images))
+
+
+def test_pvig_checkpoint_loads_at_another_resolution():
+    source = pyramid_vig.pvig_ti_224_gelu(num_classes=10)
+    model = pyramid_vig.pvig_ti_224_gelu(num_classes=10, img_size=448).eval()
+    model.load_state_dict(source.state_dict(), strict=True)
+    assert model.pos_embed.shape == (1, 48, 112, 112)
+    with torch.no_grad():
+        assert model(_images(1, 448)).shape == (1, 10)
+
+
+def _parameter_grads(model, images):
+    model.zero_grad()
+    model(images).logsumexp(1).sum().backward()
+    return {name: p.grad for name, p in model.named_parameters() if p.grad is not None}
+
+
+@pytest.mark.parametrize('factory, size', [(vig.vig_ti_224_gelu, 64), (pyramid_vig.pvig_ti_224_gelu, 224)])
+def test_grad_checkpointing_keeps_parameter_gradients(factory, size):
+    torch.manual_seed(0)
+    model = factory(num_classes=10, img_size=size).double().train()
+    checkpointed = copy.deepcopy(model)
+    checkpointed.set_grad_checkpointing()
+    images = _images(2, size).double()
+    ref = _parameter_grads(model, images)
+    grads = _parameter_grads(checkpointed, images)
+    assert grads.keys() == ref.keys()
+    for name in ref:
+        torch.testing.assert_close(grads[name], ref[name], msg=name)
+
+
+def test_pvig_forward_features_returns_every_requested_stage():
+    model = pyramid_vig.pvig_ti_224_gelu(num_classes=10).eval()
+    images = _images(2, 224)
+    with torch.no_grad():
+        features = model.forward_features(images, stages=[0, 1, 2, 3], return_nodes=True, return_edges=True)
+        logits = model(images)
+    for stage, (channels, size) in enumerate(zip([48, 96, 240, 384], [56, 28, 14, 7])):
+        assert features['nodes'][stage].shape == (2, channels, size, size)
+        assert features['pooled'][stage].shape == (2, channels)
+    pooled = features['pooled'][3][:, :, None, None]
+    torch.testing.assert_close(model.prediction(pooled).flatten(1), logits)
+    graph_blocks = {i for i, block in enumerate(model.backbone)
+                    if any(isinstance(m, Grapher) for m in block.modules())}
+    assert set(features['edges']) == graph_blocks
+    assert features['edges'][0].shape[1:] == (2, 56 * 56, 9)
+
+
+def test_pvig_forward_features_stops_after_the_last_requested_stage():
+    model = pyramid_vig.pvig_ti_224_gelu(num_classes=10).eval()
+    with torch.no_grad():
+        features = model.forward_features(_images(1, 224), stages=[1], return_edges=True)
+    assert list(features['pooled']) == [1]
+    assert max(features['edges']) < model.stage_ends[1] + 1
+
+
+def test_early_exit_without_confident_heads_matches_forward():
+    torch.manual_seed(0)
+    model = vig.vig_ti_224_gelu(num_classes=10, img_size=64, exit_blocks=[3, 7]).double().eval()
+    images = _images(4, 64).double()
+    with torch.no_grad():
+        ref = model(images)
+    logits, blocks = model.forward_early_exit(images, threshold=1.1)
+    torch.testing.assert_close(logits, ref)
+    assert (blocks == model.n_blocks).all()
+
+
+def test_early_exit_samples_match_their_single_sample_run():
+    torch.manual_seed(0)
+    model = vig.vig_ti_224_gelu(num_classes=10, img_size=64, exit_blocks=[3, 7], graph_reuse=2).double().eval()
+    images = _images(4, 64).double()
+    with torch.no_grad():
+        nodes = model.forward_features(images, stages=[3], return_nodes=True)['nodes'][3]
+        confidence = F.softmax(model.exits[0](nodes).flatten(1), dim=1).max(dim=1)[0]
+    # some samples leave at the first head, the others run on as a smaller batch
+    threshold = confidence.median().item()
+    logits, blocks = model.forward_early_exit(images, threshold)
+    assert 4 in blocks.tolist() and blocks.max().item() > 4
+    for i in range(images.shape[0]):
+        single_logits, single_blocks = model.forward_early_exit(images[i:i + 1], threshold)
+        torch.testing.assert_close(logits[i:i + 1], single_logits)
+        assert blocks[i] == single_blocks[0]
+
+
+def test_pruning_that_keeps_every_node_matches_the_full_model():
+    torch.manual_seed(0)
+    full = vig.vig_ti_224_gelu(num_classes=10, img_size=64).double().eval()
+    pruned = vig.vig_ti_224_gelu(num_classes=10, img_size=64, prune_blocks=[3, 7], prune_keep=1.0).double().eval()
+    pruned.load_state_dict(full.state_dict(), strict=True)
+    images = _images(2, 64).double()
+    with torch.no_grad():
+        torch.testing.assert_close(pruned(images), full(images))
+
+
+@pytest.mark.parametrize('prune_score', ['norm', 'pool'])
+def test_pruning_keeps_the_scheduled_number_of_nodes(prune_score):
+    model = vig.vig_ti_224_gelu(num_classes=10, img_size=128, prune_blocks=[2, 5], prune_keep=0.5,
+                                prune_score=prune_score).eval()
+    nodes = []
+    handles = [block.register_forward_pre_hook(lambda module, inputs: nodes.append(inputs[0][0, 0].numel()))
+               for block in model.backbone]
+    with torch.no_grad():
+        logits = model(_images(2, 128))
+    for handle in handles:
+        handle.remove()
+    assert logits.shape == (2, 10)
+    assert nodes == [64] * 3 + [32] * 3 + [16] * 6
+
+
+def test_pruning_drops_masked_nodes_first():
+    model = vig.vig_ti_224_gelu(num_classes=10, img_size=64, prune_blocks=[0], prune_keep=0.5).eval()
+    x = torch.randn(2, 192, 4, 4)
+    node_mask = torch.zeros(2, 1, 4, 4)
+    node_mask[:, :, :, :2] = 1
+    x_kept, mask_kept = model.prune_nodes(x, node_mask)
+    assert x_kept.shape == (2, 192, 8, 1)
+    assert (mask_kept == 1).all()
+    torch.testing.assert_close(x_kept.squeeze(-1), x[:, :, :, :2].flatten(2))
+
+
+def test_vig_forward_features_matches_forward():
+    model = vig.vig_ti_224_gelu(num_classes=10, img_size=64, prune_blocks=[5], prune_keep=0.5).eval()
+    images = _images(2, 64)
+    with torch.no_grad():
+        features = model.forward_features(images, stages=[11, 3], return_nodes=True)
+        logits = model(images)
+    assert list(features['pooled']) == [3, 11]
+    assert features['nodes'][3].shape == (2, 192, 4, 4)
+    assert features['nodes'][11].shape == (2, 192, 8, 1)
+    torch.testing.assert_close(model.prediction(features['pooled'][11][:, :, None, None]).flatten(1), logits)
@@ -0,0 +1,45 @@
+import math
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('timm')
+
+from gcn_lib import DenseDilatedKnnGraph, MRConv2d, cached_profile, knn_cost, profile_model
+import vig
+
+
+def test_profile_counts_copy_free_mrconv_macs():
+    model = vig.vig_ti_224_gelu(num_classes=10, img_size=64)
+    copy_free = profile_model(model, (1, 3, 64, 64))
+    for m in model.modules():
+        if isinstance(m, MRConv2d):
+            m.copy_free = False
+    interleaved = profile_model(model, (1, 3, 64, 64))
+    assert copy_free['macs'] == interleaved['macs']
+    assert [b['macs'] for b in copy_free['blocks']] == [b['macs'] for b in interleaved['blocks']]
+    assert copy_free['knn_macs'] > 0
+    assert model.training
+
+
+def test_knn_cost_of_exact_knn():
+    x = torch.zeros(2, 16, 100, 1)
+    macs, topk_ops = knn_cost(DenseDilatedKnnGraph(9, 2), x)
+    assert macs == 2 * 100 * 100 * 16
+    assert topk_ops == int(2 * 100 * 100 * math.log2(18))
+
+
+def test_cached_profile_runs_once_per_key(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / 'profiles' / 'cache.json')
+    model = vig.vig_ti_224_gelu(num_classes=10, img_size=64)
+    report = cached_profile(model, 'vig_ti_224_gelu', {'knn': 'exact'}, (1, 3, 64, 64), cache_file)
+    assert report['model'] == 'vig_ti_224_gelu'
+
+    def fail(*args, **kwargs):
+        raise AssertionError('profiled again')
+    monkeypatch.setattr('gcn_lib.torch_profile.profile_model', fail)
+    assert cached_profile(model, 'vig_ti_224_gelu', {'knn': 'exact'}, (1, 3, 64, 64), cache_file) == report
+    with pytest.raises(AssertionError):
+        cached_profile(model, 'vig_ti_224_gelu', {'knn': 'lsh'}, (1, 3, 64, 64), cache_file)
+    with pytest.raises(AssertionError):
+        cached_profile(model, 'vig_ti_224_gelu', {'knn': 'exact'}, (1, 3, 64, 64), cache_file, refresh=True)
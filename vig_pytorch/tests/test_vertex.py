@@ -0,0 +1,194 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from gcn_lib import EdgeConv2d, GINConv2d, GINConv2dCSR, GraphSAGE, GraphSAGEChunked, MRConv2d, RelativePosCache, \
+    batched_index_select, max_relative, neighbor_max
+from gcn_lib import torch_vertex
+
+
+def _reference_max_relative(x, edge_index, y=None):
+    # the gather-based aggregation of MRConv2d without chunk_budget
+    x_j = batched_index_select(x if y is None else y, edge_index[0])
+    if edge_index.shape[0] > 1:
+        x_j, _ = torch.max(x_j - batched_index_select(x, edge_index[1]), -1, keepdim=True)
+        return x_j
+    x_j, _ = torch.max(x_j, -1, keepdim=True)
+    return x_j - x
+
+
+def _inputs(batch_size, channels, n_points, n_keys, k, centers, reduced, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.randn(batch_size, channels, n_points, 1, generator=generator, dtype=torch.float64)
+    y = torch.randn(batch_size, channels, n_keys, 1, generator=generator, dtype=torch.float64) if reduced else None
+    n_keys = n_keys if reduced else n_points
+    nn_idx = torch.randint(0, n_keys, (batch_size, n_points, k), generator=generator)
+    if centers:
+        # random centers exercise the scatter of the center gradient through center_idx
+        center_idx = torch.randint(0, n_points, (batch_size, n_points, k), generator=generator)
+        edge_index = torch.stack([nn_idx, center_idx])
+    else:
+        edge_index = nn_idx.unsqueeze(0)
+    return x, y, edge_index
+
+
+def _forward_backward(fn, x, y, edge_index):
+    x = x.detach().requires_grad_()
+    y = None if y is None else y.detach().requires_grad_()
+    out = fn(x, edge_index, y)
+    generator = torch.Generator().manual_seed(1)
+    out.backward(torch.randn(out.shape, generator=generator, dtype=out.dtype))
+    return out, x.grad, None if y is None else y.grad
+
+
+@pytest.mark.parametrize('centers', [False, True])
+@pytest.mark.parametrize('reduced', [False, True])
+@pytest.mark.parametrize('k, chunk_budget', [(9, 1e-3), (9, 64), (300, 1e-3)])
+def test_max_relative_matches_gather_reference(centers, reduced, k, chunk_budget):
+    # k > 256 stores the argmax as int64 instead of uint8
+    n_keys = 320 if k > 256 else 49
+    x, y, edge_index = _inputs(2, 8, 64, n_keys, k, centers, reduced)
+    ref = _forward_backward(_reference_max_relative, x, y, edge_index)
+    out = _forward_backward(lambda x, e, y: max_relative(x, e, y, chunk_budget), x, y, edge_index)
+    for a, b in zip(out, ref):
+        if b is None:
+            assert a is None
+        else:
+            assert torch.allclose(a, b)
+
+
+@pytest.mark.parametrize('centers', [False, True])
+@pytest.mark.parametrize('reduced', [False, True])
+def test_max_relative_gradcheck(centers, reduced):
+    x, y, edge_index = _inputs(2, 3, 10, 6, 4, centers, reduced)
+    x.requires_grad_()
+    if y is None:
+        assert torch.autograd.gradcheck(lambda x: max_relative(x, edge_index, None, 1e-5), (x,))
+    else:
+        y.requires_grad_()
+        assert torch.autograd.gradcheck(lambda x, y: max_relative(x, edge_index, y, 1e-5), (x, y))
+
+
+def test_neighbor_max_gradcheck():
+    _, y, edge_index = _inputs(2, 3, 10, 6, 4, False, True)
+    y.requires_grad_()
+    assert torch.autograd.gradcheck(lambda y: neighbor_max(y, edge_index[0], 1e-5), (y,))
+
+
+@pytest.mark.parametrize('centers', [False, True])
+@pytest.mark.parametrize('reduced', [False, True])
+def test_copy_free_mrconv_matches_interleaved_mrconv(centers, reduced):
+    x, y, edge_index = _inputs(2, 16, 64, 16, 9, centers, reduced)
+    reference = MRConv2d(16, 32, 'gelu', 'batch').double()
+    reference.copy_free = False
+    copy_free = MRConv2d(16, 32, 'gelu', 'batch').double()
+    copy_free.load_state_dict(reference.state_dict())
+    ref = _forward_backward(lambda x, e, y: reference(x, e, y), x, y, edge_index)
+    out = _forward_backward(lambda x, e, y: copy_free(x, e, y), x, y, edge_index)
+    for a, b in zip(out, ref):
+        if b is not None:
+            torch.testing.assert_close(a, b)
+    torch.testing.assert_close(copy_free.nn[0].weight.grad, reference.nn[0].weight.grad)
+    torch.testing.assert_close(copy_free.nn[0].bias.grad, reference.nn[0].bias.grad)
+
+
+@pytest.mark.parametrize('centers', [False, True])
+@pytest.mark.parametrize('reduced', [False, True])
+def test_chunked_mrconv_matches_gather_mrconv(centers, reduced):
+    x, y, edge_index = _inputs(2, 16, 64, 16, 9, centers, reduced)
+    reference = MRConv2d(16, 32, 'gelu', 'batch').double()
+    chunked = MRConv2d(16, 32, 'gelu', 'batch', chunk_budget=1e-3).double()
+    chunked.load_state_dict(reference.state_dict())
+    ref = _forward_backward(lambda x, e, y: reference(x, e, y), x, y, edge_index)
+    out = _forward_backward(lambda x, e, y: chunked(x, e, y), x, y, edge_index)
+    for a, b in zip(out, ref):
+        if b is not None:
+            assert torch.allclose(a, b)
+    for p, q in zip(chunked.parameters(), reference.parameters()):
+        assert torch.allclose(p.grad, q.grad)
+
+
+@pytest.mark.parametrize('centers', [False, True])
+@pytest.mark.parametrize('reduced', [False, True])
+@pytest.mark.parametrize('training', [False, True])
+def test_chunked_edgeconv_matches_full_edgeconv(centers, reduced, training):
+    # in training the batch norm of the chunked conv must use the statistics of all edges
+    x, y, edge_index = _inputs(2, 8, 64, 16, 9, centers, reduced)
+    reference = EdgeConv2d(8, 16, 'gelu', 'batch').double().train(training)
+    chunked = EdgeConv2d(8, 16, 'gelu', 'batch', chunk_budget=1e-3).double().train(training)
+    chunked.load_state_dict(reference.state_dict())
+    ref = _forward_backward(lambda x, e, y: reference(x, e, y), x, y, edge_index)
+    out = _forward_backward(lambda x, e, y: chunked(x, e, y), x, y, edge_index)
+    for a, b in zip(out, ref):
+        if b is not None:
+            assert torch.allclose(a, b)
+    for p, q in zip(chunked.parameters(), reference.parameters()):
+        assert torch.allclose(p.grad, q.grad)
+    for a, b in zip(chunked.buffers(), reference.buffers()):
+        assert torch.allclose(a.double(), b.double())
+
+
+def _randomize_batch_norms(module, seed=2):
+    generator = torch.Generator().manual_seed(seed)
+    for m in module.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.copy_(torch.randn(m.running_mean.shape, generator=generator))
+            m.running_var.copy_(torch.rand(m.running_var.shape, generator=generator) + 0.5)
+
+
+@pytest.mark.parametrize('reference_cls, variant_cls, tolerance', [(GraphSAGE, GraphSAGEChunked, 1e-8),
+                                                                    (GINConv2d, GINConv2dCSR, 1e-5)])
+@pytest.mark.parametrize('reduced', [False, True])
+def test_gather_free_convs_match_gather_convs_in_eval(reference_cls, variant_cls, tolerance, reduced):
+    x, y, edge_index = _inputs(2, 8, 64, 16, 9, False, reduced)
+    reference = reference_cls(8, 16, 'gelu', 'batch').double()
+    _randomize_batch_norms(reference)
+    reference.eval()
+    variant = variant_cls(8, 16, 'gelu', 'batch').double().eval()
+    variant.load_state_dict(reference.state_dict())
+    ref = _forward_backward(lambda x, e, y: reference(x, e, y), x, y, edge_index)
+    out = _forward_backward(lambda x, e, y: variant(x, e, y), x, y, edge_index)
+    for a, b in zip(out, ref):
+        if b is not None:
+            assert torch.allclose(a, b, rtol=tolerance, atol=tolerance)
+    for p, q in zip(variant.parameters(), reference.parameters()):
+        assert torch.allclose(p.grad, q.grad, rtol=tolerance, atol=tolerance)
+
+
+def test_chunked_sage_keeps_edge_batch_statistics_in_training():
+    x, y, edge_index = _inputs(2, 8, 64, 16, 9, False, True)
+    reference = GraphSAGE(8, 16, 'gelu', 'batch').double()
+    chunked = GraphSAGEChunked(8, 16, 'gelu', 'batch').double()
+    chunked.load_state_dict(reference.state_dict())
+    assert torch.allclose(chunked(x, edge_index, y), reference(x, edge_index, y))
+    for a, b in zip(chunked.buffers(), reference.buffers()):
+        assert torch.allclose(a.double(), b.double())
+
+
+def test_relative_pos_cache_evicts_least_recently_used_table():
+    cache = RelativePosCache(max_entries=2)
+    tables = {key: cache.get(key, lambda: torch.zeros(1)) for key in ('a', 'b')}
+    assert cache.get('a', lambda: torch.ones(1)) is tables['a']
+    cache.get('c', lambda: torch.zeros(1))
+    assert list(cache.tables) == ['a', 'c']
+    assert cache.stats() == {'entries': 2, 'hits': 1, 'misses': 3}
+
+
+def test_relative_pos_cache_stores_tables_while_tracing(monkeypatch):
+    cache = RelativePosCache(max_entries=1)
+    builds = []
+
+    def build():
+        builds.append(1)
+        return torch.zeros(1)
+    monkeypatch.setattr(torch_vertex, 'is_compiling', lambda: True)
+    table = cache.get('a', build)
+    assert cache.get('a', build) is table
+    cache.get('b', build)
+    assert len(builds) == 2
+    assert cache.stats() == {'entries': 2, 'hits': 0, 'misses': 0}
+    monkeypatch.setattr(torch_vertex, 'is_compiling', lambda: False)
+    assert cache.get('a', build) is table
+    assert cache.stats() == {'entries': 2, 'hits': 1, 'misses': 0}
+    cache.get('c', build)
+    assert cache.stats() == {'entries': 1, 'hits': 1, 'misses': 1}
@@ -30,6 +30,7 @@ from datetime import datetime
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.utils
 from torch.nn.parallel import DistributedDataParallel as NativeDDP
 
@@ -51,6 +52,8 @@ from timm.scheduler import create_scheduler
 from timm.utils import ApexScaler, NativeScaler
 
 from data.myloader import create_loader
+from gcn_lib import Instrumentation, cached_profile, compile_model, format_profile, optimize_for_inference, \
+    quantize_int8
 import pyramid_vig
 import vig
 
@@ -72,6 +75,9 @@ except AttributeError:
 torch.backends.cudnn.benchmark = True
 _logger = logging.getLogger('train')
 
+# teacher logits read from / written to --kd-cache-dir in the current epoch
+_kd_cache_stats = {'hits': 0, 'misses': 0}
+
 # The first arg parser parses out only the --config argument, this argument is used to
 # load a yaml file containing key-values that override the defaults for the main parser below
 config_parser = parser = argparse.ArgumentParser(description='Training Config', add_help=False)
@@ -100,6 +106,40 @@ parser.add_argument('--gp', default=None, type=str, metavar='POOL',
                     help='Global pool type, one of (fast, avg, max, avgmax, avgmaxc). Model default if None.')
 parser.add_argument('--img-size', type=int, default=None, metavar='N',
                     help='Image patch size (default: None => model default)')
+parser.add_argument('--knn', default=None, type=str, metavar='NAME',
+                    help='KNN backend of the Grapher blocks: exact, cosine, lsh, window or nndescent (default: None => model default)')
+parser.add_argument('--graph-reuse', default=None, type=int, nargs='+', metavar='N',
+                    help='Grapher blocks sharing one KNN graph: one value, or one per stage for pyramid_vig (default: None => 1)')
+parser.add_argument('--graph-conv', default=None, type=str, metavar='NAME',
+                    help='Graph convolution of the Grapher blocks: mr, edge, sage, gin, sage_chunked or gin_csr (default: None => model default)')
+parser.add_argument('--chunk-budget', default=None, type=float, metavar='MB',
+                    help='Run the graph convolution in vertex chunks of this many MB of gathers (default: None => off)')
+parser.add_argument('--exit-blocks', default=None, type=int, nargs='+', metavar='N',
+                    help='Backbone blocks followed by an early-exit head trained jointly, e.g. 3 5 7 (vig models only, default: None => off)')
+parser.add_argument('--exit-loss-weight', type=float, default=0.3, metavar='W',
+                    help='Weight of the mean early-exit head loss (default: 0.3)')
+parser.add_argument('--prune-blocks', default=None, type=int, nargs='+', metavar='N',
+                    help='Backbone blocks after which low-importance nodes are dropped, e.g. 4 8 12 (vig models only, default: None => off)')
+parser.add_argument('--prune-keep', type=float, default=0.7, metavar='RATIO',
+                    help='Fraction of the nodes kept at every pruning block (default: 0.7)')
+parser.add_argument('--prune-score', default='norm', type=str, metavar='NAME',
+                    help='Node importance used for pruning: norm or pool (default: norm)')
+parser.add_argument('--compile', action='store_true', default=False,
+                    help='Compile the model with torch.compile (torch >= 2.0)')
+parser.add_argument('--compile-mode', default=None, type=str, metavar='MODE',
+                    help='torch.compile mode, e.g. reduce-overhead or max-autotune (default: None)')
+parser.add_argument('--grad-checkpoint', default=None, type=int, nargs='*', metavar='N',
+                    help='Recompute the activations of these backbone blocks in backward, all blocks if no index is given (default: off)')
+parser.add_argument('--profile', action='store_true', default=False,
+                    help='Log per-block params, MACs (KNN distances and top-k included) and activation sizes at startup')
+parser.add_argument('--profile-cache', default='profile_cache.json', type=str, metavar='PATH',
+                    help='JSON file caching the profiles per model, config and input size (default: profile_cache.json)')
+parser.add_argument('--instrument', type=int, default=0, metavar='N',
+                    help='Time the KNN, gathers, graph conv and FFN of every block and sample peak memory over N '
+                         'forwards of the first epoch (or of --evaluate) (default: 0 => off)')
+parser.add_argument('--instrument-file', default='instrumentation.json', type=str, metavar='PATH',
+                    help='Per-block instrumentation report in the output dir, CSV if it ends with .csv '
+                         '(default: instrumentation.json)')
 parser.add_argument('--crop-pct', default=None, type=float,
                     metavar='N', help='Input image center crop percent (for validation only)')
 parser.add_argument('--mean', type=float, nargs='+', default=None, metavar='MEAN',
@@ -287,6 +327,24 @@ parser.add_argument('--attn_ratio', type=float, default=1.,
 parser.add_argument("--pretrain_path", default=None, type=str)
 parser.add_argument("--evaluate", action='store_true', default=False,
                     help='whether evaluate the model')
+parser.add_argument('--ptq', action='store_true', default=False,
+                    help='INT8 post-training static quantization: calibrate on the train split, then compare '
+                         'accuracy and throughput with fp32 on CPU')
+parser.add_argument('--ptq-calib-batches', type=int, default=16, metavar='N',
+                    help='train batches used for the INT8 calibration (default: 16)')
+parser.add_argument('--ptq-backend', default='fbgemm', type=str, metavar='NAME',
+                    help='quantized engine, fbgemm (x86) or qnnpack (ARM) (default: fbgemm)')
+parser.add_argument('--teacher-model', default=None, type=str, metavar='MODEL',
+                    help='Distill from this frozen teacher, e.g. vig_b_224_gelu (default: None => off)')
+parser.add_argument('--teacher-checkpoint', default='', type=str, metavar='PATH',
+                    help='Checkpoint of the teacher model (default: none)')
+parser.add_argument('--kd-alpha', type=float, default=0.5, metavar='W',
+                    help='Weight of the distillation loss, the train loss gets 1 - alpha (default: 0.5)')
+parser.add_argument('--kd-temperature', type=float, default=4.0, metavar='T',
+                    help='Softmax temperature of the distillation loss (default: 4.0)')
+parser.add_argument('--kd-cache-dir', default=None, type=str, metavar='PATH',
+                    help='Cache the teacher logits per sample and augmentation seed in this directory; every '
+                         'sample is then augmented from a seed of --seed, the epoch and its index (default: None => off)')
 
 
 def _parse_args():
@@ -354,7 +412,18 @@ def main():
         bn_tf=args.bn_tf,
         bn_momentum=args.bn_momentum,
         bn_eps=args.bn_eps,
+        knn=args.knn,
+        graph_reuse=args.graph_reuse,
+        chunk_budget=args.chunk_budget,
+        conv=args.graph_conv,
+        img_size=args.img_size,
+        exit_blocks=args.exit_blocks,
+        prune_blocks=args.prune_blocks,
+        prune_keep=args.prune_keep,
+        prune_score=args.prune_score,
         checkpoint_path=args.initial_checkpoint)
+    if args.grad_checkpoint is not None:
+        model.set_grad_checkpointing(True, args.grad_checkpoint or None)
         
     ################## pretrain ############
     if args.pretrain_path is not None:
@@ -362,29 +431,20 @@ def main():
         state_dict = torch.load(args.pretrain_path)
         model.load_state_dict(state_dict, strict=False)
         print('Pretrain weights loaded.')
-    ################### flops #################
-    print(model)
-    if hasattr(model, 'default_cfg'):
-        default_cfg = model.default_cfg
-        input_size = [1] + list(default_cfg['input_size'])
-    else:
-        input_size = [1, 3, 224, 224]
-    input = torch.randn(input_size)#.cuda()
-    
-    from torchprofile import profile_macs
-    model.eval()
-    macs = profile_macs(model, input)
-    model.train()
-    print('model flops:', macs, 'input_size:', input_size)
-    ##########################################
     
     if args.local_rank == 0:
         _logger.info('Model %s created, param count: %d' %
                      (args.model, sum([m.numel() for m in model.parameters()])))
+        if args.profile:
+            profile_model_cost(model, args)
     
     data_config = resolve_data_config(vars(args), model=model, verbose=args.local_rank == 0)
     if data_config.get('mean') is None or data_config.get('std') is None:
         _logger.warning("[DEBUG] mean or std is None in data_config. This may indicate a preprocessing mismatch, especially for direction classification data.")
+
+    if args.ptq:
+        run_ptq(model, data_config, args)
+        return
     
     num_aug_splits = 0
     if args.aug_splits > 0:
@@ -462,6 +522,19 @@ def main():
             decay=args.model_ema_decay,
             device='cpu' if args.model_ema_force_cpu else '',
             resume=args.resume)
+
+    if args.compile and args.instrument:
+        _logger.warning('--instrument times the eager model, ignoring --compile')
+        args.compile = False
+    if args.compile:
+        # after the EMA copy, which stays eager
+        compile_model(model, args.compile_mode)
+        if args.local_rank == 0:
+            _logger.info('Compiled the model with torch.compile (mode: {})'.format(args.compile_mode))
+
+    teacher = None
+    if args.teacher_model:
+        teacher = create_teacher(args)
     
     if args.distributed:
         if args.sync_bn:
@@ -518,6 +591,11 @@ def main():
         else:
             mixup_fn = Mixup(**mixup_args)
 
+    if args.kd_cache_dir and (not args.teacher_model or mixup_active or num_aug_splits > 1):
+        # the teacher input must be a function of one sample and its augmentation seed
+        _logger.warning('--kd-cache-dir needs --teacher-model and no mixup, cutmix or aug splits, ignoring it')
+        args.kd_cache_dir = None
+
     if num_aug_splits > 1:
         dataset_train = AugMixDataset(dataset_train, num_splits=num_aug_splits)
 
@@ -550,7 +628,8 @@ def main():
         collate_fn=collate_fn,
         pin_memory=args.pin_mem,
         use_multi_epochs_loader=args.use_multi_epochs_loader,
-        repeated_aug=args.repeated_aug
+        repeated_aug=args.repeated_aug,
+        seed=args.seed if args.kd_cache_dir else None
     )
 
     eval_dir = os.path.join(args.data, 'test')
@@ -585,9 +664,19 @@ def main():
         train_loss_fn = nn.CrossEntropyLoss().cuda()
     validate_loss_fn = nn.CrossEntropyLoss().cuda()
     
+    instrumentation = None
+    if args.instrument:
+        instrumentation = Instrumentation(model.module if hasattr(model, 'module') else model,
+                                          args.instrument).start()
+
     if args.evaluate:
-        eval_metrics = validate(model, loader_eval, validate_loss_fn, args, amp_autocast=amp_autocast)
-        print(eval_metrics)
+        if teacher is not None:
+            kd_report(model, teacher, loader_eval, validate_loss_fn, args, amp_autocast=amp_autocast)
+        else:
+            eval_metrics = validate(model, loader_eval, validate_loss_fn, args, amp_autocast=amp_autocast)
+            print(eval_metrics)
+        if instrumentation is not None:
+            save_instrumentation(instrumentation, args)
         return
     
     eval_metric = args.eval_metric
@@ -616,13 +705,22 @@ def main():
 
     try:
         for epoch in range(start_epoch, num_epochs):
-            if args.distributed:
+            if args.distributed or args.kd_cache_dir:
                 loader_train.sampler.set_epoch(epoch)
 
             train_metrics = train_epoch(
                 epoch, model, loader_train, optimizer, train_loss_fn, args,
                 lr_scheduler=lr_scheduler, saver=saver, output_dir=output_dir,
-                amp_autocast=amp_autocast, loss_scaler=loss_scaler, model_ema=model_ema, mixup_fn=mixup_fn)
+                amp_autocast=amp_autocast, loss_scaler=loss_scaler, model_ema=model_ema, mixup_fn=mixup_fn,
+                teacher=teacher)
+            if args.kd_cache_dir and args.local_rank == 0:
+                lookups = max(_kd_cache_stats['hits'] + _kd_cache_stats['misses'], 1)
+                _logger.info('Teacher logits cache: {} sample hits, {} misses ({:.1f}% hit rate)'.format(
+                    _kd_cache_stats['hits'], _kd_cache_stats['misses'], 100. * _kd_cache_stats['hits'] / lookups))
+            _kd_cache_stats.update(hits=0, misses=0)
+            if instrumentation is not None:
+                save_instrumentation(instrumentation, args, output_dir)
+                instrumentation = None
 
             # train_loss の記録
             train_loss_history.append(train_metrics['loss'])
@@ -659,6 +757,8 @@ def main():
         pass
     if best_metric is not None:
         _logger.info('*** Best metric: {0} (epoch {1})'.format(best_metric, best_epoch))
+    if teacher is not None:
+        kd_report(model, teacher, loader_eval, validate_loss_fn, args, amp_autocast=amp_autocast)
 
     # ★★★ 学習終了後に train loss / val loss をプロットして保存 ★★★
     if args.local_rank == 0:
@@ -679,7 +779,7 @@ def main():
 def train_epoch(
         epoch, model, loader, optimizer, loss_fn, args,
         lr_scheduler=None, saver=None, output_dir='', amp_autocast=suppress,
-        loss_scaler=None, model_ema=None, mixup_fn=None):
+        loss_scaler=None, model_ema=None, mixup_fn=None, teacher=None):
 
     if args.mixup_off_epoch and epoch >= args.mixup_off_epoch:
         if args.prefetcher and loader.mixup_enabled:
@@ -706,10 +806,24 @@ def train_epoch(
                 input, target = mixup_fn(input, target)
         if args.channels_last:
             input = input.contiguous(memory_format=torch.channels_last)
+        if teacher is not None:
+            keys = loader.sampler.pop_keys(input.size(0)) if args.kd_cache_dir else None
+            soft_target = teacher_logits(teacher, input, args, keys, amp_autocast)
 
         with amp_autocast():
             output = model(input)
-            loss = loss_fn(output, target)
+            if isinstance(output, tuple):
+                # early-exit heads: final loss plus the weighted mean loss of the exits
+                output, aux = output
+                loss = loss_fn(output, target) + args.exit_loss_weight * sum(loss_fn(o, target) for o in aux) / len(aux)
+            else:
+                loss = loss_fn(output, target)
+            if teacher is not None:
+                # Hinton KD on the final output, scaled by T^2 to keep the gradient size of the hard loss
+                t = args.kd_temperature
+                kd_loss = F.kl_div(F.log_softmax(output.float() / t, dim=1), F.softmax(soft_target / t, dim=1),
+                                   reduction='batchmean') * t * t
+                loss = (1 - args.kd_alpha) * loss + args.kd_alpha * kd_loss
         
         if torch.isnan(loss):
             _logger.error(f"[DEBUG] NaN detected in loss at epoch {epoch}, batch {batch_idx}.")
@@ -788,7 +902,173 @@ def train_epoch(
     return OrderedDict([('loss', losses_m.avg)])
 
 
-def validate(model, loader, loss_fn, args, amp_autocast=suppress, log_suffix=''):
+def profile_model_cost(model, args):
+    """Per-block cost report of the freshly created model, cached per model, config and input size."""
+    if args.img_size is not None:
+        input_size = [1, 3, args.img_size, args.img_size]
+    elif hasattr(model, 'default_cfg'):
+        input_size = [1] + list(model.default_cfg['input_size'])
+    else:
+        input_size = [1, 3, 224, 224]
+    config = {key: getattr(args, key) for key in (
+        'num_classes', 'knn', 'graph_reuse', 'graph_conv', 'chunk_budget', 'exit_blocks', 'prune_blocks',
+        'prune_keep', 'prune_score')}
+    report = cached_profile(model, args.model, config, input_size, args.profile_cache)
+    _logger.info('Model profile:\n' + format_profile(report))
+    return report
+
+
+def save_instrumentation(instrumentation, args, output_dir=''):
+    """Stops the per-block instrumentation and writes its report (rank 0)."""
+    instrumentation.stop()
+    if args.local_rank == 0:
+        path = os.path.join(output_dir, args.instrument_file)
+        instrumentation.save(path)
+        _logger.info('Per-block latency and memory of {} forwards saved to {}'.format(instrumentation.recorded, path))
+
+
+def create_teacher(args):
+    """Frozen teacher for distillation: batch norms folded, eval mode, no gradients."""
+    teacher = create_model(
+        args.teacher_model,
+        num_classes=args.num_classes,
+        img_size=args.img_size,
+        checkpoint_path=args.teacher_checkpoint)
+    if not args.teacher_checkpoint:
+        _logger.warning('Distilling from a teacher without --teacher-checkpoint')
+    teacher = optimize_for_inference(teacher.cuda(), log_info=args.local_rank == 0)
+    for p in teacher.parameters():
+        p.requires_grad_(False)
+    if args.channels_last:
+        teacher = teacher.to(memory_format=torch.channels_last)
+    if args.local_rank == 0:
+        _logger.info('Distilling from teacher %s (alpha %.2f, temperature %.1f)' %
+                     (args.teacher_model, args.kd_alpha, args.kd_temperature))
+    return teacher
+
+
+def teacher_logits(teacher, input, args, keys=None, amp_autocast=suppress):
+    """
+    Float32 teacher logits of a training batch. With --kd-cache-dir, keys holds the (dataset index,
+    augmentation seed) of every sample and the logits are stored in float16 per teacher and key
+    along with a 4x4 thumbnail of the augmented sample. A sample is reused only while its thumbnail
+    still matches, so other data or transforms recompute instead of reading stale targets, and the
+    teacher only runs on the samples that miss. Misses return the float16-rounded logits as well, so
+    the targets do not depend on whether they came from the cache.
+    """
+    if keys is None:
+        with torch.no_grad(), amp_autocast():
+            return teacher(input).float()
+    fingerprints = F.adaptive_avg_pool2d(input.float(), 4).flatten(1).cpu()
+    paths = [os.path.join(args.kd_cache_dir, args.teacher_model, '{:05d}'.format(index // 1000),
+                          '{:08d}_{}.pt'.format(index, seed)) for index, seed in keys]
+    logits = [None] * len(keys)
+    for i, path in enumerate(paths):
+        if os.path.isfile(path):
+            cached = torch.load(path)
+            if cached['fingerprint'].shape == fingerprints[i].shape and \
+                    torch.allclose(cached['fingerprint'], fingerprints[i], atol=1e-3):
+                logits[i] = cached['logits']
+    missing = [i for i, l in enumerate(logits) if l is None]
+    _kd_cache_stats['hits'] += len(keys) - len(missing)
+    _kd_cache_stats['misses'] += len(missing)
+    if missing:
+        with torch.no_grad(), amp_autocast():
+            computed = teacher(input[missing]).half().cpu()
+        for i, l in zip(missing, computed):
+            os.makedirs(os.path.dirname(paths[i]), exist_ok=True)
+            # clone so that every file only holds its own sample
+            torch.save({'logits': l.clone(), 'fingerprint': fingerprints[i].clone()}, paths[i])
+            logits[i] = l
+    return torch.stack(logits).to(input.device).float()
+
+
+def kd_report(model, teacher, loader, loss_fn, args, amp_autocast=suppress):
+    """Accuracy retention and speed-up of the distilled student against its teacher."""
+    input = next(iter(loader))[0]
+    if not args.prefetcher:
+        input = input.cuda()
+    results = OrderedDict()
+    for name, m in (('teacher', teacher), ('student', model)):
+        metrics = validate(m, loader, loss_fn, args, amp_autocast=amp_autocast, log_suffix=' ({})'.format(name),
+                           results_file='evaluation_results_{}.txt'.format(name))
+        with torch.no_grad(), amp_autocast():
+            m(input)
+            torch.cuda.synchronize()
+            start = time.time()
+            for _ in range(5):
+                m(input)
+            torch.cuda.synchronize()
+        metrics['img_per_sec'] = 5 * input.size(0) / (time.time() - start)
+        results[name] = metrics
+    if args.local_rank == 0:
+        teacher_metrics, student_metrics = results['teacher'], results['student']
+        _logger.info('KD: teacher {} Acc@1 {:.3f} ({:.1f} img/s), student {} Acc@1 {:.3f} ({:.1f} img/s): '
+                     '{:.1f}% of the teacher accuracy at {:.2f}x speed'.format(
+                         args.teacher_model, teacher_metrics['top1'], teacher_metrics['img_per_sec'],
+                         args.model, student_metrics['top1'], student_metrics['img_per_sec'],
+                         100. * student_metrics['top1'] / max(teacher_metrics['top1'], 1e-8),
+                         student_metrics['img_per_sec'] / teacher_metrics['img_per_sec']))
+    return results
+
+
+def run_ptq(model, data_config, args):
+    """INT8 post-training quantization: calibrate on train batches, then evaluate fp32 and int8 on CPU."""
+    device = torch.device('cpu')
+    if args.resume:
+        resume_checkpoint(model, args.resume, log_info=args.local_rank == 0)
+    model = model.cpu().eval()
+    # shuffled train batches without augmentation
+    loader_calib = create_loader(
+        Dataset(os.path.join(args.data, 'train')),
+        input_size=data_config['input_size'],
+        batch_size=args.batch_size,
+        is_training=True,
+        use_prefetcher=False,
+        no_aug=True,
+        interpolation=data_config['interpolation'],
+        mean=data_config['mean'],
+        std=data_config['std'],
+        num_workers=args.workers,
+    )
+    loader_eval = create_loader(
+        Dataset(os.path.join(args.data, 'test')),
+        input_size=data_config['input_size'],
+        batch_size=args.validation_batch_size_multiplier * args.batch_size,
+        is_training=False,
+        use_prefetcher=False,
+        interpolation=data_config['interpolation'],
+        mean=data_config['mean'],
+        std=data_config['std'],
+        num_workers=args.workers,
+        crop_pct=data_config['crop_pct'],
+    )
+    calibration = (input for i, (input, _) in zip(range(args.ptq_calib_batches), loader_calib))
+    model_int8 = quantize_int8(model, calibration, args.ptq_backend)
+    _logger.info('Calibrated INT8 model on {} train batches'.format(args.ptq_calib_batches))
+
+    loss_fn = nn.CrossEntropyLoss()
+    input = next(iter(loader_eval))[0]
+    results = OrderedDict()
+    for name, m in (('fp32', model), ('int8', model_int8)):
+        metrics = validate(m, loader_eval, loss_fn, args, log_suffix=' ({})'.format(name), device=device,
+                           results_file='evaluation_results_{}.txt'.format(name))
+        with torch.no_grad():
+            m(input)
+            start = time.time()
+            for _ in range(5):
+                m(input)
+        metrics['img_per_sec'] = 5 * input.size(0) / (time.time() - start)
+        results[name] = metrics
+    for name, metrics in results.items():
+        _logger.info('{}: Acc@1 {:.3f}  Acc@5 {:.3f}  {:.1f} img/s ({:.2f}x)'.format(
+            name, metrics['top1'], metrics['top5'], metrics['img_per_sec'],
+            metrics['img_per_sec'] / results['fp32']['img_per_sec']))
+    return results
+
+
+def validate(model, loader, loss_fn, args, amp_autocast=suppress, log_suffix='', device=None,
+             results_file='evaluation_results.txt'):
     batch_time_m = AverageMeter()
     losses_m = AverageMeter()
     top1_m = AverageMeter()
@@ -814,7 +1094,10 @@ def validate(model, loader, loss_fn, args, amp_autocast=suppress, log_suffix='')
     with torch.no_grad():
         for batch_idx, (input, target) in enumerate(loader):
             last_batch = batch_idx == last_idx
-            if not args.prefetcher:
+            if device is not None:
+                input = input.to(device)
+                target = target.to(device)
+            elif not args.prefetcher:
                 input = input.cuda()
                 target = target.cuda()
             if args.channels_last:
@@ -840,7 +1123,8 @@ def validate(model, loader, loss_fn, args, amp_autocast=suppress, log_suffix='')
             else:
                 reduced_loss = loss.data
     
-            torch.cuda.synchronize()
+            if input.is_cuda:
+                torch.cuda.synchronize()
     
             losses_m.update(reduced_loss.item(), input.size(0))
             top1_m.update(acc1.item(), output.size(0))
@@ -908,7 +1192,7 @@ def validate(model, loader, loss_fn, args, amp_autocast=suppress, log_suffix='')
             f"{cls_idx}\t{class_name}\t{total}\t{top1_corr}\t{top1_acc:.2f}\t{top5_corr}\t{top5_acc:.2f}"
         )
     
-    output_txt_path = os.path.join(args.output, "evaluation_results.txt")
+    output_txt_path = os.path.join(args.output, results_file)
     with open(output_txt_path, "w") as f:
         f.write("Overall evaluation metrics:\n")
         f.write(f"Loss: {losses_m.avg:.4f}\n")
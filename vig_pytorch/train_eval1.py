@@ -14,6 +14,8 @@ from collections import defaultdict, OrderedDict
 from datetime import datetime
 from contextlib import suppress
 import vig
+import pyramid_vig
+from gcn_lib import Instrumentation, compile_model
 
 import torch
 import torch.nn as nn
@@ -55,12 +57,27 @@ def dict_softmax(scores_dict):
             result[k] = float('nan')
     return result
 
+def valid_region_mask(region, size):
+    # 有効領域 [left, top, right, bottom]（割合）を size x size グリッドのマスク (1, size, size) に変換
+    # セルの一部でも有効領域に掛かれば有効とする
+    left, top, right, bottom = region
+    edges = torch.arange(size, dtype=torch.float32) / size
+    cols = (edges + 1.0 / size > left) & (edges < right)
+    rows = (edges + 1.0 / size > top) & (edges < bottom)
+    return (rows.view(-1, 1) & cols.view(1, -1)).float().unsqueeze(0)
+
 class MyImageDataset(torch.utils.data.Dataset):
-    def __init__(self, root, transform=None, labeled=True):
+    def __init__(self, root, transform=None, labeled=True, valid_regions=None, mask_size=56):
         self.root = root
         self.transform = transform
         self.samples = []
         self.labeled = labeled
+        # クロップ時に記録した有効領域（valid_regions.json）。指定時はノードマスクも返す
+        self.valid_regions = None
+        self.mask_size = mask_size
+        if valid_regions:
+            with open(valid_regions, "r", encoding="utf-8") as f:
+                self.valid_regions = json.load(f)
 
         if self.labeled:
             subdirs = [d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d))]
@@ -79,6 +96,32 @@ class MyImageDataset(torch.utils.data.Dataset):
                 if fname.lower().endswith(('.jpg', '.jpeg', '.png')):
                     fpath = os.path.join(root, fname)
                     self.samples.append((fpath, -1))
+        if self.valid_regions is not None:
+            self.regions = self._resolve_regions()
+
+    def _resolve_regions(self):
+        # キーは root からの相対パス ("ラベル/ファイル名")。dataset_split / unify_direction がキーを付け替える
+        # 付け替え前のサイドカーはファイル名で引くが、同名ファイルが別の領域を持つ場合は推測せず全域を有効とする
+        by_name = defaultdict(list)
+        for key, region in self.valid_regions.items():
+            by_name[os.path.basename(key)].append(region)
+        regions, ambiguous = [], []
+        for path, _ in self.samples:
+            key = "/".join(os.path.relpath(path, self.root).split(os.sep))
+            region = self.valid_regions.get(key)
+            if region is None:
+                candidates = by_name.get(os.path.basename(path), [])
+                if candidates and all(c == candidates[0] for c in candidates):
+                    region = candidates[0]
+                else:
+                    if candidates:
+                        ambiguous.append(key)
+                    region = [0.0, 0.0, 1.0, 1.0]
+            regions.append(region)
+        if ambiguous:
+            _logger.warning(f"valid_regions: {len(ambiguous)} 枚はファイル名が複数の有効領域に一致するためマスクしません"
+                            f"（例: {ambiguous[0]}）。分割後の valid_regions.json を指定してください")
+        return regions
 
     def __len__(self):
         return len(self.samples)
@@ -88,6 +131,8 @@ class MyImageDataset(torch.utils.data.Dataset):
         img = Image.open(path).convert('RGB')
         if self.transform:
             img = self.transform(img)
+        if self.valid_regions is not None:
+            return img, label, path, valid_region_mask(self.regions[index], self.mask_size)
         return img, label, path
 
 def parse_class_name(class_name):
@@ -96,7 +141,8 @@ def parse_class_name(class_name):
         return parts[0], parts[1]
     return class_name, None
 
-def extract_logits(model, loader, output_file, idx_to_class, labeled=True, amp_autocast=suppress):
+def extract_logits(model, loader, output_file, idx_to_class, labeled=True, amp_autocast=suppress,
+                   skip_masked=False):
     model.eval()
     desired_order = ["front", "frontside", "side", "backside", "back"]
 
@@ -123,10 +169,19 @@ def extract_logits(model, loader, output_file, idx_to_class, labeled=True, amp_a
         overall_obj_top1 = 0
         overall_obj_top5 = 0
 
-        for batch_idx, (inputs, targets, paths) in enumerate(loader):
+        for batch_idx, batch in enumerate(loader):
+            inputs, targets, paths = batch[:3]
             inputs = inputs.cuda()
             with amp_autocast():
-                outputs = model(inputs)
+                if len(batch) > 3:
+                    # パディング部分のノードマスク付き
+                    node_mask = batch[3].cuda()
+                    if skip_masked:
+                        outputs = model(inputs, node_mask=node_mask, skip_masked=True)
+                    else:
+                        outputs = model(inputs, node_mask=node_mask)
+                else:
+                    outputs = model(inputs)
             if isinstance(outputs, (tuple, list)):
                 outputs = outputs[0]
             logits = outputs.cpu()
@@ -295,6 +350,74 @@ def extract_logits(model, loader, output_file, idx_to_class, labeled=True, amp_a
 
     return
 
+def extract_features(model, loader, output_file, stages=None, return_nodes=False, return_edges=False,
+                     device=None, amp_autocast=suppress):
+    # 予測ヘッドを通さずにバックボーンの埋め込み（およびノード特徴・KNN グラフ）を保存
+    model.eval()
+    pooled, nodes, edges = defaultdict(list), defaultdict(list), defaultdict(list)
+    all_paths, all_targets = [], []
+    with torch.no_grad():
+        for batch in loader:
+            inputs, targets, paths = batch[:3]
+            inputs = inputs.to(device)
+            node_mask = batch[3].to(device) if len(batch) > 3 else None
+            with amp_autocast():
+                features = model.forward_features(inputs, stages, return_nodes, return_edges, node_mask=node_mask)
+            for stage, value in features['pooled'].items():
+                pooled[stage].append(value.float().cpu())
+            for stage, value in features.get('nodes', {}).items():
+                nodes[stage].append(value.cpu())
+            for block, value in features.get('edges', {}).items():
+                edges[block].append(value[0].cpu())
+            all_paths.extend(paths)
+            all_targets.append(torch.as_tensor(targets))
+
+    result = {
+        "paths": all_paths,
+        "targets": torch.cat(all_targets),
+        "pooled": {stage: torch.cat(values) for stage, values in pooled.items()},
+    }
+    if return_nodes:
+        result["nodes"] = {stage: torch.cat(values) for stage, values in nodes.items()}
+    if return_edges:
+        result["edges"] = {block: torch.cat(values) for block, values in edges.items()}
+    torch.save(result, output_file)
+    _logger.info(f"Saved features of {len(all_paths)} images (stages: {sorted(result['pooled'])}) to {output_file}")
+    return result
+
+def early_exit_report(model, loader, thresholds, device, amp_autocast=suppress, output_file=None):
+    # しきい値ごとの Top1 精度・平均実行ブロック数・1 枚あたりの時間
+    model.eval()
+    rows = []
+    for threshold in thresholds:
+        correct, total, blocks_sum, elapsed = 0, 0, 0, 0.0
+        with torch.no_grad():
+            for batch in loader:
+                inputs, targets = batch[0].to(device), batch[1].to(device)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+                with amp_autocast():
+                    logits, blocks = model.forward_early_exit(inputs, threshold)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                elapsed += time.perf_counter() - start
+                correct += (logits.argmax(dim=1) == targets).sum().item()
+                blocks_sum += blocks.sum().item()
+                total += targets.numel()
+        rows.append((threshold, 100.0 * correct / max(total, 1), blocks_sum / max(total, 1),
+                     1000.0 * elapsed / max(total, 1)))
+
+    lines = ["threshold  Acc@1  avg_blocks/{}  ms/img".format(model.n_blocks)]
+    for threshold, acc, blocks, ms in rows:
+        lines.append("{:9.3f}  {:6.2f}  {:13.2f}  {:6.3f}".format(threshold, acc, blocks, ms))
+    for line in lines:
+        _logger.info(line)
+    if output_file is not None:
+        with open(output_file, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+    return rows
+
 def _parse_args():
     config_parser = argparse.ArgumentParser(description='Evaluation Config', add_help=False)
     config_parser.add_argument('-c', '--config',
@@ -319,6 +442,39 @@ def _parse_args():
                         help='評価のみ実行する')
     parser.add_argument('--amp', action='store_true', default=True)
     parser.add_argument('--img-size', type=int, default=224, metavar='N')
+    parser.add_argument('--knn', default=None, type=str,
+                        help='Grapher の KNN バックエンド（exact, cosine, lsh, window, nndescent）')
+    parser.add_argument('--graph-reuse', default=None, type=int, nargs='+',
+                        help='1 つの KNN グラフを共有する Grapher ブロック数（1 つ、pvig ではステージごとも可）')
+    parser.add_argument('--exit-blocks', default=None, type=int, nargs='+',
+                        help='早期終了ヘッドを置くブロック番号（学習時と同じ値、vig モデルのみ）')
+    parser.add_argument('--exit-thresholds', default=None, type=float, nargs='+',
+                        help='早期終了の softmax 信頼度しきい値（複数指定で精度・速度カーブを出力）')
+    parser.add_argument('--prune-blocks', default=None, type=int, nargs='+',
+                        help='重要度の低いノードを削減するブロック番号（vig モデルのみ）')
+    parser.add_argument('--prune-keep', type=float, default=0.7,
+                        help='削減ブロックごとに残すノードの割合')
+    parser.add_argument('--prune-score', default='norm', type=str,
+                        help='ノード重要度の指標（norm: 特徴ノルム, pool: 平均プーリング出力への寄与）')
+    parser.add_argument('--valid-regions', default=None, type=str,
+                        help='評価 split の valid_regions.json（例: data/test/valid_regions.json）。'
+                             '指定するとパディング部分のノードを KNN 候補から除外する')
+    parser.add_argument('--dump-features', action='store_true', default=False,
+                        help='予測ヘッドを通さないバックボーン埋め込みを features.pt に保存する')
+    parser.add_argument('--feature-stages', default=None, type=int, nargs='+',
+                        help='埋め込みを保存するブロック番号（vig）またはステージ番号（pvig）。省略時は最終段')
+    parser.add_argument('--dump-nodes', action='store_true', default=False,
+                        help='ノードごとの特徴も保存する')
+    parser.add_argument('--dump-edges', action='store_true', default=False,
+                        help='ブロックごとの KNN グラフ（edge_index）も保存する')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='torch.compile でモデルをコンパイルする（torch >= 2.0）')
+    parser.add_argument('--instrument', type=int, default=0, metavar='N',
+                        help='N バッチ分、ブロックごとの KNN・gather・グラフ畳み込み・FFN の時間とピークメモリを計測する（0: 無効）')
+    parser.add_argument('--instrument-file', default='instrumentation.json', type=str,
+                        help='計測結果の出力ファイル名（.csv で終わる場合は CSV）')
+    parser.add_argument('--skip-masked', action='store_true', default=False,
+                        help='バッチ全体でパディングのノードを計算から除外する（vig モデルのみ）')
     parser.add_argument('--seed', type=int, default=42, metavar='S')
     parser.add_argument("--local_rank", default=0, type=int)
     parser.add_argument('--eval-dir', default='val', type=str,
@@ -363,13 +519,21 @@ def main():
         transforms.ToTensor(),
         transforms.Normalize(mean=data_config['mean'], std=data_config['std'])
     ])
-    dataset_val = MyImageDataset(eval_root, transform=val_transform, labeled=True)
+    dataset_val = MyImageDataset(eval_root, transform=val_transform, labeled=True,
+                                 valid_regions=args.valid_regions, mask_size=args.img_size // 4)
     loader_val = DataLoader(dataset_val, batch_size=args.batch_size,
                             shuffle=False, num_workers=args.workers,
                             pin_memory=args.pin_mem)
 
     model = create_model(args.model, num_classes=args.num_classes,
-                         pretrained=False, img_size=args.img_size)
+                         pretrained=False, img_size=args.img_size, knn=args.knn,
+                         graph_reuse=args.graph_reuse, exit_blocks=args.exit_blocks,
+                         prune_blocks=args.prune_blocks, prune_keep=args.prune_keep,
+                         prune_score=args.prune_score)
+    if args.skip_masked and not isinstance(model, vig.DeepGCN):
+        # pyramid_vig のノードはダウンサンプリングのためグリッド上に残す必要がある
+        _logger.error("--skip-masked は vig モデルのみ対応しています（pvig では --valid-regions のみ指定してください）")
+        exit(1)
     model = model.to(device)
     _logger.info(f"Loading checkpoint from {args.resume}")
     state_dict = torch.load(args.resume, map_location=device)
@@ -378,11 +542,37 @@ def main():
     missing, unexpected = model.load_state_dict(state_dict, strict=False)
     _logger.info(f"Checkpoint loaded (missing: {missing}, unexpected: {unexpected})")
     model.eval()
+    if args.compile and args.instrument:
+        _logger.warning("--instrument は eager モデルを計測するため、--compile を無視します")
+    elif args.compile:
+        compile_model(model)
+    instrumentation = None
+    if args.instrument:
+        instrumentation = Instrumentation(model, args.instrument).start()
 
     output_file = os.path.join(output_dir, "logits_val.txt")
     _logger.info(f"Extracting logits for validation data to {output_file}")
     extract_logits(model, loader_val, output_file, dataset_val.idx_to_class,
-                   labeled=True, amp_autocast=amp_autocast)
+                   labeled=True, amp_autocast=amp_autocast, skip_masked=args.skip_masked)
+    if instrumentation is not None:
+        # ブロックごとの時間・メモリ内訳を保存し、以降の処理ではフックを外す
+        instrumentation.stop()
+        instrumentation_file = os.path.join(output_dir, args.instrument_file)
+        instrumentation.save(instrumentation_file)
+        _logger.info(f"Instrumentation ({instrumentation.recorded} batches) saved to {instrumentation_file}")
+    if getattr(model, 'relative_pos_cache', None) is not None:
+        _logger.info(f"Relative position cache: {model.relative_pos_cache.stats()}")
+
+    if args.dump_features:
+        extract_features(model, loader_val, os.path.join(output_dir, "features.pt"), args.feature_stages,
+                         args.dump_nodes, args.dump_edges, device, amp_autocast)
+
+    if args.exit_thresholds:
+        if not getattr(model, 'exit_blocks', None):
+            _logger.warning("--exit-thresholds を指定しましたが、モデルに早期終了ヘッドがありません")
+        else:
+            early_exit_report(model, loader_val, args.exit_thresholds, device, amp_autocast,
+                              os.path.join(output_dir, "early_exit.txt"))
 
     _logger.info("Evaluation finished.")
 
@@ -6,7 +6,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Sequential as Seq
-from gcn_lib import Grapher, act_layer
+from torch.utils.checkpoint import checkpoint
+from gcn_lib import Grapher, act_layer, GraphContext, record_knn_graphs, share_knn_graphs
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.models.helpers import load_pretrained
@@ -99,6 +100,7 @@ class DeepGCN(torch.nn.Module):
         conv = opt.conv
         self.n_blocks = opt.n_blocks
         drop_path = opt.drop_path
+        knn_args = dict(opt.knn_args, knn=opt.knn)
         
         self.stem = Stem(out_dim=channels, act=act)
 
@@ -106,21 +108,51 @@ class DeepGCN(torch.nn.Module):
         print('dpr', dpr)
         num_knn = [int(x.item()) for x in torch.linspace(k, 2*k, self.n_blocks)]  # number of knn's k
         print('num_knn', num_knn)
-        max_dilation = 196 // max(num_knn)
+        h, w = to_2tuple(opt.img_size)
+        for _ in range(4):  # the stem halves the resolution four times
+            h, w = (h + 1) // 2, (w + 1) // 2
+        max_dilation = max(1, h * w // max(num_knn))
         
-        self.pos_embed = nn.Parameter(torch.zeros(1, channels, 14, 14))
+        self.pos_embed = nn.Parameter(torch.zeros(1, channels, h, w))
+        self._pos_embed_cache = {}
 
         if opt.use_dilation:
             self.backbone = Seq(*[Seq(Grapher(channels, num_knn[i], min(i // 4 + 1, max_dilation), conv, act, norm,
-                                                bias, stochastic, epsilon, 1, drop_path=dpr[i]),
+                                                bias, stochastic, epsilon, 1, drop_path=dpr[i], knn_args=knn_args,
+                                                chunk_budget=opt.chunk_budget),
                                       FFN(channels, channels * 4, act=act, drop_path=dpr[i])
                                      ) for i in range(self.n_blocks)])
         else:
             self.backbone = Seq(*[Seq(Grapher(channels, num_knn[i], 1, conv, act, norm,
-                                                bias, stochastic, epsilon, 1, drop_path=dpr[i]),
+                                                bias, stochastic, epsilon, 1, drop_path=dpr[i], knn_args=knn_args,
+                                                chunk_budget=opt.chunk_budget),
                                       FFN(channels, channels * 4, act=act, drop_path=dpr[i])
                                      ) for i in range(self.n_blocks)])
 
+        graph_reuse = opt.graph_reuse
+        if isinstance(graph_reuse, (list, tuple)):
+            if len(graph_reuse) != 1:
+                raise NotImplementedError('graph_reuse:{} per stage is not supported by vig (one stage)'.format(
+                    graph_reuse))
+            graph_reuse = graph_reuse[0]
+        self.graph_context = GraphContext()
+        share_knn_graphs([block[0] for block in self.backbone], graph_reuse, self.graph_context)
+
+        # auxiliary early-exit classifiers after the blocks in exit_blocks
+        self.exit_blocks = sorted(opt.exit_blocks or [])
+        self.exits = nn.ModuleList([Seq(nn.BatchNorm2d(channels),
+                                        nn.AdaptiveAvgPool2d(1),
+                                        nn.Conv2d(channels, opt.n_classes, 1, bias=True))
+                                    for _ in self.exit_blocks])
+
+        # node pruning: after the blocks in prune_blocks only the prune_keep most important nodes go on
+        if opt.prune_score not in ('norm', 'pool'):
+            raise NotImplementedError('prune_score:{} is not supported'.format(opt.prune_score))
+        self.prune_blocks = sorted(opt.prune_blocks or [])
+        self.prune_keep = opt.prune_keep
+        self.prune_score = opt.prune_score
+        self.checkpoint_blocks = set()
+
         self.prediction = Seq(nn.Conv2d(channels, 1024, 1, bias=True),
                               nn.BatchNorm2d(1024),
                               act_layer(act),
@@ -137,34 +169,210 @@ class DeepGCN(torch.nn.Module):
                     m.bias.data.zero_()
                     m.bias.requires_grad = True
 
-    def forward(self, inputs):
-        x = self.stem(inputs) + self.pos_embed
+    def get_pos_embed(self, H, W):
+        """pos_embed interpolated to an H x W node grid, cached per resolution in inference"""
+        if (H, W) == tuple(self.pos_embed.shape[2:]):
+            return self.pos_embed
+        if torch.is_grad_enabled():
+            return F.interpolate(self.pos_embed, size=(H, W), mode='bicubic', align_corners=False)
+        key = (H, W, self.pos_embed.device, self.pos_embed.dtype, self.pos_embed._version)
+        if key not in self._pos_embed_cache:
+            if len(self._pos_embed_cache) >= 4:
+                self._pos_embed_cache.clear()
+            self._pos_embed_cache[key] = F.interpolate(self.pos_embed, size=(H, W), mode='bicubic',
+                                                       align_corners=False)
+        return self._pos_embed_cache[key]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of another resolution: resize pos_embed to the grid of this model
+        pos_embed = state_dict.get(prefix + 'pos_embed')
+        if pos_embed is not None and pos_embed.shape != self.pos_embed.shape:
+            state_dict[prefix + 'pos_embed'] = F.interpolate(pos_embed, size=self.pos_embed.shape[2:],
+                                                             mode='bicubic', align_corners=False)
+        super(DeepGCN, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def set_grad_checkpointing(self, enable=True, blocks=None):
+        """Recompute the activations of the backbone blocks in blocks (default: all) in backward."""
+        self.checkpoint_blocks = set(range(self.n_blocks) if blocks is None else blocks) if enable else set()
+
+    def _run_block(self, i, x, node_mask):
+        # the replay in backward restores the node mask this block saw in forward
+        self.graph_context.node_mask = node_mask
+        return self.backbone[i](x)
+
+    def prune_nodes(self, x, node_mask=None):
+        """
+        Keep the ceil(prune_keep * N) most important nodes of x (B, C, H, W) or (B, C, N, 1), scored by
+        their feature norm (norm) or their contribution to the average-pooled embedding (pool).
+        Masked nodes of node_mask (B, 1, H, W) or (B, 1, N, 1) are dropped first.
+        Returns:
+            the kept nodes in their original order as (B, C, N', 1) and their mask (B, 1, N', 1) or None
+        """
+        B, C = x.shape[:2]
+        x = x.reshape(B, C, -1)
+        n_keep = max(1, int(math.ceil(x.shape[2] * self.prune_keep)))
+        if self.prune_score == 'norm':
+            score = x.norm(dim=1)
+        else:
+            score = (x * x.mean(dim=2, keepdim=True)).sum(dim=1)
+        if node_mask is not None:
+            score = score.masked_fill(node_mask.flatten(1) == 0, float('-inf'))
+        idx = score.topk(n_keep, dim=1, sorted=False)[1].sort(dim=1)[0]
+        x = torch.gather(x, 2, idx.unsqueeze(1).expand(-1, C, -1))
+        if node_mask is not None:
+            node_mask = torch.gather(node_mask.flatten(2), 2, idx.unsqueeze(1)).unsqueeze(-1)
+        return x.unsqueeze(-1), node_mask
+
+    def _embed(self, inputs, node_mask=None, skip_masked=False):
+        # stem, position embedding and node mask of the backbone input
+        x = self.stem(inputs)
         B, C, H, W = x.shape
+        x = x + self.get_pos_embed(H, W)
+        if node_mask is not None:
+            node_mask = F.adaptive_max_pool2d(node_mask.float(), (H, W))
+            if skip_masked:
+                keep = node_mask.flatten(2).amax(dim=(0, 1)) > 0
+                x = x.flatten(2)[:, :, keep].unsqueeze(-1)
+                node_mask = node_mask.flatten(2)[:, :, keep].unsqueeze(-1)
+        self.graph_context.node_mask = node_mask
+        return x, node_mask
+
+    def forward_features(self, inputs, stages=None, return_nodes=False, return_edges=False, node_mask=None):
+        """
+        Backbone embeddings without the prediction head; blocks after the last requested one are not run.
+        Args:
+            inputs: (B, 3, H, W) images
+            stages: backbone block indices whose outputs are returned (default: the last block)
+            return_nodes: also return the node features of these blocks, (B, C, H, W) or (B, C, N', 1) after pruning
+            return_edges: also return the KNN edge_index (1, B, N, k) of every block up to the last requested one
+            node_mask: see forward
+        Returns:
+            dict with 'pooled' {block: (B, C)} and, if requested, 'nodes' {block: features} and 'edges' {block: edge_index}
+        """
+        stages = [self.n_blocks - 1] if stages is None else sorted(stages)
+        features = {'pooled': {}}
+        if return_nodes:
+            features['nodes'] = {}
+        handles = []
+        if return_edges:
+            features['edges'] = {}
+            handles = record_knn_graphs(enumerate(self.backbone[:stages[-1] + 1]), features['edges'])
+        x, node_mask = self._embed(inputs, node_mask)
+        for i, block in enumerate(self.backbone[:stages[-1] + 1]):
+            x = block(x)
+            if i in stages:
+                features['pooled'][i] = F.adaptive_avg_pool2d(x, 1).flatten(1)
+                if return_nodes:
+                    features['nodes'][i] = x
+            if i in self.prune_blocks:
+                x, node_mask = self.prune_nodes(x, node_mask)
+                self.graph_context.node_mask = node_mask
+        self.graph_context.node_mask = None
+        for handle in handles:
+            handle.remove()
+        return features
+
+    def forward(self, inputs, node_mask=None, skip_masked=False):
+        """
+        Args:
+            inputs: (B, 3, H, W) images
+            node_mask: (B, 1, h, w) mask of the image content (e.g. the unpadded part of a square crop)
+                at any resolution, or None. Masked nodes are no KNN candidates of the valid ones.
+            skip_masked: drop the nodes masked in every sample of the batch before the first block
+        """
+        x, node_mask = self._embed(inputs, node_mask, skip_masked)
         
+        aux = []
+        for i, block in enumerate(self.backbone):
+            if i in self.checkpoint_blocks and torch.is_grad_enabled():
+                x = checkpoint(self._run_block, i, x, node_mask, use_reentrant=False)
+            else:
+                x = block(x)
+            if self.training and i in self.exit_blocks:
+                aux.append(self.exits[self.exit_blocks.index(i)](x).flatten(1))
+            if i in self.prune_blocks:
+                x, node_mask = self.prune_nodes(x, node_mask)
+                self.graph_context.node_mask = node_mask
+        self.graph_context.node_mask = None
+
+        x = F.adaptive_avg_pool2d(x, 1)
+        x = self.prediction(x).squeeze(-1).squeeze(-1)
+        if aux:
+            # training with exits: final logits and the logits of every exit head
+            return x, aux
+        return x
+
+    @torch.no_grad()
+    def forward_early_exit(self, inputs, threshold=0.9):
+        """
+        Inference that stops every sample at the first exit head whose softmax confidence reaches
+        threshold; the samples still running continue as a smaller batch.
+        Returns:
+            logits (B, n_classes) and the number of blocks run for every sample (B,)
+        """
+        x, _ = self._embed(inputs)
+        B = x.shape[0]
+        logits = None
+        blocks = torch.full((B,), self.n_blocks, dtype=torch.long, device=x.device)
+        active = torch.arange(B, device=x.device)
         for i in range(self.n_blocks):
             x = self.backbone[i](x)
+            if i in self.exit_blocks:
+                out = self.exits[self.exit_blocks.index(i)](x).flatten(1)
+                if logits is None:
+                    logits = out.new_zeros(B, out.shape[1])
+                done = F.softmax(out.float(), dim=1).max(dim=1)[0] >= threshold
+                if done.any():
+                    logits[active[done]] = out[done]
+                    blocks[active[done]] = i + 1
+                    keep = ~done
+                    x, active = x[keep], active[keep]
+                    self.graph_context.compact(keep)
+                    if active.numel() == 0:
+                        return logits, blocks
+            if i in self.prune_blocks:
+                x, _ = self.prune_nodes(x)
+        out = self.prediction(F.adaptive_avg_pool2d(x, 1)).squeeze(-1).squeeze(-1)
+        if logits is None:
+            return out, blocks
+        logits[active] = out.to(logits.dtype)
+        return logits, blocks
 
-        x = F.adaptive_avg_pool2d(x, 1)
-        return self.prediction(x).squeeze(-1).squeeze(-1)
+
+class _OptInit(object):
+    """Options shared by the vig factories; every factory sets the size of its backbone on top."""
+    def __init__(self, num_classes=1000, drop_path_rate=0.0, drop_rate=0.0, num_knn=9, knn='exact',
+                 knn_args=None, graph_reuse=1, chunk_budget=None, conv='mr', img_size=224, exit_blocks=None,
+                 prune_blocks=None, prune_keep=0.7, prune_score='norm', **kwargs):
+        self.k = num_knn # neighbor num (default:9)
+        self.conv = conv # graph conv layer {edge, mr, sage, gin, sage_chunked, gin_csr}
+        self.img_size = img_size # input resolution the model is built for, int or (H, W)
+        self.exit_blocks = exit_blocks # blocks followed by an early-exit head, e.g. [3, 5, 7] (None: no exits)
+        self.prune_blocks = prune_blocks # blocks after which low-importance nodes are dropped, e.g. [4, 8, 12] (None: keep all)
+        self.prune_keep = prune_keep # fraction of the nodes kept at every pruning block
+        self.prune_score = prune_score # node importance for pruning {norm, pool}
+        self.act = 'gelu' # activation layer {relu, prelu, leakyrelu, gelu, hswish}
+        self.norm = 'batch' # batch or instance normalization {batch, instance}
+        self.bias = True # bias of conv layer True or False
+        self.n_classes = num_classes # Dimension of out_channels
+        self.dropout = drop_rate # dropout rate
+        self.use_dilation = True # use dilated knn or not
+        self.epsilon = 0.2 # stochastic epsilon for gcn
+        self.use_stochastic = False # stochastic for gcn, True or False
+        self.drop_path = drop_path_rate
+        self.knn = knn # knn backend {exact, cosine, lsh, window, nndescent}
+        self.knn_args = knn_args or {} # extra DenseDilatedKnnGraph options, e.g. {'tile_size': 512}
+        self.graph_reuse = graph_reuse # blocks sharing one KNN graph (1: rebuild in every block)
+        self.chunk_budget = chunk_budget # MB per vertex chunk of the memory-efficient edge, mr and sage_chunked convs (None: off)
 
 
 @register_model
 def vig_ti_224_gelu(pretrained=False, **kwargs):
-    class OptInit:
-        def __init__(self, num_classes=1000, drop_path_rate=0.0, drop_rate=0.0, num_knn=9, **kwargs):
-            self.k = num_knn # neighbor num (default:9)
-            self.conv = 'mr' # graph conv layer {edge, mr}
-            self.act = 'gelu' # activation layer {relu, prelu, leakyrelu, gelu, hswish}
-            self.norm = 'batch' # batch or instance normalization {batch, instance}
-            self.bias = True # bias of conv layer True or False
+    class OptInit(_OptInit):
+        def __init__(self, **kwargs):
+            super(OptInit, self).__init__(**kwargs)
             self.n_blocks = 12 # number of basic blocks in the backbone
             self.n_filters = 192 # number of channels of deep features
-            self.n_classes = num_classes # Dimension of out_channels
-            self.dropout = drop_rate # dropout rate
-            self.use_dilation = True # use dilated knn or not
-            self.epsilon = 0.2 # stochastic epsilon for gcn
-            self.use_stochastic = False # stochastic for gcn, True or False
-            self.drop_path = drop_path_rate
 
     opt = OptInit(**kwargs)
     model = DeepGCN(opt)
@@ -174,21 +382,11 @@ def vig_ti_224_gelu(pretrained=False, **kwargs):
 
 @register_model
 def vig_s_224_gelu(pretrained=False, **kwargs):
-    class OptInit:
-        def __init__(self, num_classes=1000, drop_path_rate=0.0, drop_rate=0.0, num_knn=9, **kwargs):
-            self.k = num_knn # neighbor num (default:9)
-            self.conv = 'mr' # graph conv layer {edge, mr}
-            self.act = 'gelu' # activation layer {relu, prelu, leakyrelu, gelu, hswish}
-            self.norm = 'batch' # batch or instance normalization {batch, instance}
-            self.bias = True # bias of conv layer True or False
+    class OptInit(_OptInit):
+        def __init__(self, **kwargs):
+            super(OptInit, self).__init__(**kwargs)
             self.n_blocks = 16 # number of basic blocks in the backbone
             self.n_filters = 320 # number of channels of deep features
-            self.n_classes = num_classes # Dimension of out_channels
-            self.dropout = drop_rate # dropout rate
-            self.use_dilation = True # use dilated knn or not
-            self.epsilon = 0.2 # stochastic epsilon for gcn
-            self.use_stochastic = False # stochastic for gcn, True or False
-            self.drop_path = drop_path_rate
 
     opt = OptInit(**kwargs)
     model = DeepGCN(opt)
@@ -198,21 +396,11 @@ def vig_s_224_gelu(pretrained=False, **kwargs):
 
 @register_model
 def vig_b_224_gelu(pretrained=False, **kwargs):
-    class OptInit:
-        def __init__(self, num_classes=1000, drop_path_rate=0.0, drop_rate=0.0, num_knn=9, **kwargs):
-            self.k = num_knn # neighbor num (default:9)
-            self.conv = 'mr' # graph conv layer {edge, mr}
-            self.act = 'gelu' # activation layer {relu, prelu, leakyrelu, gelu, hswish}
-            self.norm = 'batch' # batch or instance normalization {batch, instance}
-            self.bias = True # bias of conv layer True or False
+    class OptInit(_OptInit):
+        def __init__(self, **kwargs):
+            super(OptInit, self).__init__(**kwargs)
             self.n_blocks = 16 # number of basic blocks in the backbone
             self.n_filters = 640 # number of channels of deep features
-            self.n_classes = num_classes # Dimension of out_channels
-            self.dropout = drop_rate # dropout rate
-            self.use_dilation = True # use dilated knn or not
-            self.epsilon = 0.2 # stochastic epsilon for gcn
-            self.use_stochastic = False # stochastic for gcn, True or False
-            self.drop_path = drop_path_rate
 
     opt = OptInit(**kwargs)
     model = DeepGCN(opt)